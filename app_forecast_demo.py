@@ -6,9 +6,25 @@ import seaborn as sns
 from datetime import datetime, timedelta
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.preprocessing import StandardScaler
+from scipy.optimize import minimize
+from joblib import Parallel, delayed
 from prophet import Prophet
+from prophet import __version__ as prophet_version
+from prophet.serialize import model_to_json, model_from_json
+from prophet.utilities import regressor_coefficients
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import sqlite3
+from contextlib import closing
 import logging
+import hashlib
+import io
+import csv
+import re
+import os
+import glob
 
 # Disabilita log pesanti di Prophet
 logging.getLogger('prophet').setLevel(logging.ERROR)
@@ -55,6 +71,7 @@ if 'meta_scale' not in st.session_state: st.session_state.meta_scale = 1.0
 if 'sat_val' not in st.session_state: st.session_state.sat_val = 0.85
 if 'is_demo_loaded' not in st.session_state: st.session_state.is_demo_loaded = False
 if 'last_uploaded_file' not in st.session_state: st.session_state.last_uploaded_file = None
+if 'last_history_merge' not in st.session_state: st.session_state.last_history_merge = None
 
 # --- FUNZIONI DI UTILITÀ ---
 
@@ -65,21 +82,47 @@ def clean_currency_us(column):
     s = s.str.replace(',', '', regex=False) 
     return pd.to_numeric(s, errors='coerce').fillna(0)
 
-def parse_iso_week(week_str):
-    try:
-        week_str = str(week_str).strip()
-        if len(week_str) < 6: return pd.NaT
-        year = int(week_str[:4])
-        week = int(week_str[4:])
-        return datetime.fromisocalendar(year, week, 1) 
-    except:
-        return pd.NaT
-
-def get_week_range_label_with_year(date):
-    if pd.isna(date): return ""
-    start = date
-    end = date + timedelta(days=6)
-    return f"{start.strftime('%d %b')} - {end.strftime('%d %b %Y')}"
+def parse_iso_week(values):
+    """Converte la colonna 'YYYYWW' nel lunedì della settimana ISO, in modo vettoriale.
+    Valori non validi (testo, settimane inesistenti, lunghezza < 6) diventano NaT. Come il parser
+    originale (int() sulla parte settimana) sono ammessi spazi tra anno e settimana ("2023 01")."""
+    values = pd.Series(values)
+    # Export multi-store/giornalieri ripetono la stessa settimana: parsing sui soli valori unici
+    codes, uniq = pd.factorize(values, use_na_sentinel=False)
+    s = pd.Series(uniq, dtype=object).astype(str).str.strip()
+    parts = s.str.extract(r'^(\d{4})\s*(\d{1,3})$')
+    parts.loc[s.str.len() < 6] = np.nan  # "20231": 5 caratteri, non è un codice settimana
+    year = pd.to_numeric(parts[0]).to_numpy(dtype=float)
+    week = pd.to_numeric(parts[1]).to_numpy(dtype=float)
+    valid = (year >= 1678) & (year <= 2261)  # range supportato da datetime64[ns]
+    year = np.where(valid, year, 1970).astype(np.int64)
+    week = np.where(valid, week, 1).astype(np.int64)
+
+    # Lunedì della week 1 ISO = lunedì della settimana che contiene il 4 gennaio
+    jan_1 = (year - 1970).astype('datetime64[Y]').astype('datetime64[D]').astype(np.int64)
+    jan_4 = jan_1 + 3
+    week1_monday = jan_4 - (jan_4 + 3) % 7  # 1970-01-01 era giovedì (weekday 3)
+    next_jan_1 = (year + 1 - 1970).astype('datetime64[Y]').astype('datetime64[D]').astype(np.int64)
+    weeks_in_year = (next_jan_1 - 4 - week1_monday) // 7 + 1  # settimana del 28 dicembre
+    valid &= (week >= 1) & (week <= weeks_in_year)
+
+    days = week1_monday + (week - 1) * 7
+    dates = days.astype('datetime64[D]').astype('datetime64[ns]')
+    dates[~valid] = np.datetime64('NaT')
+    return pd.Series(dates[codes], index=values.index)
+
+def week_range_labels(dates):
+    """Etichette 'Periodo' in blocco: strftime solo sulle date uniche, poi mappatura ("" per NaT)."""
+    dates = pd.Series(dates)
+    uniq = pd.Series(dates.dropna().unique())
+    labels = uniq.dt.strftime('%d %b') + ' - ' + (uniq + pd.Timedelta(days=6)).dt.strftime('%d %b %Y')
+    return dates.map(pd.Series(labels.to_numpy(), index=uniq)).fillna("")
+
+def seasonal_profile(seasonal, columns):
+    """Profilo stagionale denso (54, n colonne) indicizzato per settimana ISO (riga 0 inutilizzata): le settimane
+    assenti dallo storico prendono la media del profilo. Lookup per settimana = gather su array."""
+    profile = seasonal.set_index('Week')[columns].reindex(range(54))
+    return profile.fillna(seasonal[columns].mean()).to_numpy(dtype=np.float64)
 
 def clean_percentage(val):
     if pd.isna(val): return 0.0
@@ -87,103 +130,1192 @@ def clean_percentage(val):
     try: return float(s)
     except: return 0.0
 
-def generate_demo_data():
-    """Genera dati casuali ma realistici per la demo (2020-2026)."""
-    # Impostiamo date fisse dal 2020 al 2026
-    start_date = datetime(2020, 1, 1)
-    end_date = datetime(2026, 5, 31)
-    dates = pd.date_range(start=start_date, end=end_date, freq='W-MON')
-    
-    data = []
-    
-    # 1. Stagionalità Settimanale (Week 1-53) - Clonato dal CSV reale
-    # Notiamo: Q1 basso, Picco estivo (Week 26-28), Picco enorme Q4 (Black Friday Week 47-48)
-    seasonal_profile = {
-        1: 0.8, 2: 0.7, 3: 0.6, 4: 0.6, 5: 0.5, 6: 0.5, 7: 0.5, 8: 0.55, 9: 0.6, 10: 0.6,
-        11: 0.65, 12: 0.7, 13: 0.75, 14: 0.8, 15: 0.8, 16: 0.8, 17: 0.85, 18: 0.9, 19: 0.9, 20: 0.95,
-        21: 1.0, 22: 1.05, 23: 1.1, 24: 1.15, 25: 1.2, 26: 1.3, 27: 1.4, 28: 1.3, 29: 1.1, 30: 1.0,
-        31: 0.9, 32: 0.8, 33: 0.7, 34: 0.7, 35: 0.8, 36: 0.9, 37: 0.95, 38: 1.0, 39: 1.0, 40: 1.05,
-        41: 1.1, 42: 1.15, 43: 1.2, 44: 1.4, 45: 1.8, 46: 2.5, 47: 4.5, 48: 3.8, 49: 3.2, 50: 2.5,
-        51: 1.5, 52: 1.0, 53: 0.9
+# --- GENERATORE DATI SINTETICI (DEMO & LOAD TEST) ---
+
+# 1. Stagionalità Settimanale (Week 1-53) - Clonato dal CSV reale
+# Notiamo: Q1 basso, Picco estivo (Week 26-28), Picco enorme Q4 (Black Friday Week 47-48)
+DEMO_SEASONAL_PROFILE = {
+    1: 0.8, 2: 0.7, 3: 0.6, 4: 0.6, 5: 0.5, 6: 0.5, 7: 0.5, 8: 0.55, 9: 0.6, 10: 0.6,
+    11: 0.65, 12: 0.7, 13: 0.75, 14: 0.8, 15: 0.8, 16: 0.8, 17: 0.85, 18: 0.9, 19: 0.9, 20: 0.95,
+    21: 1.0, 22: 1.05, 23: 1.1, 24: 1.15, 25: 1.2, 26: 1.3, 27: 1.4, 28: 1.3, 29: 1.1, 30: 1.0,
+    31: 0.9, 32: 0.8, 33: 0.7, 34: 0.7, 35: 0.8, 36: 0.9, 37: 0.95, 38: 1.0, 39: 1.0, 40: 1.05,
+    41: 1.1, 42: 1.15, 43: 1.2, 44: 1.4, 45: 1.8, 46: 2.5, 47: 4.5, 48: 3.8, 49: 3.2, 50: 2.5,
+    51: 1.5, 52: 1.0, 53: 0.9
+}
+
+# 2. Trend Annuale Non-Lineare (Fattore moltiplicativo base)
+DEMO_YEARLY_TREND = {
+    2020: 1.0,
+    2021: 1.4,  # Boom post-2020
+    2022: 1.3,  # Assestamento/Calo
+    2023: 1.5,  # Ripresa
+    2024: 1.7,  # Crescita solida
+    2025: 1.9,  # Crescita continua
+    2026: 2.1   # Proiezione
+}
+
+def generate_synthetic_data(seed=42, start="2020-01-01", end="2026-05-31", years=None, stores=1, freq="W", noise=0.10):
+    """Generatore sintetico vettoriale e riproducibile (stesso seed = stessi dati).
+    years: se indicato sostituisce `end` (anni a partire da `start`); stores: numero di negozi
+    (colonna 'Store'); freq: 'W' settimanale (lunedì) o 'D' giornaliero; noise: rumore ± sulle vendite.
+    Con più negozi o dati giornalieri produce milioni di righe in pochi secondi (load test)."""
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(start)
+    end = start + pd.DateOffset(years=years) - pd.Timedelta(days=1) if years else pd.Timestamp(end)
+    dates = pd.date_range(start=start, end=end, freq='W-MON' if freq == "W" else 'D')
+
+    iso = dates.isocalendar()
+    week = iso['week'].to_numpy(dtype=np.int64)
+    year = iso['year'].to_numpy(dtype=np.int64)
+
+    # Fattori per data, poi replicati per negozio (righe = date x negozi)
+    profile = np.ones(54)
+    profile[list(DEMO_SEASONAL_PROFILE)] = list(DEMO_SEASONAL_PROFILE.values())
+    trend_years = np.array(sorted(DEMO_YEARLY_TREND))
+    trend_vals = np.array([DEMO_YEARLY_TREND[y] for y in trend_years])
+    # Prima del 2020 base 1.0, dopo il 2026 la crescita prosegue di +0.2 l'anno
+    y_fact = np.where(year > trend_years[-1], trend_vals[-1] + 0.2 * (year - trend_years[-1]),
+                      np.interp(year, trend_years, trend_vals))
+    s_fact = profile[week]
+
+    n_dates = len(dates)
+    n = n_dates * stores
+    s_fact, y_fact, week, year = (np.tile(a, stores) for a in (s_fact, y_fact, week, year))
+    store_scale = np.repeat(rng.lognormal(0.0, 0.3, stores) if stores > 1 else np.ones(1), n_dates)
+
+    base_sales = 5000.0 if freq == "W" else 5000.0 / 7  # Valore base settimanale (o giornaliero)
+
+    # Calcolo Vendite Totali con randomicità controllata
+    total_sales = base_sales * s_fact * y_fact * store_scale * rng.uniform(1 - noise, 1 + noise, n)
+
+    # Spesa Ads: 20% del fatturato di media, 15% nei picchi (efficienza sale, CPM più caro)
+    marketing_pressure = np.where(s_fact > 2.0, 0.15, 0.20)
+    total_spend = total_sales * marketing_pressure * rng.uniform(0.95, 1.05, n)
+
+    # Split Google/Meta (Google prende più brand search nei picchi)
+    google_share = np.where(s_fact > 1.5, 0.50, 0.40)
+    g_cost = total_spend * google_share
+    m_cost = total_spend * (1 - google_share)
+
+    # KPI Derivati
+    aov = 120.0 + rng.uniform(-10, 10, n)
+    orders = (total_sales / aov).astype(np.int64)
+
+    # Resi (più alti a gennaio, dopo i picchi) e sconti (più alti nei picchi)
+    return_rate = np.where(week <= 5, 0.25, 0.12)
+    returns = -(total_sales * return_rate * rng.uniform(0.8, 1.2, n))
+    discounts = -(total_sales * np.where(s_fact < 2, 0.05, 0.15))
+
+    # Returning customer rate come stringa "NN%" (formato export Shopify) via lookup
+    ret_labels = np.array([f"{i}%" for i in range(12, 28)])
+
+    data = {
+        'Year Week': pd.Series(year * 100 + week).astype(str).to_numpy(),
+        'Cost': g_cost,
+        'Amount Spent': m_cost,
+        'Total sales': total_sales,
+        'Returns': returns,
+        'Discounts': discounts,
+        'Average order value': aov,
+        'Orders': orders,
+        'Returning customer rate': ret_labels[rng.integers(0, len(ret_labels), n)],
+        # ROAS Simulato: Google 0.6x e Meta 0.5x del fatturato
+        'Conversions Value': np.where(g_cost > 0, total_sales * 0.6, 0.0),
+        'Website Purchases Conversion Value': np.where(m_cost > 0, total_sales * 0.5, 0.0),
+        'Avg. CPC': 0.85,
+        'CPC (All)': 0.65,
+        'CPM (Cost per 1,000 Impressions)': 12.50,
+        'Impressions': (m_cost / 12.50 * 1000).astype(np.int64),
+        'Frequency': 1.2,
+        'Items': (orders * 1.5).astype(np.int64),
+        'Gross sales': total_sales - discounts
     }
+    df = pd.DataFrame(data)
+    if freq != "W":
+        df.insert(0, 'Date', np.tile(dates.to_numpy(), stores))
+    if stores > 1:
+        df.insert(0, 'Store', np.repeat([f"Store {i + 1}" for i in range(stores)], n_dates))
+    return df
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def generate_demo_data(seed=42):
+    """Genera dati casuali ma realistici per la demo (2020-2026), riproducibili e in cache per seed."""
+    return generate_synthetic_data(seed=seed)
+
+# --- COLONNE & INGESTIONE ---
+
+# Colonne a nome fisso (export standard Google Ads / Meta / Shopify)
+col_g_val = 'Conversions Value'
+col_m_val = 'Website Purchases Conversion Value'
+col_g_cpc = 'Avg. CPC'
+col_m_cpc = 'CPC (All)'
+col_m_cpm = 'CPM (Cost per 1,000 Impressions)'
+col_g_imps = 'Impressions'
+col_m_freq = 'Frequency'
+
+col_items = 'Items'
+col_ret_rate = 'Returning customer rate'
+col_discounts = 'Discounts'
+
+def detect_key_columns(columns):
+    """Individua le colonne chiave del CSV per sottostringa (data, spese, vendite, resi, ordini, AOV)."""
+    col_date = next((c for c in columns if 'Year Week' in c or 'Settimana' in c), None)
+    col_google = next((c for c in columns if 'Cost' in c), 'Cost')
+    col_meta = next((c for c in columns if 'Amount Spent' in c), 'Amount Spent')
+    col_sales = next((c for c in columns if 'Total sales' in c), 'Total sales')
+    col_returns = next((c for c in columns if 'Returns' in c), 'Returns')
+    col_orders = next((c for c in columns if 'Orders' in c), 'Orders')
+    col_aov = next((c for c in columns if 'Average order value' in c), 'Average order value')
+    return col_date, col_google, col_meta, col_sales, col_returns, col_orders, col_aov
+
+def prepare_dataset(df, be_aov, profit_order):
+    """Pulizia, tipizzazione e colonne derivate (MER, CoS, Profitto, ROAS) del DataFrame grezzo."""
+    df.columns = df.columns.str.strip()
+    col_date, col_google, col_meta, col_sales, col_returns, col_orders, col_aov = detect_key_columns(df.columns)
+
+    if not col_date:
+        raise ValueError("Manca colonna data.")
+
+    df['Data_Interna'] = parse_iso_week(df[col_date])
+    df = df.dropna(subset=['Data_Interna']).sort_values('Data_Interna')
+    df['Periodo'] = week_range_labels(df['Data_Interna'])
+
+    # === CREAZIONE COLONNE GLOBALI PER TAB 4 ===
+    df['Year'] = df['Data_Interna'].dt.isocalendar().year
+    df['Week'] = df['Data_Interna'].dt.isocalendar().week
+    # ==========================================================
+
+    money_cols = [col_google, col_meta, col_sales, col_returns, col_aov, 'Gross sales', col_discounts,
+                  col_g_val, col_m_val, col_g_cpc, col_m_cpc, col_m_cpm]
+    for c in money_cols:
+        if c in df.columns: df[c] = clean_currency_us(df[c])
+
+    if col_g_imps in df.columns: df[col_g_imps] = pd.to_numeric(df[col_g_imps], errors='coerce').fillna(0)
+    if col_m_freq in df.columns: df[col_m_freq] = pd.to_numeric(df[col_m_freq], errors='coerce').fillna(0)
+
+    # Pulizia specifica per l'AI
+    if col_ret_rate in df.columns: df[col_ret_rate] = df[col_ret_rate].apply(clean_percentage)
+    # Conteggi (interi nello schema): stessa pulizia degli importi, così "1,234" non diventa NaN
+    for c in (col_orders, col_items):
+        if c in df.columns: df[c] = clean_currency_us(df[c])
+
+    df = df.fillna(0)
+
+    df['Fatturato_Netto'] = df[col_sales].clip(lower=0)
+    df['Spesa_Ads_Totale'] = df[col_google] + df[col_meta]
+    df['Spesa_Ads_Totale'] = df['Spesa_Ads_Totale'].replace(0, np.nan)
+    df['MER'] = (df[col_sales] / df['Spesa_Ads_Totale']).fillna(0)
+    df['Tasso_Resi'] = (df[col_returns].abs() / df[col_sales].replace(0, np.nan)) * 100
+    df['Tasso_Resi'] = df['Tasso_Resi'].fillna(0)
+
+    # Calcolo CoS Storico
+    df['CoS'] = (df['Spesa_Ads_Totale'] / df['Fatturato_Netto'].replace(0, np.nan)) * 100
+    df['CoS'] = df['CoS'].fillna(0)
+
+    # --- CALCOLO PROFITTO NETTO STIMATO NEL DF ---
+    df = apply_economics(df, be_aov, profit_order)
+
+    # Inizializzazione sicura ROAS
+    df['ROAS_Google'] = 0.0
+    df['ROAS_Meta'] = 0.0
+    if col_g_val in df.columns: df['ROAS_Google'] = df[col_g_val] / df[col_google].replace(0, np.nan).fillna(0)
+    if col_m_val in df.columns: df['ROAS_Meta'] = df[col_m_val] / df[col_meta].replace(0, np.nan).fillna(0)
+    return apply_schema(df)
+
+def apply_economics(df, be_aov, profit_order):
+    """Profitto Operativo stimato: l'unica colonna derivata che dipende dagli input economici."""
+    col_orders = detect_key_columns(df.columns)[5]
+    num_orders = df[col_orders] if col_orders in df.columns else (df['Fatturato_Netto'] / be_aov)
+
+    # Profitto Operativo = (Numero Ordini * Profitto per Ordine) - Spesa Ads
+    # FIX: Uso la variabile corretta profit_order definita nella sidebar
+    df['Profitto_Operativo'] = (num_orders * profit_order) - df['Spesa_Ads_Totale']
+    return df
+
+# --- SCHEMA COMPATTO DEL DATAFRAME DI LAVORO ---
+# Ogni sessione Streamlit tiene la propria copia di df: float32 per importi/rapporti,
+# interi piccoli per calendario e conteggi, category per le etichette ripetute.
+DF_SCHEMA = {
+    'Year': 'int16', 'Week': 'int8', 'Orders': 'int32', col_items: 'int32', col_g_imps: 'int32',
+    'Periodo': 'category',
+    'Gross sales': 'float32', col_discounts: 'float32', col_g_val: 'float32', col_m_val: 'float32',
+    col_g_cpc: 'float32', col_m_cpc: 'float32', col_m_cpm: 'float32', col_m_freq: 'float32', col_ret_rate: 'float32',
+    'Fatturato_Netto': 'float32', 'Spesa_Ads_Totale': 'float32', 'MER': 'float32', 'Tasso_Resi': 'float32',
+    'CoS': 'float32', 'Profitto_Operativo': 'float32', 'ROAS_Google': 'float32', 'ROAS_Meta': 'float32',
+}
+
+def apply_schema(df):
+    """Applica DF_SCHEMA (più le colonne chiave rilevate) alle colonne presenti. Gli interi
+    con decimali o fuori range ricadono su float32 invece di essere troncati."""
+    col_date, col_google, col_meta, col_sales, col_returns, col_orders, col_aov = detect_key_columns(df.columns)
+    schema = dict(DF_SCHEMA)
+    schema.update({c: 'float32' for c in (col_google, col_meta, col_sales, col_returns, col_aov)})
+    schema.update({col_orders: 'int32', col_date: 'category'})
+    for c, dtype in schema.items():
+        if c not in df.columns or df[c].dtype == dtype: continue
+        if dtype.startswith('int'):
+            vals = pd.to_numeric(df[c], errors='coerce')
+            limits = np.iinfo(dtype)
+            if vals.isna().any() or (vals % 1 != 0).any() or vals.min() < limits.min or vals.max() > limits.max:
+                dtype = 'float32'
+            df[c] = vals.astype(dtype)
+        else:
+            df[c] = df[c].astype(dtype)
+    return df
+
+def add_model_features(df):
+    """Feature dei modelli (stagionalità sin/cos, lag del fatturato) su una copia locale:
+    non restano memorizzate nel DataFrame di sessione."""
+    week = df['Week'].astype(float)
+    return df.assign(
+        Week_Sin=np.sin(2 * np.pi * week / 53), Week_Cos=np.cos(2 * np.pi * week / 53),
+        Lag_Sales_1=df['Fatturato_Netto'].shift(1), Lag_Sales_4=df['Fatturato_Netto'].shift(4)
+    )
 
-    # 2. Trend Annuale Non-Lineare (Fattore moltiplicativo base)
-    yearly_trend = {
-        2020: 1.0,
-        2021: 1.4,  # Boom post-2020
-        2022: 1.3,  # Assestamento/Calo
-        2023: 1.5,  # Ripresa
-        2024: 1.7,  # Crescita solida
-        2025: 1.9,  # Crescita continua
-        2026: 2.1   # Proiezione
+# Colonne numeriche attese negli export: se il campione le legge come numeri, il dtype viene fissato
+KNOWN_NUMERIC_COLS = ['Cost', 'Amount Spent', 'Total sales', 'Returns', 'Discounts', 'Orders', 'Items',
+                      'Gross sales', 'Average order value', col_g_val, col_m_val, col_g_cpc, col_m_cpc,
+                      col_m_cpm, col_g_imps, col_m_freq]
+
+def sniff_csv_format(sample):
+    """Rileva separatore e convenzione numerica (decimale/migliaia) da un campione di testa del file."""
+    try:
+        sep = csv.Sniffer().sniff(sample, delimiters=',;\t|').delimiter
+    except csv.Error:
+        sep = ','
+    # Formato europeo ("1.234,56" / "12,50") possibile solo se la virgola non è il separatore
+    eu_hits = len(re.findall(r'\d,\d{1,2}(?!\d)', sample)) if sep != ',' else 0
+    us_hits = len(re.findall(r'\d\.\d+(?![\d,])', sample))
+    if eu_hits > us_hits:
+        decimal = ','
+        thousands = '.' if re.search(r'\d\.\d{3}(?!\d)', sample) else None
+    else:
+        decimal = '.'
+        # Con separatore virgola le migliaia US possono stare solo dentro campi quotati ("1,234.56")
+        us_thousands = r'"[€$£\s\-]*\d{1,3}(?:,\d{3})+(?:\.\d+)?"' if sep == ',' else r'\d,\d{3}(?!\d)'
+        thousands = ',' if re.search(us_thousands, sample) else None
+    return sep, decimal, thousands
+
+def read_csv_fast(file_bytes, sample_size=64 * 1024):
+    """Legge il CSV con engine C/pyarrow dopo lo sniffing su un campione di testa.
+    In caso di errore ricade sul percorso originale (sep=None, engine='python')."""
+    sample = file_bytes[:sample_size].decode('utf-8', errors='ignore')
+    if len(file_bytes) > sample_size and '\n' in sample:
+        sample = sample[:sample.rfind('\n')]  # niente righe troncate nel campione
+    try:
+        sep, decimal, thousands = sniff_csv_format(sample)
+        opts = {'sep': sep, 'decimal': decimal, 'thousands': thousands}
+
+        # dtype espliciti: data come stringa, metriche note come float se il campione è già numerico
+        head = pd.read_csv(io.StringIO(sample), engine='c', **opts)
+        dtypes = {c: 'float64' for c in head.columns
+                  if c.strip() in KNOWN_NUMERIC_COLS and pd.api.types.is_numeric_dtype(head[c])}
+        dtypes.update({c: str for c in head.columns if 'Year Week' in c or 'Settimana' in c})
+
+        # pyarrow non supporta il separatore delle migliaia: in quel caso resta l'engine C
+        engines = ['c'] if thousands else ['pyarrow', 'c']
+        for engine in engines:
+            try:
+                if engine == 'pyarrow':
+                    return pd.read_csv(io.BytesIO(file_bytes), engine='pyarrow', sep=sep, decimal=decimal, dtype=dtypes)
+                return pd.read_csv(io.BytesIO(file_bytes), engine='c', dtype=dtypes, **opts)
+            except (ImportError, ValueError):
+                continue
+    except Exception:
+        pass
+    return pd.read_csv(io.BytesIO(file_bytes), sep=None, engine='python')
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def load_uploaded_dataset(file_hash, _file_bytes, be_aov, profit_order):
+    """Lettura e pulizia completa dell'upload. In cache per hash del file + input economici:
+    i rerun (slider, bottoni) riusano il DataFrame già tipizzato senza riparsare il CSV."""
+    df = read_csv_fast(_file_bytes)
+    df = df.dropna(how='all')
+    return prepare_dataset(df, be_aov, profit_order)
+
+# --- CACHE MODELLI ---
+
+# Iperparametri del Random Forest di forecast (fanno parte della chiave di cache)
+RF_FORECAST_PARAMS = {'n_estimators': 300, 'max_depth': 6, 'min_samples_leaf': 3, 'random_state': 42}
+
+def frame_fingerprint(df, columns=None):
+    """Impronta del contenuto di un DataFrame (valori + nomi colonne), indipendente dall'indice."""
+    d = df if columns is None else df[columns]
+    h = hashlib.sha1(pd.util.hash_pandas_object(d, index=False).to_numpy().tobytes())
+    h.update('|'.join(map(str, d.columns)).encode())
+    return h.hexdigest()
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def fit_random_forest(fingerprint, _X, _y, **params):
+    """Random Forest allenato una volta per (dati di training + feature, iperparametri).
+    Gli slider di scenario cambiano solo gli input di previsione: il modello fittato resta in
+    cache (eviction LRU oltre max_entries) ed è condiviso tra le sessioni."""
+    model = RandomForestRegressor(n_jobs=-1, **params)
+    model.fit(_X, _y)
+    return model
+
+def forest_predict(model, X):
+    """Stesso risultato di model.predict (media degli alberi) chiamando direttamente tree_.predict:
+    evita il costo fisso di validazione e dispatch per chiamata, che domina sui batch piccoli."""
+    X32 = np.ascontiguousarray(X, dtype=np.float32)
+    out = np.zeros(len(X32))
+    for est in model.estimators_:
+        out += est.tree_.predict(X32).reshape(len(X32), -1)[:, 0]
+    return out / len(model.estimators_)
+
+def recursive_rf_forecast(model, exog, lag_idx, lag1, lag4, stress_mult=1.0):
+    """Forecast ricorsivo su matrice preallocata exog (n_scenari, orizzonte, n_feature) con le feature
+    esogene già compilate: a ogni step si aggiornano in place solo le colonne lag (lag_idx = posizioni di
+    Lag_Sales_1 e Lag_Sales_4) e si fa un solo predict batch su tutti gli scenari.
+    lag1/lag4/stress_mult: scalari o array (n_scenari,). Ritorna le previsioni (n_scenari, orizzonte)."""
+    exog = np.asarray(exog, dtype=np.float64)
+    n_scen, horizon, _ = exog.shape
+    i_lag1, i_lag4 = lag_idx
+    lag1 = np.broadcast_to(np.asarray(lag1, dtype=np.float64), (n_scen,))
+    lag4 = np.broadcast_to(np.asarray(lag4, dtype=np.float64), (n_scen,))
+    preds = np.empty((n_scen, horizon))
+    for t in range(horizon):
+        X_t = exog[:, t, :]
+        X_t[:, i_lag1] = lag1
+        X_t[:, i_lag4] = lag4
+        # Applichiamo lo STRESS MULTIPLIER al risultato della previsione
+        preds[:, t] = forest_predict(model, X_t) * stress_mult
+        lag4, lag1 = lag1, preds[:, t]
+    return preds
+
+# --- BACKTEST WALK-FORWARD ---
+# Iperparametri del RF di backtest e numero di processi per i fold (-1 = tutti i core; configurabile da ambiente)
+RF_BACKTEST_PARAMS = {'n_estimators': 200, 'max_depth': 6, 'min_samples_leaf': 3, 'random_state': 42}
+BACKTEST_WORKERS = int(os.environ.get('FORECAST_BACKTEST_WORKERS', '-1'))
+BACKTEST_MIN_TRAIN = 20 # Settimane minime di storico prima di una origine
+
+# Cadenze di refit: refit completo a ogni origine, ogni k settimane (il modello di inizio blocco prevede le
+# settimane successive del blocco) oppure foresta incrementale con warm_start (nuovi alberi sul prefisso corrente)
+BACKTEST_CADENCES = {
+    "Refit ogni settimana (completo)": {'refit_every': 1},
+    "Refit ogni 2 settimane": {'refit_every': 2},
+    "Refit ogni 4 settimane": {'refit_every': 4},
+    "Refit ogni 8 settimane": {'refit_every': 8},
+    "Warm-start (foresta incrementale)": {'warm_start': True},
+}
+# Prophet costa secondi per fit: nel backtest si rifitta al più ogni N settimane qualunque sia la cadenza del RF
+PROPHET_BACKTEST_REFIT_EVERY = 4
+
+def forecast_accuracy(pred, actual):
+    """Accuratezza per riga: 1 - errore relativo, limitata a 0 (0 se il fatturato reale è nullo)."""
+    actual = np.asarray(actual, dtype=np.float64)
+    safe = np.where(actual > 0, actual, 1.0)
+    return np.where(actual > 0, np.maximum(0, 1 - np.abs(np.asarray(pred) - actual) / safe), 0.0)
+
+def fill_prefix_median(X_train):
+    return np.where(np.isnan(X_train), np.nanmedian(X_train, axis=0), X_train)
+
+def rf_backtest_block(X, y, n_train, X_block, params):
+    """Un fit walk-forward sulle prime n_train righe (NaN -> mediana del train) e previsione delle righe di test
+    del blocco. Eseguito in un processo separato: un solo core per fit, la parallelizzazione è tra i blocchi."""
+    model = RandomForestRegressor(n_jobs=1, **params)
+    model.fit(fill_prefix_median(X[:n_train]), y[:n_train])
+    return model.predict(X_block)
+
+def run_backtest_warm_start(X, y, n_trains, X_test, params, trees_per_step=10):
+    """Foresta incrementale: fit completo alla prima origine, poi a ogni origine si aggiungono trees_per_step
+    alberi allenati sul prefisso corrente. Sequenziale per costruzione, parallelo sugli alberi."""
+    model = RandomForestRegressor(n_jobs=-1, warm_start=True, **params)
+    preds = np.empty(len(n_trains))
+    for i, n in enumerate(n_trains):
+        if i > 0: model.n_estimators += trees_per_step
+        model.fit(fill_prefix_median(X[:n]), y[:n])
+        preds[i] = model.predict(X_test[i:i + 1])[0]
+    return preds
+
+def refit_prefixes(dates, test_pos, refit_every=1, warm_start=False):
+    """Righe di train del fit usato da ogni origine (dates = date dello storico ordinato). Con refit ogni k
+    settimane i blocchi sono ancorati al calendario (settimane dal lunedì 1970-01-05, divise per k) e non alla
+    prima origine: restano gli stessi quando lo storico si allunga e la finestra scorre."""
+    n_trains = np.searchsorted(dates, dates[test_pos], side='left')
+    k = max(1, int(refit_every))
+    if warm_start or k == 1: return n_trains
+    block = ((dates - np.datetime64('1970-01-05')) // np.timedelta64(7, 'D')) // k
+    n_fits = np.searchsorted(block, block[test_pos], side='left')
+    return np.clip(n_fits, BACKTEST_MIN_TRAIN, n_trains)
+
+def run_backtest_folds(X, y, n_fits, X_test, params=None, n_jobs=None, warm_start=False):
+    """Previsioni RF per le origini date: un fit per prefisso distinto (n_fits), fit in parallelo su un pool di
+    processi joblib/loky, X e y condivisi in sola lettura (memmap automatico oltre max_nbytes).
+    Le righe di test restano quelle di ogni settimana; i risultati tornano nell'ordine delle origini."""
+    params = RF_BACKTEST_PARAMS if params is None else params
+    if warm_start:
+        return run_backtest_warm_start(X, y, n_fits, X_test, params)
+    n_jobs = BACKTEST_WORKERS if n_jobs is None else n_jobs
+    uniq, inv = np.unique(n_fits, return_inverse=True)
+    blocks = Parallel(n_jobs=n_jobs)(
+        delayed(rf_backtest_block)(X, y, n, X_test[inv == j], params) for j, n in enumerate(uniq)
+    )
+    preds = np.empty(len(n_fits))
+    for j, block in enumerate(blocks):
+        preds[inv == j] = block
+    return preds
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def compare_backtest_cadences(design_key, _X, _y, _dates, _test_pos, _X_test, _actual):
+    """Accuratezza e costo di ogni cadenza di refit rispetto al refit completo, sulle stesse origini."""
+    rows = []
+    for label, cadence in BACKTEST_CADENCES.items():
+        t0 = datetime.now()
+        n_fits = refit_prefixes(_dates, _test_pos, **cadence)
+        pred = run_backtest_folds(_X, _y, n_fits, _X_test, warm_start=cadence.get('warm_start', False))
+        rows.append({
+            'Cadenza': label, 'Fit': len(n_fits) if cadence.get('warm_start') else len(np.unique(n_fits)),
+            'Accuratezza RF': forecast_accuracy(pred, _actual).mean(),
+            'Errore Medio RF (€)': np.abs(pred - _actual).mean(),
+            'Tempo (s)': (datetime.now() - t0).total_seconds()
+        })
+    df_cmp = pd.DataFrame(rows)
+    df_cmp['Δ Accuratezza vs Completo'] = df_cmp['Accuratezza RF'] - df_cmp['Accuratezza RF'].iloc[0]
+    return df_cmp
+
+# --- ARCHIVIO STORICO (PARQUET) ---
+# Un dataset = una cartella con un file Parquet per anno ISO. Ogni riga è già pulita e porta con sé
+# le colonne derivate, più la chiave settimana (_week_key) e l'hash del grezzo (_week_hash) per l'append.
+STORE_DIR = os.environ.get('FORECAST_STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.forecast_store'))
+
+def store_safe_name(dataset, default='storico'):
+    return re.sub(r'[^\w\-]+', '_', dataset.strip()).strip('_') or default
+
+def history_path(dataset):
+    return os.path.join(STORE_DIR, 'history', store_safe_name(dataset))
+
+def list_history_datasets():
+    root = os.path.join(STORE_DIR, 'history')
+    if not os.path.isdir(root): return []
+    return sorted(d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)))
+
+def history_files(dataset):
+    return sorted(glob.glob(os.path.join(history_path(dataset), 'year=*.parquet')))
+
+def history_version(dataset):
+    """Firma dell'archivio (file + mtime): cambia a ogni append e invalida la cache di lettura."""
+    return tuple((os.path.basename(f), os.stat(f).st_mtime_ns) for f in history_files(dataset))
+
+def merge_into_history(dataset, raw_df, be_aov, profit_order):
+    """Append incrementale per settimana ISO (dedup su 'Year Week'): pulisce solo le settimane
+    nuove o modificate e riscrive solo gli anni toccati. Ritorna il numero di settimane salvate."""
+    raw_df.columns = raw_df.columns.str.strip()
+    col_date = detect_key_columns(raw_df.columns)[0]
+    if not col_date:
+        raise ValueError("Manca colonna data.")
+
+    week_key = raw_df[col_date].astype(str).str.strip()
+    week_hash = pd.util.hash_pandas_object(raw_df, index=False).groupby(week_key).sum()
+
+    # Confronto con l'archivio leggendo solo le due colonne chiave
+    files = history_files(dataset)
+    changed = week_hash.index
+    if files:
+        stored = pd.concat([pd.read_parquet(f, columns=['_week_key', '_week_hash']) for f in files])
+        stored = stored.drop_duplicates('_week_key').set_index('_week_key')['_week_hash']
+        common = week_hash.index.intersection(stored.index)
+        unchanged = common[week_hash[common].to_numpy() == stored[common].to_numpy()]
+        changed = week_hash.index.difference(unchanged)
+
+    new_rows = raw_df[week_key.isin(changed)]
+    if new_rows.empty: return 0
+
+    cleaned = prepare_dataset(new_rows.copy(), be_aov, profit_order)
+    cleaned['_week_key'] = cleaned[col_date].astype(str).str.strip()
+    cleaned['_week_hash'] = cleaned['_week_key'].map(week_hash).astype('uint64')
+
+    os.makedirs(history_path(dataset), exist_ok=True)
+    for year, part in cleaned.groupby('Year'):
+        path = os.path.join(history_path(dataset), f'year={int(year)}.parquet')
+        if os.path.exists(path):
+            old = pd.read_parquet(path)
+            part = pd.concat([old[~old['_week_key'].isin(changed)], part])
+        part = part.sort_values('Data_Interna')
+        part = part.fillna({c: 0 for c in part.columns if pd.api.types.is_numeric_dtype(part[c])})
+        tmp_path = path + '.tmp'
+        part.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+    return cleaned['_week_key'].nunique()
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def load_history_dataset(dataset, version, be_aov, profit_order):
+    """Storico completo dall'archivio, con il profitto ricalcolato sugli input economici correnti."""
+    if not version: return None
+    df = pd.concat([pd.read_parquet(f) for f in history_files(dataset)], ignore_index=True)
+    df = df.drop(columns=['_week_key', '_week_hash']).sort_values('Data_Interna').reset_index(drop=True)
+    return apply_schema(apply_economics(df, be_aov, profit_order))
+
+# --- ARCHIVIO MODELLI PROPHET ---
+# I fit di Prophet (Stan) costano secondi: vengono serializzati in JSON su disco, con chiave
+# impronta dati + regressori + configurazione, e riletti ai rerun, ai riavvii e tra sessioni.
+PROPHET_PARAMS = {
+    'yearly_seasonality': True,
+    'weekly_seasonality': True,
+    'daily_seasonality': False,
+    'changepoint_prior_scale': 0.08, # Leggermente più flessibile per catturare trend pluriennali
+    'seasonality_prior_scale': 10.0
+}
+PROPHET_HOLIDAYS = 'IT'
+# Capienza dell'archivio JSON (LRU sull'mtime, aggiornato a ogni lettura): i fit delle origini uscite
+# dalla finestra del backtest e delle versioni dati superate vengono eliminati
+PROPHET_STORE_MAX_MODELS = int(os.environ.get('FORECAST_PROPHET_STORE_MAX', '64'))
+
+def prophet_model_key(fingerprint, regressors):
+    cfg = repr((fingerprint, tuple(regressors), sorted(PROPHET_PARAMS.items()), PROPHET_HOLIDAYS, prophet_version))
+    return hashlib.sha1(cfg.encode()).hexdigest()
+
+def build_prophet(regressors):
+    m = Prophet(**PROPHET_PARAMS)
+    for reg in regressors:
+        m.add_regressor(reg)
+    m.add_country_holidays(country_name=PROPHET_HOLIDAYS)
+    return m
+
+def load_or_fit_prophet(fingerprint, df_p, regressors):
+    """Prophet dal JSON su disco se già fittato su questi dati, altrimenti fit e salvataggio atomico.
+    Senza dipendenze da Streamlit: usabile anche nei processi del backtest."""
+    path = os.path.join(STORE_DIR, 'prophet', prophet_model_key(fingerprint, regressors) + '.json')
+    if os.path.exists(path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                m = model_from_json(f.read())
+            os.utime(path) # Usato di recente: resta fuori dalla potatura LRU
+            return m
+        except Exception:
+            pass # File corrotto o di una versione incompatibile: si rifà il fit
+
+    m = build_prophet(regressors)
+    m.fit(df_p)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(model_to_json(m))
+        os.replace(tmp_path, path)
+    except OSError:
+        pass # Archivio non scrivibile: il modello resta comunque nella cache di processo
+    return m
+
+def prune_prophet_store(max_models=None):
+    """Tiene nell'archivio Prophet solo i max_models JSON usati più di recente. Ritorna quanti ne ha rimossi."""
+    max_models = PROPHET_STORE_MAX_MODELS if max_models is None else max_models
+    try:
+        entries = [e for e in os.scandir(os.path.join(STORE_DIR, 'prophet')) if e.name.endswith('.json')]
+    except OSError:
+        return 0
+    stale = sorted(entries, key=lambda e: e.stat().st_mtime, reverse=True)[max_models:]
+    for e in stale:
+        try:
+            os.remove(e.path)
+        except OSError:
+            pass # Già rimosso da un'altra sessione
+    return len(stale)
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def fit_prophet(fingerprint, _df_p, regressors):
+    """Prophet fittato una volta per versione dei dati: prima la cache di processo, poi il JSON su disco,
+    solo in ultima istanza il fit. regressors è una tupla (ordine = ordine di add_regressor)."""
+    return load_or_fit_prophet(fingerprint, _df_p, regressors)
+
+def prophet_backtest_block(df_p, n_train, regressors, test_rows):
+    """Un'origine del backtest Prophet: fit (o JSON in cache) sulle prime n_train righe, previsione delle
+    righe di test con i regressori reali. Solo yhat: niente campionamento dell'incertezza."""
+    for name in ('prophet', 'cmdstanpy'):
+        logging.getLogger(name).setLevel(logging.ERROR)
+    train = df_p.iloc[:n_train]
+    m = load_or_fit_prophet(frame_fingerprint(train), train, regressors)
+    m.uncertainty_samples = 0
+    return m.predict(test_rows)['yhat'].to_numpy(dtype=np.float64)
+
+def run_prophet_backtest(df_p, regressors, n_fits, test_pos, n_jobs=None):
+    """Backtest Prophet fuori campione: un fit per prefisso distinto, fit in parallelo su processi e ognuno
+    salvato su disco (archivio potato in LRU a fine giro). Ritorna yhat per ogni origine, nell'ordine dato."""
+    n_jobs = BACKTEST_WORKERS if n_jobs is None else n_jobs
+    uniq, inv = np.unique(n_fits, return_inverse=True)
+    blocks = Parallel(n_jobs=n_jobs)(
+        delayed(prophet_backtest_block)(df_p, n, regressors, df_p.iloc[test_pos[inv == j]].drop(columns='y'))
+        for j, n in enumerate(uniq)
+    )
+    preds = np.empty(len(n_fits))
+    for j, block in enumerate(blocks):
+        preds[inv == j] = block
+    prune_prophet_store()
+    return preds
+
+# --- ARCHIVIO RISULTATI BACKTEST ---
+# Un file Parquet per dataset con le previsioni RF/Prophet per origine. Il dataset è identificato dall'impronta
+# delle prime BACKTEST_MIN_TRAIN settimane (non dal nome del file caricato: due 'export.csv' diversi non
+# condividono l'archivio, lo stesso storico con settimane nuove in coda sì). Chiave del fold = configurazione +
+# hash cumulativo dello storico fino all'origine (inclusa): le settimane aggiunte in coda non invalidano i
+# fold già calcolati, si valutano solo le origini nuove e quelle uscite dalla finestra di 12 mesi vengono potate.
+BACKTEST_STORE_COLUMNS = ['fold_key', 'config', 'origin', 'pred_ml', 'pred_p']
+
+def backtest_store_path(dataset_key):
+    return os.path.join(STORE_DIR, 'backtest', store_safe_name(dataset_key, 'dataset') + '.parquet')
+
+def prefix_hashes(df):
+    """h[i] = hash del contenuto delle prime i righe (h[0] = storico vuoto)."""
+    h = hashlib.sha1()
+    out = [h.hexdigest()]
+    for row_hash in pd.util.hash_pandas_object(df, index=False).to_numpy():
+        h.update(row_hash.tobytes())
+        out.append(h.hexdigest())
+    return out
+
+def load_backtest_store(dataset_key):
+    path = backtest_store_path(dataset_key)
+    if not os.path.exists(path): return pd.DataFrame(columns=BACKTEST_STORE_COLUMNS)
+    try:
+        return pd.read_parquet(path)
+    except Exception:
+        return pd.DataFrame(columns=BACKTEST_STORE_COLUMNS) # File illeggibile: si ricalcola
+
+def save_backtest_store(dataset_key, df_store):
+    path = backtest_store_path(dataset_key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        df_store[BACKTEST_STORE_COLUMNS].to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass # Archivio non scrivibile: il backtest resta comunque valido per questa esecuzione
+
+# --- MOTORE SCENARI PROPHET ---
+# Budget e stress cambiano solo i regressori google/meta futuri e un moltiplicatore finale: a modello
+# fittato l'effetto è lineare. Si fa un solo predict completo (trend, stagionalità, festività, incertezza)
+# sul piano base e ogni scenario si ricombina in NumPy con i coefficienti dei regressori.
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def prophet_base_forecast(model_key, future_key, _m, _future):
+    """Predict completo sul piano di budget base, una volta per (modello, future base)."""
+    fc = _m.predict(_future)
+    coefs = regressor_coefficients(_m).set_index('regressor')[['regressor_mode', 'coef']]
+    return fc[['ds', 'trend', 'yhat', 'yhat_lower', 'yhat_upper']], coefs
+
+def prophet_scenario_shift(base_fc, coefs, deltas):
+    """Spostamento di yhat per variazioni dei regressori (deltas: regressore -> Δx, anche 2D n_scenari × T):
+    coef·Δx per i regressori additivi, trend·coef·Δx per quelli moltiplicativi."""
+    trend = base_fc['trend'].to_numpy()
+    shift = np.zeros(len(trend))
+    for reg, dx in deltas.items():
+        effect = coefs.at[reg, 'coef'] * np.asarray(dx, dtype=float)
+        shift = shift + (trend * effect if coefs.at[reg, 'regressor_mode'] == 'multiplicative' else effect)
+    return shift
+
+def prophet_plan_sales(p_ctx, g_plan, m_plan, stress_mult=1.0):
+    """Fatturato Prophet per piani di spesa assoluti (anche 2D n_piani × T). p_ctx = (previsione base futura,
+    coefficienti, google base, meta base): il piano base è lo stesso di heuristic e RF (heur_base), quindi
+    forecast, superficie, ottimizzatore e verifica Ensemble partono dalla stessa spesa."""
+    base_fc, coefs, p_g, p_m = p_ctx
+    shift = prophet_scenario_shift(base_fc, coefs, {'google': g_plan - p_g, 'meta': m_plan - p_m})
+    return (base_fc['yhat'].to_numpy() + shift) * stress_mult
+
+def prophet_scenario_forecast(base_fc, coefs, deltas, stress_mult=1.0):
+    """Previsione di scenario (yhat e banda di incertezza) senza rifare m.predict."""
+    shift = prophet_scenario_shift(base_fc, coefs, deltas)
+    out = base_fc[['ds']].copy()
+    for col in ('yhat', 'yhat_lower', 'yhat_upper'):
+        out[col] = (base_fc[col].to_numpy() + shift) * stress_mult
+    return out
+
+# --- VALIDAZIONE STORICA (SIMULATORE DI PRECISIONE) ---
+# Le stesse feature del test sulla singola settimana, costruite per tutto lo storico in blocco:
+# una predict RF e una predict Prophet sui modelli in cache invece di un rerun per settimana.
+def precision_inputs(df_hist, g_col, m_col, drivers):
+    """Righe RF (stagionalità, spesa reale, lag dalle settimane precedenti, driver reali) e frame Prophet per ogni
+    settimana dello storico. Nelle prime settimane i lag mancanti ricadono sul fatturato della settimana stessa."""
+    sales = df_hist['Fatturato_Netto'].to_numpy(dtype=np.float64)
+    lag1, lag4 = sales.copy(), sales.copy()
+    lag1[1:], lag4[4:] = sales[:-1], sales[:-4]
+    w = df_hist['Data_Interna'].dt.isocalendar().week.to_numpy(dtype=np.float64)
+    X = np.column_stack([
+        np.sin(2 * np.pi * w / 53), np.cos(2 * np.pi * w / 53),
+        df_hist[g_col].to_numpy(dtype=np.float64), df_hist[m_col].to_numpy(dtype=np.float64), lag1, lag4
+    ] + [df_hist[b].to_numpy(dtype=np.float64) for b in drivers])
+    p_frame = pd.DataFrame({'ds': df_hist['Data_Interna'].to_numpy(), 'google': X[:, 2], 'meta': X[:, 3]})
+    for j, b in enumerate(drivers):
+        p_frame[b] = X[:, 6 + j]
+    return X, p_frame, sales
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def validate_all_weeks(X, p_frame, actual, _rf_model, _p_model):
+    """Previsione RF, Prophet ed Ensemble per tutte le settimane con errore e accuratezza.
+    I modelli dipendono solo dallo storico, già identificato da X/p_frame (chiave di cache)."""
+    rf_pred = _rf_model.predict(X)
+    p_pred = _p_model.predict(p_frame)['yhat'].to_numpy(dtype=np.float64)
+    ens_pred = (rf_pred + p_pred) / 2
+    return pd.DataFrame({
+        'Data': p_frame['ds'].to_numpy(),
+        'Fatturato Reale': actual,
+        'Previsione RF': rf_pred,
+        'Previsione Prophet': p_pred,
+        'Media Ensemble': ens_pred,
+        'Scostamento (€)': ens_pred - actual,
+        'Errore Assoluto (€)': np.abs(ens_pred - actual),
+        'Accuratezza': forecast_accuracy(ens_pred, actual)
+    })
+
+# --- SUPERFICIE DI RISPOSTA BUDGET ---
+# Griglia di scale Google × Meta valutata in un solo passaggio vettoriale (heuristic, RF in batch, Prophet
+# ricombinato): il fatturato per combinazione sostituisce le ore passate a trascinare gli slider.
+SURFACE_SCALES = np.round(np.arange(0.5, 3.0 + 1e-9, 0.1), 2)
+
+def heuristic_response(base_sales, base_g, base_m, g_plan, m_plan, sat):
+    """Fatturato heuristic per piani di spesa (g_plan/m_plan broadcastabili a (..., T)): modello esponenziale
+    normalizzato sulla baseline, raddoppiare la spesa non raddoppia i risultati."""
+    tot_base = base_g + base_m
+    spend_ratio = np.where(tot_base > 0, (g_plan + m_plan) / np.where(tot_base > 0, tot_base, 1.0), 1.0)
+    if sat <= 0: return base_sales * np.ones_like(spend_ratio)
+    return base_sales * (1 - np.exp(-sat * spend_ratio)) / (1 - np.exp(-sat))
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def response_surface(surface_key, g_scales, m_scales, sat, stress_mult, _heur, _rf=None, _prophet=None):
+    """Fatturato totale sull'orizzonte per ogni coppia (scala Google, scala Meta): matrici (n_g, n_m) per modello.
+    _heur = (fatturato, google, meta) base per settimana; _rf = (modello, riga exog base, lag_idx, (idx google,
+    idx meta), lag1, lag4); _prophet = p_ctx di prophet_plan_sales (stesso piano base di _heur).
+    surface_key identifica dati e piano base (gli argomenti con _ non entrano nella chiave di cache)."""
+    gs, ms = np.meshgrid(g_scales, m_scales, indexing='ij')
+    gs, ms = gs.ravel()[:, None], ms.ravel()[:, None]
+    base_sales, base_g, base_m = _heur
+    g_plan, m_plan = gs * base_g, ms * base_m
+
+    out = {
+        'Spesa': (g_plan + m_plan).sum(axis=1),
+        'Heuristic': heuristic_response(base_sales, base_g, base_m, g_plan, m_plan, sat).sum(axis=1)
+    }
+    if _rf is not None:
+        model, exog_row, lag_idx, (i_g, i_m), lag1, lag4 = _rf
+        exog = np.repeat(exog_row[None], len(gs), axis=0)
+        exog[:, :, i_g], exog[:, :, i_m] = g_plan, m_plan
+        out['Random Forest'] = recursive_rf_forecast(model, exog, lag_idx, lag1, lag4, stress_mult).sum(axis=1)
+    if _prophet is not None:
+        out['Prophet'] = prophet_plan_sales(_prophet, g_plan, m_plan, stress_mult).sum(axis=1)
+    if 'Random Forest' in out and 'Prophet' in out:
+        out['Ensemble'] = (out['Random Forest'] + out['Prophet']) / 2
+    return {k: v.reshape(len(g_scales), len(m_scales)) for k, v in out.items()}
+
+# --- OTTIMIZZATORE BUDGET ---
+# Variabili = scala per canale rispetto al piano base, lineare a tratti tra al massimo OPT_MAX_KNOTS nodi
+# (con orizzonti brevi un nodo per settimana). Obiettivo liscio (con gradiente analitico):
+# media tra heuristic con saturazione e Prophet lineare nei regressori; il Random Forest (a gradini, non
+# derivabile) valuta solo il piano finale. Vincoli lineari: budget totale e variazione massima settimana su settimana.
+OPT_MAX_KNOTS = 26
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def optimize_budget_plan(plan_key, total_budget, max_week_change, be_aov, profit_order, be_roas, sat, stress_mult,
+                         _heur, _prophet, scale_bounds=(0.5, 3.0)):
+    """Piano settimanale Google/Meta che massimizza il Profitto Operativo stimato sull'orizzonte.
+    max_week_change: variazione massima tra settimane consecutive, in quota della spesa media base del canale.
+    be_roas: se valorizzato, vincolo MER complessivo >= Break-Even ROAS. Ritorna un dict con piano e diagnostica."""
+    base_sales, base_g, base_m = _heur
+    p_fc, coefs = _prophet[:2]
+    T = len(base_sales)
+    p_trend = p_fc['trend'].to_numpy()
+    # Effetto marginale Prophet per € speso (additivo: coef; moltiplicativo: trend·coef)
+    k_g = coefs.at['google', 'coef'] * (p_trend if coefs.at['google', 'regressor_mode'] == 'multiplicative' else 1.0)
+    k_m = coefs.at['meta', 'coef'] * (p_trend if coefs.at['meta', 'regressor_mode'] == 'multiplicative' else 1.0)
+    has_base = base_g + base_m > 0
+    tot_base = np.where(has_base, base_g + base_m, 1.0)
+    # Heuristic come heuristic_response: senza saturazione (sat <= 0) o senza spesa base resta il fatturato base
+    reactive = has_base & (sat > 0)
+    sat_norm = (1 - np.exp(-sat)) if sat > 0 else 1.0
+    norm = max(base_sales.sum(), 1.0) # Scala dell'obiettivo per il condizionamento numerico
+
+    # Scala settimanale = B · nodi (interpolazione lineare); con K == T, B è l'identità
+    K = min(T, OPT_MAX_KNOTS)
+    knots = np.linspace(0, T - 1, K)
+    B = np.column_stack([np.interp(np.arange(T), knots, np.eye(K)[k]) for k in range(K)])
+    BB = np.block([[B, np.zeros_like(B)], [np.zeros_like(B), B]])
+
+    def split(z):
+        x = BB @ z
+        return x[:T] * base_g, x[T:] * base_m
+
+    def sales_and_grad(x):
+        g, m = split(x)
+        ratio = (g + m) / tot_base
+        heur = np.where(reactive, base_sales * (1 - np.exp(-sat * ratio)) / sat_norm, base_sales)
+        d_heur = np.where(reactive, base_sales * sat * np.exp(-sat * ratio) / (sat_norm * tot_base), 0.0) # d heur / d spesa (uguale per i due canali)
+        prop = prophet_plan_sales(_prophet, g, m, stress_mult)
+        sales = 0.5 * (heur + prop)
+        d_g, d_m = 0.5 * (d_heur + k_g * stress_mult), 0.5 * (d_heur + k_m * stress_mult)
+        return sales, np.concatenate([d_g * base_g, d_m * base_m]) @ BB
+
+    spend_grad = np.concatenate([base_g, base_m]) @ BB
+
+    def neg_profit(z):
+        sales, d_sales = sales_and_grad(z)
+        g, m = split(z)
+        profit = sales.sum() / be_aov * profit_order - (g + m).sum()
+        grad = d_sales / be_aov * profit_order - spend_grad
+        return -profit / norm, -grad / norm
+
+    # Vincoli lineari A·x <= b: budget totale + |spesa_t - spesa_t-1| <= max_week_change · spesa media base
+    rows, b = [np.concatenate([base_g, base_m])[None]], [total_budget]
+    for c, base in enumerate((base_g, base_m)):
+        diff = np.zeros((T - 1, 2 * T))
+        idx = np.arange(T - 1) + c * T
+        diff[np.arange(T - 1), idx + 1] = base[1:]
+        diff[np.arange(T - 1), idx] = -base[:-1]
+        rows += [diff, -diff]
+        b += [np.full(2 * (T - 1), max_week_change * base.mean())]
+    A, b = np.vstack(rows) @ BB, np.concatenate([np.atleast_1d(v) for v in b])
+    constraints = [{'type': 'ineq', 'fun': lambda z: b - A @ z, 'jac': lambda z: -A}]
+    if be_roas:
+        def be_margin(z):
+            sales = sales_and_grad(z)[0]
+            g, m = split(z)
+            return (sales.sum() - be_roas * (g + m).sum()) / norm
+        def be_margin_jac(z):
+            return (sales_and_grad(z)[1] - be_roas * spend_grad) / norm
+        constraints.append({'type': 'ineq', 'fun': be_margin, 'jac': be_margin_jac})
+
+    # Punto di partenza: piano base riscalato sul budget (i nodi interpolati restano nei limiti di scala)
+    z0 = np.full(2 * K, np.clip(total_budget / max(tot_base.sum(), 1.0), *scale_bounds))
+    res = minimize(neg_profit, z0, jac=True, method='SLSQP', bounds=[scale_bounds] * (2 * K),
+                   constraints=constraints, options={'maxiter': 200, 'ftol': 1e-9})
+    g, m = split(res.x)
+    sales = sales_and_grad(res.x)[0]
+    return {
+        'google': g, 'meta': m, 'sales': sales,
+        'profit': sales.sum() / be_aov * profit_order - (g + m).sum(),
+        'success': bool(res.success), 'message': res.message, 'iterations': res.nit
     }
 
-    base_sales = 5000.0 # Valore base settimanale
+# --- ARCHIVIO METEO ---
+# Meteo giornaliero per (città, data) in SQLite sotto STORE_DIR, condiviso tra dataset e riavvii: dal provider si
+# scaricano solo gli intervalli mancanti. Gli ultimi WEATHER_FINAL_DAYS giorni sono provvisori e si aggiornano
+# al più una volta al giorno. Provider da ambiente: 'open-meteo' (default) oppure 'file' (CSV/Parquet locale con
+# colonne City, Date, temp, rain) per ambienti offline e test.
+WEATHER_CITIES = {
+    'Milano': (45.46, 9.19), 'Torino': (45.07, 7.68), 'Venezia': (45.44, 12.31),
+    'Bologna': (44.49, 11.34), 'Genova': (44.40, 8.94), 'Firenze': (43.76, 11.25),
+    'Ancona': (43.61, 13.51), 'Perugia': (43.11, 12.38), 'Roma': (41.90, 12.49),
+    'Pescara': (42.46, 14.21), 'Napoli': (40.85, 14.26), 'Bari': (41.11, 16.87),
+    'Potenza': (40.64, 15.80), 'Catanzaro': (38.90, 16.58), 'Palermo': (38.11, 13.36),
+    'Catania': (37.50, 15.08), 'Cagliari': (39.22, 9.12), 'Sassari': (40.72, 8.56),
+    'Trento': (46.06, 11.12), 'Trieste': (45.64, 13.77)
+}
+WEATHER_FINAL_DAYS = 5
+WEATHER_FETCH_WORKERS = 4 # Richieste concorrenti (un blocco per anno)
+WEATHER_PROVIDER = os.environ.get('FORECAST_WEATHER_PROVIDER', 'open-meteo')
+WEATHER_FILE = os.environ.get('FORECAST_WEATHER_FILE', os.path.join(STORE_DIR, 'weather_local.csv'))
+
+# Heatmap: colore per fascia di temperatura (<5, <12, <20, <28, oltre), raggio del punto in base alla pioggia
+WEATHER_TEMP_BINS = [5, 12, 20, 28]
+WEATHER_TEMP_COLORS = np.array(['#0000FF', '#3498db', '#f1c40f', '#e67e22', '#e74c3c'])
+
+@st.cache_resource(show_spinner=False)
+def weather_session():
+    """Sessione HTTP condivisa (connessioni riusate tra i blocchi) con retry e backoff su errori temporanei.
+    Un solo retry di connessione: offline (DNS/rete assenti) il tab non resta in attesa dei backoff."""
+    retry = Retry(total=3, connect=1, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=('GET',))
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(max_retries=retry, pool_maxsize=WEATHER_FETCH_WORKERS))
+    return session
+
+def fetch_open_meteo(start, end):
+    """Provider Open-Meteo: tutte le città in una richiesta (archivio storico, API forecast per le date recenti).
+    Ogni città arriva come array giornalieri: un DataFrame colonnare per città, senza righe una per una."""
+    lats = ",".join([str(c[0]) for c in WEATHER_CITIES.values()])
+    lons = ",".join([str(c[1]) for c in WEATHER_CITIES.values()])
+    s_str = start.strftime('%Y-%m-%d')
+    e_str = end.strftime('%Y-%m-%d')
     
-    for d in dates:
-        year = d.year
-        week = d.isocalendar().week
-        
-        s_fact = seasonal_profile.get(week, 1.0)
-        y_fact = yearly_trend.get(year, 1.0)
-        
-        # Randomicità controllata
-        noise = np.random.uniform(0.9, 1.1)
-        
-        # Calcolo Vendite Totali
-        total_sales = base_sales * s_fact * y_fact * noise
-        
-        # Spesa Ads (Segue le vendite ma con efficienza variabile)
-        # Quando il fatturato esplode (Black Friday), il ROAS sale ma il CPM costa di più
-        marketing_pressure = 0.20 # 20% del fatturato va in ads di media
-        if s_fact > 2.0: marketing_pressure = 0.15 # Efficienza sale nei picchi
-        
-        total_spend = total_sales * marketing_pressure * np.random.uniform(0.95, 1.05)
-        
-        # Split Google/Meta (Google prende più brand search nei picchi)
-        google_share = 0.40
-        if s_fact > 1.5: google_share = 0.50
-        
-        g_cost = total_spend * google_share
-        m_cost = total_spend * (1 - google_share)
-        
-        # KPI Derivati
-        aov = 120.0 + np.random.uniform(-10, 10)
-        orders = int(total_sales / aov)
-        
-        # Resi (più alti dopo i picchi)
-        return_rate = 0.12
-        if week in [1, 2, 3, 4, 5]: return_rate = 0.25 # Gennaio resi alti
-        returns = - (total_sales * return_rate * np.random.uniform(0.8, 1.2))
-        
-        discounts = - (total_sales * 0.05) if s_fact < 2 else - (total_sales * 0.15) # Più sconti nei picchi
-        
-        # ROAS Simulato
-        roas_g = (total_sales * 0.6) / g_cost if g_cost > 0 else 0
-        roas_m = (total_sales * 0.5) / m_cost if m_cost > 0 else 0
-        
-        data.append({
-            'Year Week': f"{year}{week:02d}",
-            'Cost': g_cost,
-            'Amount Spent': m_cost,
-            'Total sales': total_sales,
-            'Returns': returns,
-            'Discounts': discounts,
-            'Average order value': aov,
-            'Orders': orders,
-            'Returning customer rate': f"{np.random.randint(12, 28)}%",
-            'Conversions Value': g_cost * roas_g,
-            'Website Purchases Conversion Value': m_cost * roas_m,
-            'Avg. CPC': 0.85,
-            'CPC (All)': 0.65,
-            'CPM (Cost per 1,000 Impressions)': 12.50,
-            'Impressions': int(m_cost / 12.50 * 1000),
-            'Frequency': 1.2,
-            'Items': int(orders * 1.5),
-            'Gross sales': total_sales - discounts
+    is_recent = (datetime.now() - end).days < WEATHER_FINAL_DAYS
+    base_url = "https://api.open-meteo.com/v1/forecast" if is_recent else "https://archive-api.open-meteo.com/v1/archive"
+    url = f"{base_url}?latitude={lats}&longitude={lons}&start_date={s_str}&end_date={e_str}&daily=temperature_2m_max,precipitation_sum&timezone=Europe%2FBerlin"
+    
+    resp = weather_session().get(url, timeout=15)
+    resp.raise_for_status()
+    resp = resp.json()
+    if not isinstance(resp, list): resp = [resp]
+    
+    frames = [
+        pd.DataFrame({
+            'City': city, 'Date': data['daily']['time'],
+            'temp': np.array(data['daily']['temperature_2m_max'], dtype=np.float64),
+            'rain': np.array(data['daily']['precipitation_sum'], dtype=np.float64)
         })
-        
-    return pd.DataFrame(data)
+        for city, data in zip(WEATHER_CITIES, resp) if 'daily' in data
+    ]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['City', 'Date', 'temp', 'rain'])
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def read_weather_file(path, mtime):
+    df_w = pd.read_parquet(path) if path.endswith('.parquet') else pd.read_csv(path)
+    return df_w.assign(Date=pd.to_datetime(df_w['Date']).dt.strftime('%Y-%m-%d'))
+
+def fetch_weather_file(start, end):
+    """Provider locale: legge WEATHER_FILE (CSV o Parquet, in cache per versione del file) e restituisce l'intervallo."""
+    df_w = read_weather_file(WEATHER_FILE, os.path.getmtime(WEATHER_FILE))
+    in_range = (df_w['Date'] >= start.strftime('%Y-%m-%d')) & (df_w['Date'] <= end.strftime('%Y-%m-%d'))
+    return df_w.loc[in_range & df_w['City'].isin(list(WEATHER_CITIES)), ['City', 'Date', 'temp', 'rain']]
+
+WEATHER_PROVIDERS = {'open-meteo': fetch_open_meteo, 'file': fetch_weather_file}
+
+def weather_db_path():
+    return os.path.join(STORE_DIR, 'weather.sqlite')
+
+def open_weather_db():
+    os.makedirs(STORE_DIR, exist_ok=True)
+    conn = sqlite3.connect(weather_db_path())
+    conn.execute("CREATE TABLE IF NOT EXISTS weather (city TEXT, date TEXT, temp REAL, rain REAL, fetched TEXT, PRIMARY KEY (city, date))")
+    return conn
+
+def weather_store_version():
+    path = weather_db_path()
+    return os.path.getmtime(path) if os.path.exists(path) else 0
+
+def missing_weather_ranges(conn, start, end, today):
+    """Intervalli contigui (inizio, fine) da scaricare: date senza tutte le città oppure provvisorie
+    (scaricate a meno di WEATHER_FINAL_DAYS giorni dalla data) e non aggiornate oggi."""
+    days = pd.date_range(start.normalize(), end.normalize(), freq='D')
+    if len(days) == 0: return []
+    stored = pd.read_sql_query(
+        "SELECT date, COUNT(*) AS n, MIN(fetched) AS fetched FROM weather WHERE date BETWEEN ? AND ? GROUP BY date",
+        conn, params=(days[0].strftime('%Y-%m-%d'), days[-1].strftime('%Y-%m-%d'))
+    )
+    fetched = pd.to_datetime(stored['fetched'])
+    final = (fetched - pd.to_datetime(stored['date'])).dt.days >= WEATHER_FINAL_DAYS
+    complete = stored.loc[(stored['n'] >= len(WEATHER_CITIES)) & (final | (fetched >= today)), 'date']
+    
+    idx = np.flatnonzero(~days.strftime('%Y-%m-%d').isin(complete))
+    if len(idx) == 0: return []
+    breaks = np.flatnonzero(np.diff(idx) > 1)
+    starts, ends = idx[np.r_[0, breaks + 1]], idx[np.r_[breaks, len(idx) - 1]]
+    return [(days[a], days[b]) for a, b in zip(starts, ends)]
+
+def weather_chunks(ranges, today):
+    """Divide gli intervalli mancanti in blocchi per anno solare; gli ultimi giorni provvisori stanno in un blocco
+    a parte (per Open-Meteo vanno sull'API forecast, il resto sull'archivio)."""
+    recent = today - pd.Timedelta(days=WEATHER_FINAL_DAYS)
+    chunks = []
+    for r_start, r_end in ranges:
+        cuts = [d for d in pd.date_range(r_start, r_end, freq='YS') if d > r_start]
+        if r_start < recent <= r_end: cuts = sorted(set(cuts) | {recent})
+        starts = [r_start] + cuts
+        ends = [c - pd.Timedelta(days=1) for c in cuts] + [r_end]
+        chunks += list(zip(starts, ends))
+    return chunks
+
+@st.cache_data(ttl=900, show_spinner=False)
+def sync_weather_store(start, end, provider):
+    """Scarica dal provider solo gli intervalli mancanti, in blocchi annuali concorrenti, e li salva nell'archivio
+    man mano che arrivano: un blocco fallito non blocca gli altri. Ritorna l'ultimo errore (None se tutto ok);
+    in cache per 15 minuti, così un provider irraggiungibile non viene richiamato a ogni rerun."""
+    fetch = WEATHER_PROVIDERS[provider]
+    today = pd.Timestamp.now().normalize()
+    error = None
+    with closing(open_weather_db()) as conn:
+        chunks = weather_chunks(missing_weather_ranges(conn, start, end, today), today)
+        if not chunks: return None
+        with ThreadPoolExecutor(max_workers=min(WEATHER_FETCH_WORKERS, len(chunks))) as pool:
+            futures = [pool.submit(fetch, c_start, c_end) for c_start, c_end in chunks]
+            for fut in as_completed(futures):
+                try:
+                    df_w = fut.result()
+                except Exception as ex:
+                    error = str(ex)
+                    continue
+                conn.executemany(
+                    "INSERT OR REPLACE INTO weather VALUES (?, ?, ?, ?, ?)",
+                    df_w[['City', 'Date', 'temp', 'rain']].assign(fetched=today.strftime('%Y-%m-%d')).itertuples(index=False, name=None)
+                )
+                conn.commit()
+    return error
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def load_weather_timeseries(start, end, version):
+    """Meteo dell'intervallo dall'archivio locale con coordinate e stile per la mappa (version = stato dell'archivio)."""
+    with closing(open_weather_db()) as conn:
+        df_w = pd.read_sql_query(
+            "SELECT date AS Date, city AS City, temp, rain FROM weather WHERE date BETWEEN ? AND ?",
+            conn, params=(start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'))
+        )
+    df_w = df_w[df_w['City'].isin(list(WEATHER_CITIES))]
+    city_order = pd.Categorical(df_w['City'], categories=list(WEATHER_CITIES))
+    df_w = df_w.assign(_c=city_order).sort_values(['_c', 'Date'], kind='stable').drop(columns='_c').reset_index(drop=True)
+    coords = np.array([WEATHER_CITIES[c] for c in df_w['City']]).reshape(-1, 2)
+    df_w.insert(2, 'lat', coords[:, 0])
+    df_w.insert(3, 'lon', coords[:, 1])
+    df_w['color'] = WEATHER_TEMP_COLORS[np.digitize(df_w['temp'].to_numpy(dtype=np.float64), WEATHER_TEMP_BINS)]
+    df_w['size'] = 6000 + df_w['rain'] * 400
+    return df_w
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def weather_monthly(start, end, version, _df_w):
+    """Meteo mensile ('YYYY-MM' dalle date ISO, senza riparsare): temperatura e pioggia medie per città (pivot
+    mese x città) e nazionali (media di tutte le città e giorni). start/end/version identificano _df_w."""
+    month = _df_w['Date'].str[:7].rename('Mese')
+    vals = _df_w[['temp', 'rain']].astype('float64')  # float anche ad archivio vuoto (colonne object)
+    by_city = vals.groupby([month, _df_w['City']]).mean().unstack('City')
+    if by_city.empty:
+        # Senza meteo: stessa struttura (metrica x città) senza righe, così il ledger usa i fallback
+        cols = pd.MultiIndex.from_product([['temp', 'rain'], sorted(WEATHER_CITIES)], names=[None, 'City'])
+        by_city = pd.DataFrame(index=pd.Index([], dtype=object, name='Mese'), columns=cols, dtype='float64')
+    national = vals.groupby(month).mean()
+    return by_city, national
+
+# --- CUBO ANNO × SETTIMANA (CONFRONTI LFL) ---
+# Somme e conteggi non nulli delle metriche per (anno, settimana ISO), calcolati una volta per versione
+# del dataset: trend YoY, elasticità e Health Check leggono solo slice sulle settimane comuni.
+LFL_CUBE_COLUMNS = ['Fatturato_Netto', 'Spesa_Ads_Totale', 'Orders', 'Returns', col_g_imps,
+                    col_g_cpc, col_m_cpc, col_m_cpm, col_m_freq, col_ret_rate]
+
+def lfl_cube_columns(df):
+    """Colonne del DataFrame che entrano nel cubo LFL (più le chiavi anno/settimana)."""
+    return ['Year', 'Week'] + [c for c in LFL_CUBE_COLUMNS if c in df.columns]
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def year_week_cube(data_key, _df):
+    """Cubo (metrica, anno, settimana 0-53) di somme e conteggi, maschera di presenza (anno, settimana)
+    e matrice delle settimane comuni (anno, anno, settimana). data_key identifica _df."""
+    years = np.sort(_df['Year'].unique()).astype(np.int64)
+    cell = np.searchsorted(years, _df['Year'].to_numpy(dtype=np.int64)) * 54 + _df['Week'].to_numpy(dtype=np.int64)
+    metrics = [c for c in LFL_CUBE_COLUMNS if c in _df.columns]
+    sums = np.zeros((len(metrics), len(years), 54))
+    counts = np.zeros((len(metrics), len(years), 54), dtype=np.int64)
+    for k, c in enumerate(metrics):
+        vals = _df[c].astype(str).str.replace('%', '').str.strip() if c == col_ret_rate else _df[c]
+        vals = pd.to_numeric(vals, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+        if c == 'Returns': vals = np.abs(vals)
+        ok = ~np.isnan(vals)
+        sums[k] = np.bincount(cell[ok], weights=vals[ok], minlength=len(years) * 54).reshape(len(years), 54)
+        counts[k] = np.bincount(cell[ok], minlength=len(years) * 54).reshape(len(years), 54)
+    present = np.bincount(cell, minlength=len(years) * 54).reshape(len(years), 54) > 0
+    return {'years': years, 'metrics': metrics, 'sum': sums, 'count': counts, 'present': present,
+            'common': present[:, None, :] & present[None, :, :]}
+
+def lfl_weeks(cube, year_a, year_b):
+    """Maschera (54,) delle settimane presenti sia in year_a che in year_b."""
+    return cube['common'][np.searchsorted(cube['years'], year_a), np.searchsorted(cube['years'], year_b)]
+
+def cube_totals(cube, year, weeks=None):
+    """Somme e conteggi per metrica di un anno sulle settimane della maschera (None = tutto l'anno)."""
+    i = np.searchsorted(cube['years'], year)
+    w = cube['present'][i] if weeks is None else weeks
+    return (dict(zip(cube['metrics'], cube['sum'][:, i, w].sum(axis=1))),
+            dict(zip(cube['metrics'], cube['count'][:, i, w].sum(axis=1))))
+
+# --- HEALTH CHECK (TUTTI GLI ANNI) ---
+
+def safe_ratio(num, den):
+    """num / den elemento per elemento, 0 dove den <= 0."""
+    num, den = np.broadcast_arrays(np.asarray(num, dtype=np.float64), np.asarray(den, dtype=np.float64))
+    return np.divide(num, den, out=np.zeros(num.shape), where=den > 0)
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def health_metrics_table(data_key, _cube, be_aov):
+    """Statistiche vitali di ogni anno su ogni finestra LFL in un solo passaggio sul cubo: la riga (Year, Vs)
+    è l'anno Year ristretto alle settimane in comune con Vs (tutto l'anno se non ce ne sono).
+    data_key identifica _cube."""
+    years, present, common = _cube['years'], _cube['present'], _cube['common']
+    window = np.where(common.any(axis=2, keepdims=True), common, present[:, None, :])  # (anno, vs, settimana)
+    tot = dict(zip(_cube['metrics'], np.einsum('myw,yvw->myv', _cube['sum'], window.astype(np.float64))))
+    cnt = dict(zip(_cube['metrics'], np.einsum('myw,yvw->myv', _cube['count'], window.astype(np.int64))))
+    zeros = np.zeros(window.shape[:2])
+
+    def col_mean(c):
+        # Media sulle righe non nulle (NaN se la finestra non ne ha), 0 se la colonna manca
+        return np.where(cnt[c] > 0, safe_ratio(tot[c], cnt[c]), np.nan) if c in tot else zeros
+
+    sales, spend = tot['Fatturato_Netto'], tot['Spesa_Ads_Totale']
+    orders = tot['Orders'] if 'Orders' in tot else sales / be_aov
+    aov, cpa = safe_ratio(sales, orders), safe_ratio(spend, orders)
+    ret_mean = col_mean(col_ret_rate)
+    ret_rate = ret_mean / 100
+    # Formula LTV Proxy: AOV / (1 - Retention Rate)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ltv = np.where(ret_rate < 0.99, aov / (1 - ret_rate), aov)
+
+    metrics = {
+        'sales': sales, 'mer': safe_ratio(sales, spend), 'cpa': cpa,
+        'cpc_g': col_mean(col_g_cpc), 'cpc_m': col_mean(col_m_cpc), 'cpm_m': col_mean(col_m_cpm),
+        'freq_m': col_mean(col_m_freq), 'imps_g': tot.get(col_g_imps, zeros), 'aov': aov,
+        'returns': safe_ratio(tot.get('Returns', zeros), sales) * 100, 'ret': ret_mean,
+        'ltv': ltv, 'ltv_cpa': safe_ratio(ltv, cpa), 'weeks_count': window.sum(axis=2),
+    }
+    index = pd.MultiIndex.from_product([years, years], names=['Year', 'Vs'])
+    return pd.DataFrame({k: np.ravel(v) for k, v in metrics.items()}, index=index)
+
+# --- INSIGHT AI: SCORING MENSILE ---
+
+def monthly_agg_spec(columns):
+    """Aggregazioni mensili dell'Insight AI: somme di volumi/spese, medie dei rapporti presenti."""
+    col_date, col_google, col_meta, col_sales, col_returns, col_orders, col_aov = detect_key_columns(columns)
+    spec = {
+        'Spesa_Ads_Totale': 'sum', 'Fatturato_Netto': 'sum', 'Orders': 'sum',
+        col_returns: 'sum', col_discounts: 'sum', col_google: 'sum', col_meta: 'sum',
+        col_g_val: 'sum', col_m_val: 'sum', 'Gross sales': 'sum', 'Profitto_Operativo': 'sum'
+    }
+    spec.update({c: 'mean' for c in (col_ret_rate, col_m_freq, col_m_cpm, col_g_cpc, col_m_cpc) if c in columns})
+    return spec
+
+def join_labels(parts, sep=' | '):
+    """Concatena riga per riga le etichette non vuote di più Series di stringhe."""
+    out = parts[0]
+    for p in parts[1:]:
+        out = out + np.where((out != '') & (p != ''), sep, '') + p
+    return out
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def monthly_scorecard(data_key, _df, be_roas_val):
+    """Scorecard mensile completa (mese più recente in testa): metriche avanzate, Health Score, stagionalità,
+    tag e alert calcolati come operazioni vettoriali su tutti i mesi. data_key identifica _df."""
+    col_date, col_google, col_meta, col_sales, col_returns, col_orders, col_aov = detect_key_columns(_df.columns)
+    month_key = _df['Data_Interna'].dt.to_period('M').rename('Month_Date')
+    ai_df = _df.groupby(month_key).agg(monthly_agg_spec(_df.columns)).sort_index(ascending=False)
+
+    # Calcolo Metriche Avanzate Mensili
+    ai_df['MER'] = ai_df['Fatturato_Netto'] / ai_df['Spesa_Ads_Totale'].replace(0, np.nan)
+    ai_df['AOV'] = ai_df['Fatturato_Netto'] / ai_df['Orders'].replace(0, np.nan)
+    ai_df['CPA'] = ai_df['Spesa_Ads_Totale'] / ai_df['Orders'].replace(0, np.nan)
+
+    # --- LOGICA LTV INTEGRATA ---
+    has_ltv = col_ret_rate in ai_df.columns
+    if has_ltv:
+        ai_df['RET_RATE'] = pd.to_numeric(ai_df[col_ret_rate], errors='coerce').fillna(0) / 100
+        # LTV Proxy = AOV / (1 - Retention) - Cappato al 90% per evitare infiniti
+        ai_df['LTV'] = ai_df['AOV'] / (1 - ai_df['RET_RATE'].clip(upper=0.90))
+        ai_df['LTV_CPA'] = ai_df['LTV'] / ai_df['CPA'].replace(0, np.nan)
+
+    ai_df['Discount_Rate'] = (ai_df[col_discounts].abs() / ai_df['Gross sales'].replace(0, np.nan)) * 100
+    ai_df['ROAS_Google'] = ai_df[col_g_val] / ai_df[col_google].replace(0, np.nan)
+    ai_df['ROAS_Meta'] = ai_df[col_m_val] / ai_df[col_meta].replace(0, np.nan)
+    ai_df['Seasonality'] = ai_df['Fatturato_Netto'] / ai_df['Fatturato_Netto'].mean()
+
+    # Regole di scoring (i NaN non soddisfano nessuna soglia, come nei confronti scalari)
+    mer, disc = ai_df['MER'], ai_df['Discount_Rate']
+    mer_ok = (mer >= be_roas_val).to_numpy()
+    no_label = pd.Series('', index=ai_df.index)
+    # 1. Salute Finanziaria Immediata (MER)
+    score = 50 + np.where(mer_ok, 15, -15)
+    mer_txt = mer.map('{:.2f}'.format)
+    tag_mer = ('MER Pro: ' + mer_txt).where(mer_ok, '')
+    alert_mer = ('Margine Basso (MER ' + mer_txt + ')').where(~mer_ok, '')
+    # 2. Salute Strategica a Lungo Termine (LTV)
+    tag_ltv, alert_ltv = no_label, no_label
+    if has_ltv:
+        ltv_cpa = ai_df['LTV_CPA']
+        score = score + np.select([ltv_cpa > 3.5, ltv_cpa < 2.0], [20, -10], 0)
+        tag_ltv = ('High LTV: ' + ltv_cpa.map('{:.1f}'.format) + 'x').where(ltv_cpa > 3.5, '')
+        alert_ltv = no_label.mask(ltv_cpa < 2.0, 'Bassa Retention/Valore Cliente')
+    # 3. Canale Dominante (Efficienza Diretta)
+    tag_channel = pd.Series(np.where(ai_df['ROAS_Google'] > ai_df['ROAS_Meta'], 'Top: Google (Intent)', 'Top: Meta (Visual)'),
+                            index=ai_df.index)
+    # 4. Pressione Sconti
+    score = score + np.where(disc > 15, -10, 0)
+    alert_disc = ('Eccesso Sconti (' + disc.map('{:.1f}'.format) + '%)').where(disc > 15, '')
+
+    ai_df['Health_Score'] = np.minimum(score, 100)
+    ai_df['Score_Class'] = np.select([score >= 70, score >= 50], ['ai-score-high', 'ai-score-med'], 'ai-score-low')
+    ai_df['Stagionalita'] = np.select([ai_df['Seasonality'] > 1.2, ai_df['Seasonality'] < 0.8],
+                                      ['Alta Stagionalità 🔥', 'Bassa Stagionalità ❄️'], 'Standard')
+    ai_df['Tags'] = join_labels([tag_mer, tag_ltv, tag_channel])
+    ai_df['Alerts'] = join_labels([alert_mer, alert_ltv, alert_disc])
+    return ai_df
 
 # --- HEADER ---
 st.title("📈 E-commerce Strategic Decision Engine")
@@ -215,8 +1347,18 @@ st.sidebar.header("🕹️ Dati & Pannello")
 demo_mode = st.sidebar.toggle("🚀 Usa Modalità DEMO (Dati Casuali)", value=False)
 
 uploaded_file = None
-if not demo_mode:
+history_name = None
+if demo_mode:
+    demo_seed = int(st.sidebar.number_input("🎲 Seed Dati DEMO", value=42, step=1, help="Stesso seed = stessi dati: i modelli in cache non vengono riallenati a ogni interazione."))
+else:
     uploaded_file = st.sidebar.file_uploader("Carica il file .csv", type="csv")
+    if st.sidebar.toggle("💾 Archivio Storico Locale", value=False, help="Salva lo storico pulito in formato Parquet sul server. I caricamenti successivi possono contenere solo le ultime settimane: vengono uniti per 'Year Week' e solo le settimane nuove vengono elaborate."):
+        saved_datasets = list_history_datasets()
+        history_name = st.sidebar.text_input(
+            "Nome dataset", value=saved_datasets[0] if saved_datasets else "storico",
+            help=f"Dataset salvati: {', '.join(saved_datasets) if saved_datasets else 'nessuno'}"
+        )
+memory_slot = st.sidebar.empty()
 
 st.sidebar.divider()
 
@@ -347,93 +1489,34 @@ with st.expander("📋 Guida: Come formattare il CSV per la versione completa"):
 # --- LOGICA CARICAMENTO E PULIZIA (UNIFICATA) ---
 df = None
 
-# 1. Recupero DataFrame (Demo o File)
+# 1. Recupero DataFrame (Demo o File) + Elaborazione Completa
 with st.spinner("📂 Caricamento e preparazione dati..."):
-    if demo_mode:
-        df = generate_demo_data()
-        st.success("✅ Dati DEMO generati (Pattern Non-Lineare)!")
-    elif uploaded_file is not None:
-        try:
-            df = pd.read_csv(uploaded_file, sep=None, engine='python')
-            df = df.dropna(how='all')
-        except Exception as e:
-            st.error(f"Errore: {e}")
+    try:
+        if demo_mode:
+            df = prepare_dataset(generate_demo_data(demo_seed), be_aov, profit_order)
+            st.success("✅ Dati DEMO generati (Pattern Non-Lineare)!")
+        elif history_name:
+            # Archivio persistente: l'upload (anche solo le ultime settimane) viene unito una volta sola
+            if uploaded_file is not None:
+                file_bytes = uploaded_file.getvalue()
+                merge_key = (history_name, hashlib.sha1(file_bytes).hexdigest())
+                if st.session_state.last_history_merge != merge_key:
+                    n_weeks = merge_into_history(history_name, read_csv_fast(file_bytes).dropna(how='all'), be_aov, profit_order)
+                    st.session_state.last_history_merge = merge_key
+                    st.sidebar.caption(f"💾 {n_weeks} settimane nuove/aggiornate salvate in '{history_name}'.")
+            df = load_history_dataset(history_name, history_version(history_name), be_aov, profit_order)
+        elif uploaded_file is not None:
+            # Chiave di cache: hash del contenuto (non del nome) + input economici
+            file_bytes = uploaded_file.getvalue()
+            df = load_uploaded_dataset(hashlib.sha1(file_bytes).hexdigest(), file_bytes, be_aov, profit_order)
+    except Exception as e:
+        st.error(f"Errore: {e}")
 
-# 2. Elaborazione Completa (Se df esiste)
+# 2. Analisi (Se df esiste)
 if df is not None:
     try:
-        df.columns = df.columns.str.strip()
-
-        col_date = next((c for c in df.columns if 'Year Week' in c or 'Settimana' in c), None)
-        col_google = next((c for c in df.columns if 'Cost' in c), 'Cost')
-        col_meta = next((c for c in df.columns if 'Amount Spent' in c), 'Amount Spent')
-        col_sales = next((c for c in df.columns if 'Total sales' in c), 'Total sales')
-        col_returns = next((c for c in df.columns if 'Returns' in c), 'Returns')
-        col_orders = next((c for c in df.columns if 'Orders' in c), 'Orders')
-        col_aov = next((c for c in df.columns if 'Average order value' in c), 'Average order value')
-        
-        col_g_val = 'Conversions Value'
-        col_m_val = 'Website Purchases Conversion Value'
-        col_g_cpc = 'Avg. CPC'
-        col_m_cpc = 'CPC (All)'
-        col_m_cpm = 'CPM (Cost per 1,000 Impressions)'
-        col_g_imps = 'Impressions'
-        col_m_freq = 'Frequency'
-        
-        col_items = 'Items'
-        col_ret_rate = 'Returning customer rate'
-        col_discounts = 'Discounts'
-
-        if not col_date:
-            st.error("Errore: Manca colonna data.")
-            st.stop()
-
-        df['Data_Interna'] = df[col_date].apply(parse_iso_week)
-        df = df.dropna(subset=['Data_Interna']).sort_values('Data_Interna')
-        df['Periodo'] = df['Data_Interna'].apply(get_week_range_label_with_year)
-
-        # === CREAZIONE COLONNE GLOBALI PER TAB 4 ===
-        df['Year'] = df['Data_Interna'].dt.isocalendar().year
-        df['Week'] = df['Data_Interna'].dt.isocalendar().week
-        # ==========================================================
-
-        money_cols = [col_google, col_meta, col_sales, col_returns, col_aov, 'Gross sales', col_discounts, 
-                      col_g_val, col_m_val, col_g_cpc, col_m_cpc, col_m_cpm]
-        for c in money_cols:
-            if c in df.columns: df[c] = clean_currency_us(df[c])
-
-        if col_g_imps in df.columns: df[col_g_imps] = pd.to_numeric(df[col_g_imps], errors='coerce').fillna(0)
-        if col_m_freq in df.columns: df[col_m_freq] = pd.to_numeric(df[col_m_freq], errors='coerce').fillna(0)
-        
-        # Pulizia specifica per l'AI
-        if col_ret_rate in df.columns: df[col_ret_rate] = df[col_ret_rate].apply(clean_percentage)
-        if col_items in df.columns: df[col_items] = pd.to_numeric(df[col_items], errors='coerce').fillna(0)
-
-        df = df.fillna(0)
-
-        df['Fatturato_Netto'] = df[col_sales].clip(lower=0)
-        df['Spesa_Ads_Totale'] = df[col_google] + df[col_meta]
-        df['Spesa_Ads_Totale'] = df['Spesa_Ads_Totale'].replace(0, np.nan)
-        df['MER'] = (df[col_sales] / df['Spesa_Ads_Totale']).fillna(0)
-        df['Tasso_Resi'] = (df[col_returns].abs() / df[col_sales].replace(0, np.nan)) * 100
-        df['Tasso_Resi'] = df['Tasso_Resi'].fillna(0)
-        
-        # Calcolo CoS Storico
-        df['CoS'] = (df['Spesa_Ads_Totale'] / df['Fatturato_Netto'].replace(0, np.nan)) * 100
-        df['CoS'] = df['CoS'].fillna(0)
-        
-        # --- CALCOLO PROFITTO NETTO STIMATO NEL DF ---
-        num_orders = df[col_orders] if col_orders in df.columns else (df['Fatturato_Netto'] / be_aov)
-        
-        # Profitto Operativo = (Numero Ordini * Profitto per Ordine) - Spesa Ads
-        # FIX: Uso la variabile corretta profit_order definita nella sidebar
-        df['Profitto_Operativo'] = (num_orders * profit_order) - df['Spesa_Ads_Totale']
-
-        # Inizializzazione sicura ROAS
-        df['ROAS_Google'] = 0.0
-        df['ROAS_Meta'] = 0.0
-        if col_g_val in df.columns: df['ROAS_Google'] = df[col_g_val] / df[col_google].replace(0, np.nan).fillna(0)
-        if col_m_val in df.columns: df['ROAS_Meta'] = df[col_m_val] / df[col_meta].replace(0, np.nan).fillna(0)
+        col_date, col_google, col_meta, col_sales, col_returns, col_orders, col_aov = detect_key_columns(df.columns)
+        memory_slot.caption(f"🧮 Memoria dati sessione: {df.memory_usage(deep=True).sum() / 1e6:.2f} MB ({len(df):,} righe)")
 
         # --- AUTO-CALCOLO ELASTICITÀ ---
         df_annual = df.groupby('Year').agg({'Spesa_Ads_Totale': 'sum', 'Fatturato_Netto': 'sum'}).sort_index()
@@ -456,40 +1539,37 @@ if df is not None:
         growth_rate = (sales_ly - sales_py) / sales_py if sales_py > 0 else 0.0
 
         # Storico Annuale Like-for-Like (LFL) - Logica Unificata con Health Check
+        lfl_key = frame_fingerprint(df, lfl_cube_columns(df))
+        lfl_cube = year_week_cube(lfl_key, df)
         historical_growth_data = []
         years_avail = sorted(df['Year'].unique(), reverse=True)
-        for i in range(len(years_avail) - 1):
-            curr_y = years_avail[i]
-            prev_y = years_avail[i+1]
-            
+        for curr_y, prev_y in zip(years_avail[:-1], years_avail[1:]):
             # 1. Identifichiamo le settimane disponibili per entrambi gli anni (Confronto Omogeneo)
-            weeks_curr = set(df[df['Year'] == curr_y]['Week'].unique())
-            weeks_prev = set(df[df['Year'] == prev_y]['Week'].unique())
-            common_weeks = sorted(list(weeks_curr.intersection(weeks_prev)))
-            
-            if common_weeks:
+            common_weeks = lfl_weeks(lfl_cube, curr_y, prev_y)
+
+            if common_weeks.any():
                 # 2. Sommiamo il fatturato solo per le settimane comuni
-                val_curr_lfl = df[(df['Year'] == curr_y) & (df['Week'].isin(common_weeks))]['Fatturato_Netto'].sum()
-                val_prev_lfl = df[(df['Year'] == prev_y) & (df['Week'].isin(common_weeks))]['Fatturato_Netto'].sum()
-                
+                val_curr_lfl = cube_totals(lfl_cube, curr_y, common_weeks)[0]['Fatturato_Netto']
+                val_prev_lfl = cube_totals(lfl_cube, prev_y, common_weeks)[0]['Fatturato_Netto']
+
                 if val_prev_lfl > 0:
                     g_y = (val_curr_lfl - val_prev_lfl) / val_prev_lfl
                     # Se stiamo confrontando un anno parziale (es. l'attuale), aggiungiamo il flag LFL
-                    is_partial = len(common_weeks) < 48
+                    is_partial = common_weeks.sum() < 48
                     tag = " (LFL)" if is_partial else ""
                     historical_growth_data.append(f"📅 {curr_y} vs {prev_y}: **{g_y:+.1%}{tag}**")
                 else:
                     historical_growth_data.append(f"📅 {curr_y} vs {prev_y}: **N/A**")
             else:
                 # Fallback: Se non c'è nessuna settimana in comune, mostriamo il dato totale (es. primo anno)
-                val_curr = df[df['Year'] == curr_y]['Fatturato_Netto'].sum()
-                val_prev = df[df['Year'] == prev_y]['Fatturato_Netto'].sum()
+                val_curr = cube_totals(lfl_cube, curr_y)[0]['Fatturato_Netto']
+                val_prev = cube_totals(lfl_cube, prev_y)[0]['Fatturato_Netto']
                 if val_prev > 0:
                     g_y = (val_curr - val_prev) / val_prev
                     historical_growth_data.append(f"📅 {curr_y} vs {prev_y}: **{g_y:+.1%}**")
 
         # === 🚀 AUTO-SETTING AL PRIMO CARICAMENTO (O AVVIO DEMO) ===
-        current_source_name = "DEMO" if demo_mode else (uploaded_file.name if uploaded_file else None)
+        current_source_name = f"DEMO-{demo_seed}" if demo_mode else (f"💾 {history_name}" if history_name else (uploaded_file.name if uploaded_file else None))
         
         if st.session_state.last_uploaded_file != current_source_name:
             st.session_state.trend_val = 0.0
@@ -549,6 +1629,12 @@ if df is not None:
             
             # Durata
             mesi_prev = st.number_input("Mesi di Previsione", 1, 24, 6)
+            
+            # Cadenza del backtest
+            bt_cadence_label = st.selectbox(
+                "⏱️ Cadenza Refit Backtest", list(BACKTEST_CADENCES), key="bt_cadence",
+                help=f"Il refit completo a ogni settimana è il più accurato ma anche il più lento. Le altre cadenze prevedono comunque ogni settimana: il confronto di accuratezza è nel report di Backtesting. Prophet si rifitta al più ogni {PROPHET_BACKTEST_REFIT_EVERY} settimane."
+            )
 
         st.sidebar.divider()
         st.sidebar.subheader("📉 Stress Test (Scenario Analysis)")
@@ -657,59 +1743,36 @@ if df is not None:
                 st.success(f"🟢 **SCALABILITÀ:** Efficienza eccellente ({mer_attuale:.2f} vs {be_roas_val:.2f}). Hai margine operativo per aumentare i budget Ads del 15-20% senza compromettere la stabilità.")
 
         # --- 5. CALCOLO PREVISIONALE ---
-        # Pre-calcolo delle feature per tutti i modelli (ML e Backtest)
-        df['Week'] = df['Data_Interna'].dt.isocalendar().week
-        df['Week_Sin'] = np.sin(2 * np.pi * df['Week'] / 53)
-        df['Week_Cos'] = np.cos(2 * np.pi * df['Week'] / 53)
-        df['Lag_Sales_1'] = df['Fatturato_Netto'].shift(1)
-        df['Lag_Sales_4'] = df['Fatturato_Netto'].shift(4)
-
-        df['Week_Num'] = df['Week'] # Per retrocompatibilità stagionale
-        seasonal = df.groupby('Week_Num').agg({
-            'Fatturato_Netto': 'mean', col_google: 'mean', col_meta: 'mean', col_orders: 'mean'
+        # Le feature dei modelli (Week_Sin/Cos, Lag_Sales_*) sono calcolate al momento da add_model_features
+        seasonal = df.groupby('Week').agg({
+            'Fatturato_Netto': 'mean', col_google: 'mean', col_meta: 'mean'
         }).reset_index()
 
+        # Profilo denso per settimana ISO (fatturato, google, meta): heuristic, budget futuro Prophet e backtest
+        season_prof = seasonal_profile(seasonal, ['Fatturato_Netto', col_google, col_meta])
+
         avg_hist_sales = df['Fatturato_Netto'].mean()
         
         future_dates = pd.date_range(start=last_date + pd.Timedelta(weeks=1), periods=int(mesi_prev*4.34), freq='W-MON')
+        future_weeks = future_dates.isocalendar().week.to_numpy(dtype=np.int64)
 
-        rows = []
-        for d in future_dates:
-            w = d.isocalendar().week
-            base = seasonal[seasonal['Week_Num'] == w]
-            if base.empty: base = seasonal.mean().to_frame().T
-            
-            # Trend applicato (Base storica + Slider)
-            base_trend = (1 + growth_rate) * (1 + manual_trend)
-            
-            proj_sales_base = base['Fatturato_Netto'].values[0] * base_trend
-            proj_google_base = base[col_google].values[0] * base_trend
-            proj_meta_base = base[col_meta].values[0] * base_trend
-            
-            new_g, new_m = proj_google_base * m_google, proj_meta_base * m_meta
-            total_new_spend = new_g + new_m
-            total_base_spend = proj_google_base + proj_meta_base
-            
-            # Modello Esponenziale: raddoppiare la spesa non raddoppia i risultati
-            spend_ratio = total_new_spend / total_base_spend if total_base_spend > 0 else 1.0
-            saturation_effect = 1 - np.exp(-sat_factor * spend_ratio)
-            # Normalizzazione per mantenere la coerenza con la baseline
-            efficiency_boost = saturation_effect / (1 - np.exp(-sat_factor)) if sat_factor > 0 else 1.0
-            
-            f_sales = proj_sales_base * efficiency_boost
-            
-            f_orders = f_sales / be_aov
-            
-            rows.append({
-                'Data': d, 
-                'Periodo': get_week_range_label_with_year(d),
-                'Google Previsto': new_g, 
-                'Meta Previsto': new_m, 
-                'Fatturato Previsto': f_sales, 
-                'Ordini Previsti': f_orders
-            })
+        # Trend applicato (Base storica + Slider); piano base (scala 1x) anche per la superficie di risposta
+        base_trend = (1 + growth_rate) * (1 + manual_trend)
+        heur_base = tuple(np.ascontiguousarray(season_prof[future_weeks].T) * base_trend)
+        proj_sales_base, proj_google_base, proj_meta_base = heur_base
+        new_g, new_m = proj_google_base * m_google, proj_meta_base * m_meta
+        
+        # Modello Esponenziale: raddoppiare la spesa non raddoppia i risultati (normalizzato sulla baseline)
+        f_sales = heuristic_response(proj_sales_base, proj_google_base, proj_meta_base, new_g, new_m, sat_factor)
         
-        df_prev = pd.DataFrame(rows)
+        df_prev = pd.DataFrame({
+            'Data': future_dates,
+            'Periodo': week_range_labels(future_dates).to_numpy(),
+            'Google Previsto': new_g,
+            'Meta Previsto': new_m,
+            'Fatturato Previsto': f_sales,
+            'Ordini Previsti': f_sales / be_aov
+        })
         df_prev['Spesa Totale'] = df_prev['Google Previsto'] + df_prev['Meta Previsto']
         df_prev['MER Previsto'] = df_prev['Fatturato Previsto'] / df_prev['Spesa Totale']
         # Calcolo CoS Previsto
@@ -719,7 +1782,7 @@ if df is not None:
         # --- 5.2 CALCOLO ML AVANZATO ---
         def run_ml_forecast(df_hist, periods, g_scale, m_scale, sat, stress_mult):
             # Prepariamo le feature
-            df_train = df_hist.copy()
+            df_train = add_model_features(df_hist)
             
             # Feature critiche: Solo i "DRIVER" (quello che conosciamo o possiamo stimare)
             features_list = ['Week_Sin', 'Week_Cos', col_google, col_meta, 'Lag_Sales_1', 'Lag_Sales_4']
@@ -741,190 +1804,209 @@ if df is not None:
                     df_train[f] = df_train[f].fillna(df_train[f].median())
             
             df_train = df_train.dropna(subset=['Fatturato_Netto'])
-            X = df_train[features_list]
-            y = df_train['Fatturato_Netto']
+            X = df_train[features_list].to_numpy(dtype=np.float64)
+            y = df_train['Fatturato_Netto'].to_numpy(dtype=np.float64)
             
-            # Modello più conservativo (meno profondità, più alberi)
-            model = RandomForestRegressor(n_estimators=300, max_depth=6, min_samples_leaf=3, random_state=42, n_jobs=-1)
-            model.fit(X, y)
+            # Modello più conservativo (meno profondità, più alberi) - in cache: gli slider non lo riallenano
+            model = fit_random_forest(frame_fingerprint(df_train, features_list + ['Fatturato_Netto']), X, y, **RF_FORECAST_PARAMS)
             
             # Per il futuro, usiamo le medie delle ultime 4 settimane (più reattive al post-festività)
             avg_metrics = {m: df_hist[m].tail(4).mean() for m in valid_drivers}
 
-            # Proiezione
-            curr_sales_lag1 = df_hist['Fatturato_Netto'].iloc[-1]
-            curr_sales_lag4 = df_hist['Fatturato_Netto'].iloc[-4]
-            ml_rows = []
-            
-            for i in range(len(df_prev)):
-                d = df_prev.iloc[i]['Data']
-                w = d.isocalendar().week
-                w_sin, w_cos = np.sin(2 * np.pi * w / 53), np.cos(2 * np.pi * w / 53)
-                
-                row_pred = {
-                    'Week_Sin': w_sin, 'Week_Cos': w_cos,
-                    col_google: df_prev.iloc[i]['Google Previsto'],
-                    col_meta: df_prev.iloc[i]['Meta Previsto'],
-                    'Lag_Sales_1': curr_sales_lag1, 'Lag_Sales_4': curr_sales_lag4
-                }
-                # Aggiungiamo le medie storiche per i parametri extra
-                row_pred.update(avg_metrics)
-                
-                X_pred = pd.DataFrame([row_pred])[features_list] # Assicura ordine colonne
-                # Applichiamo lo STRESS MULTIPLIER al risultato della previsione
-                pred_sales = model.predict(X_pred)[0] * stress_mult
-                
-                curr_sales_lag4 = curr_sales_lag1
-                curr_sales_lag1 = pred_sales
-                
-                ml_rows.append({'Data': d, 'Fatturato_ML': pred_sales, 'Spesa_ML': row_pred[col_google] + row_pred[col_meta]})
-            
-            return pd.DataFrame(ml_rows), model, valid_drivers
-
-        def run_prophet_forecast(df_hist, periods, g_scale, m_scale, seasonal_ref, extra_cols, stress_mult):
+            # Proiezione: feature esogene in una matrice (1 scenario × orizzonte × feature), lag aggiornati dal forecaster
+            w = df_prev['Data'].dt.isocalendar().week.to_numpy(dtype=np.float64)
+            exog_cols = {
+                'Week_Sin': np.sin(2 * np.pi * w / 53), 'Week_Cos': np.cos(2 * np.pi * w / 53),
+                col_google: df_prev['Google Previsto'].to_numpy(), col_meta: df_prev['Meta Previsto'].to_numpy(),
+                **avg_metrics
+            }
+            exog = np.zeros((1, len(df_prev), len(features_list)))
+            for j, f in enumerate(features_list):
+                if f in exog_cols: exog[0, :, j] = exog_cols[f]
+            
+            lag_idx = (features_list.index('Lag_Sales_1'), features_list.index('Lag_Sales_4'))
+            lag1, lag4 = df_hist['Fatturato_Netto'].iloc[-1], df_hist['Fatturato_Netto'].iloc[-4]
+            # Contesto per valutare altri piani di budget in batch (superficie di risposta): budget e lag si riempiono dopo
+            budget_idx = (features_list.index(col_google), features_list.index(col_meta))
+            exog_row = exog[0].copy()
+            exog_row[:, list(budget_idx)] = 0.0
+            rf_ctx = (model, exog_row, lag_idx, budget_idx, lag1, lag4)
+            pred_sales = recursive_rf_forecast(model, exog, lag_idx, lag1, lag4, stress_mult)[0]
+            
+            df_ml_out = pd.DataFrame({'Data': df_prev['Data'], 'Fatturato_ML': pred_sales, 'Spesa_ML': exog_cols[col_google] + exog_cols[col_meta]})
+            return df_ml_out, model, valid_drivers, rf_ctx
+
+        def prophet_frame(df_hist, extra_cols):
             # Filtriamo extra_cols per usare solo i driver (evitiamo overfitting su Conversion Value)
             drivers_only = [c for c in extra_cols if c not in ['Conversions Value', 'Orders', 'Items', 'Returns', 'Website Purchases Conversion Value']]
             
             # Prophet con Regressori + Configurazione per serie storiche lunghe
             df_p = df_hist[['Data_Interna', 'Fatturato_Netto', col_google, col_meta] + drivers_only].copy()
             mapping = {'Data_Interna': 'ds', 'Fatturato_Netto': 'y', col_google: 'google', col_meta: 'meta'}
-            df_p = df_p.rename(columns=mapping)
+            return df_p.rename(columns=mapping), drivers_only
+
+        def run_prophet_forecast(df_hist, periods, g_scale, m_scale, base_plan, extra_cols, stress_mult):
+            df_p, drivers_only = prophet_frame(df_hist, extra_cols)
             
             # Changepoint prior scale: 0.05 è bilanciato. Se troppo alto segue troppo i picchi, se troppo basso è troppo rigido.
-            m = Prophet(
-                yearly_seasonality=True, 
-                weekly_seasonality=True, 
-                daily_seasonality=False,
-                changepoint_prior_scale=0.08, # Leggermente più flessibile per catturare trend pluriennali
-                seasonality_prior_scale=10.0
-            )
-            m.add_regressor('google')
-            m.add_regressor('meta')
-            for exc in drivers_only:
-                m.add_regressor(exc)
-            
-            m.add_country_holidays(country_name='IT')
-            m.fit(df_p)
+            # Configurazione in PROPHET_PARAMS; il fit è in cache (processo + disco) per versione dei dati
+            regressors = tuple(['google', 'meta'] + drivers_only)
+            fingerprint = frame_fingerprint(df_p)
+            m = fit_prophet(fingerprint, df_p, regressors)
             
             future = m.make_future_dataframe(periods=int(periods*4.34), freq='W-MON')
             # Usiamo una media pesata (esponenziale) per i parametri business, 
             # dando più peso alle ultime 4-8 settimane rispetto a 6 anni fa.
             avg_metrics = {c: df_p[c].tail(8).mean() for c in drivers_only}
 
-            def fill_future(ds):
-                w = ds.isocalendar().week
-                base = seasonal_ref[seasonal_ref['Week_Num'] == w]
-                if base.empty: base = seasonal_ref.mean().to_frame().T
-                return base[col_google].values[0] * g_scale, base[col_meta].values[0] * m_scale
-
+            # Budget futuro base = piano base (scala 1x) di heuristic e RF: profilo stagionale × trend (base_plan: google, meta)
             hist_len = len(df_p)
-            future_budget = future.tail(len(future) - hist_len)['ds'].apply(fill_future)
+            base_g, base_m = base_plan
             
-            future['google'] = df_p['google'].tolist() + [x[0] for x in future_budget]
-            future['meta'] = df_p['meta'].tolist() + [x[1] for x in future_budget]
+            # Piano base (scala 1x): il predict completo si fa una volta sola ed è in cache
+            future['google'] = df_p['google'].tolist() + base_g.tolist()
+            future['meta'] = df_p['meta'].tolist() + base_m.tolist()
             for exc in drivers_only:
                 future[exc] = df_p[exc].tolist() + [avg_metrics[exc]] * (len(future) - hist_len)
             
-            forecast = m.predict(future)
-            # Applicazione Stress Multiplier alle colonne di Prophet
-            for col in ['yhat', 'yhat_lower', 'yhat_upper']:
-                forecast[col] = forecast[col] * stress_mult
+            base_fc, coefs = prophet_base_forecast(prophet_model_key(fingerprint, regressors), frame_fingerprint(future), m, future)
+            
+            # Scenario: solo lo storico resta invariato, il budget futuro scala con gli slider (+ Stress Multiplier)
+            pad = np.zeros(hist_len)
+            deltas = {'google': np.concatenate([pad, base_g * (g_scale - 1)]), 'meta': np.concatenate([pad, base_m * (m_scale - 1)])}
+            forecast = prophet_scenario_forecast(base_fc, coefs, deltas, stress_mult)
+            p_ctx = (base_fc.tail(len(future) - hist_len), coefs, base_g, base_m)
             
-            return forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']].tail(len(future) - hist_len), m, forecast[['ds', 'yhat']].head(hist_len)
+            return forecast.tail(len(future) - hist_len), m, p_ctx
 
-        def run_historical_backtest(df_hist, drivers, target_col, seasonal_df, prophet_hist_df=None):
-            backtest_results = []
+        def backtest_design(df_hist, drivers):
+            """Origini del walk-forward degli ultimi 12 mesi e matrici di train/test condivise da tutti i fold."""
+            df_hist = add_model_features(df_hist).sort_values('Data_Interna', kind='stable').reset_index(drop=True)
             last_date = df_hist['Data_Interna'].max()
             start_backtest = last_date - pd.DateOffset(months=12)
-            test_dates = df_hist[df_hist['Data_Interna'] > start_backtest]['Data_Interna'].unique()
-            
-            for d in test_dates:
-                d = pd.to_datetime(d)
-                train_data = df_hist[df_hist['Data_Interna'] < d].copy()
-                if len(train_data) < 20: continue 
-                
-                feat_bt = ['Week_Sin', 'Week_Cos', col_google, col_meta, 'Lag_Sales_1', 'Lag_Sales_4'] + drivers
-                X_train = train_data[feat_bt].fillna(train_data[feat_bt].median(numeric_only=True))
-                y_train = train_data['Fatturato_Netto']
-                
-                # Modello potenziato per riflettere le performance reali dell'app
-                bm = RandomForestRegressor(n_estimators=200, max_depth=6, min_samples_leaf=3, random_state=42, n_jobs=-1)
-                bm.fit(X_train, y_train)
-                
-                actual_row = df_hist[df_hist['Data_Interna'] == d].iloc[0]
-                X_test = pd.DataFrame([{
-                    'Week_Sin': np.sin(2 * np.pi * d.isocalendar().week / 53),
-                    'Week_Cos': np.cos(2 * np.pi * d.isocalendar().week / 53),
-                    col_google: actual_row[col_google],
-                    col_meta: actual_row[col_meta],
-                    'Lag_Sales_1': train_data['Fatturato_Netto'].iloc[-1],
-                    'Lag_Sales_4': train_data['Fatturato_Netto'].iloc[-4] if len(train_data) > 4 else train_data['Fatturato_Netto'].iloc[-1]
-                }])
-                for drv in drivers: X_test[drv] = actual_row[drv]
-                
-                pred_ml = bm.predict(X_test)[0]
-                
-                # 1. Heuristic (Stagionalità Media)
-                w_num = d.isocalendar().week
-                h_row = seasonal_df[seasonal_df['Week_Num'] == w_num]
-                pred_h = h_row['Fatturato_Netto'].values[0] if not h_row.empty else seasonal_df['Fatturato_Netto'].mean()
-                
-                # 3. Prophet
-                pred_p = pred_ml # Fallback
-                if prophet_hist_df is not None:
-                    p_val = prophet_hist_df[pd.to_datetime(prophet_hist_df['ds']).dt.date == d.date()]['yhat'].values
-                    pred_p = p_val[0] if len(p_val) > 0 else pred_ml
-                
-                # 4. Ensemble (Media)
-                pred_ens = (pred_ml + pred_p) / 2
-
-                actual = actual_row['Fatturato_Netto']
-                
-                # Calcolo Errori per trovare il Vincente
-                errs = {
-                    'Heuristic': abs(pred_h - actual),
-                    'Random Forest': abs(pred_ml - actual),
-                    'Prophet': abs(pred_p - actual),
-                    'Ensemble': abs(pred_ens - actual)
-                }
-                winner = min(errs, key=errs.get)
-                
-                # Calcolo Accuratezze Individuali
-                def get_acc(p, a): return max(0, 1 - (abs(p - a) / a)) if a > 0 else 0
-                
-                backtest_results.append({
-                    'Anno': d.year,
-                    'Mese': d.strftime('%b'),
-                    'Mese_Num': d.month,
-                    'Vincente': winner,
-                    # Ensemble (Principale)
-                    'Accuratezza': get_acc(pred_ens, actual),
-                    'Errore_Euro': abs(pred_ens - actual),
-                    # Heuristic
-                    'Acc_Heuristic': get_acc(pred_h, actual),
-                    'Err_Heuristic': abs(pred_h - actual),
-                    # ML
-                    'Acc_ML': get_acc(pred_ml, actual),
-                    'Err_ML': abs(pred_ml - actual),
-                    # Prophet
-                    'Acc_Prophet': get_acc(pred_p, actual),
-                    'Err_Prophet': abs(pred_p - actual)
-                })
             
-            return pd.DataFrame(backtest_results) if backtest_results else None
+            # Un fold per data: train = righe precedenti (prefisso, storico ordinato), test = prima riga della data
+            dates = df_hist['Data_Interna'].to_numpy()
+            test_pos = np.flatnonzero((dates > np.datetime64(start_backtest)) & np.r_[True, dates[1:] != dates[:-1]])
+            n_trains = np.searchsorted(dates, dates[test_pos], side='left')
+            keep = n_trains >= BACKTEST_MIN_TRAIN
+            test_pos, n_trains = test_pos[keep], n_trains[keep]
+            if len(test_pos) == 0: return None
+            
+            feat_bt = ['Week_Sin', 'Week_Cos', col_google, col_meta, 'Lag_Sales_1', 'Lag_Sales_4'] + drivers
+            X = df_hist[feat_bt].to_numpy(dtype=np.float64)
+            y = df_hist['Fatturato_Netto'].to_numpy(dtype=np.float64)
+            
+            # Riga di test: stagionalità della data, spesa e driver reali, lag dall'ultimo dato di train
+            d_idx = pd.DatetimeIndex(dates[test_pos])
+            w = d_idx.isocalendar().week.to_numpy(dtype=np.float64)
+            X_test = X[test_pos].copy()
+            X_test[:, 0], X_test[:, 1] = np.sin(2 * np.pi * w / 53), np.cos(2 * np.pi * w / 53)
+            X_test[:, 4] = y[n_trains - 1]
+            X_test[:, 5] = np.where(n_trains > 4, y[n_trains - 4], y[n_trains - 1])
+            key = hashlib.sha1(b''.join(np.ascontiguousarray(a).tobytes() for a in (dates, X, y, n_trains, X_test))).hexdigest()
+            return {'X': X, 'y': y, 'n_trains': n_trains, 'X_test': X_test, 'test_pos': test_pos, 'actual': y[test_pos],
+                    'dates': d_idx, 'all_dates': dates, 'week': w, 'key': key, 'features': feat_bt, 'frame': df_hist}
+
+        def run_historical_backtest(df_hist, drivers, target_col, season_ref, cadence=None, persist=False):
+            design = backtest_design(df_hist, drivers)
+            if design is None: return None
+            d_idx, w, actual, test_pos = design['dates'], design['week'], design['actual'], design['test_pos']
+            cadence = cadence or {}
+            warm = cadence.get('warm_start', False)
+            n_fits = refit_prefixes(design['all_dates'], test_pos, **cadence)
+            p_refit = max(PROPHET_BACKTEST_REFIT_EVERY, cadence.get('refit_every', 1))
+            p_fits = refit_prefixes(design['all_dates'], test_pos, refit_every=p_refit)
+            df_p, drivers_only = prophet_frame(design['frame'], drivers)
+            regressors = tuple(['google', 'meta'] + drivers_only)
+            
+            # Chiave del fold: configurazione + storico fino all'origine + prefisso di fit (warm-start: anche l'inizio catena)
+            config = hashlib.sha1(repr((
+                sorted(RF_BACKTEST_PARAMS.items()), sorted(cadence.items()), design['features'], regressors,
+                sorted(PROPHET_PARAMS.items()), PROPHET_HOLIDAYS, prophet_version, p_refit
+            )).encode()).hexdigest()
+            prefix = prefix_hashes(design['frame'][['Data_Interna'] + design['features'] + ['Fatturato_Netto']])
+            chain = prefix[test_pos[0] + 1] if warm else ''
+            fold_keys = np.array([
+                hashlib.sha1(f"{config}|{prefix[pos + 1]}|{n}|{pn}|{chain}".encode()).hexdigest()
+                for pos, n, pn in zip(test_pos, n_fits, p_fits)
+            ])
+            
+            # Previsioni già in archivio; si calcolano solo le origini nuove (warm-start: tutta la catena)
+            store_key = prefix[BACKTEST_MIN_TRAIN]
+            store = load_backtest_store(store_key) if persist else pd.DataFrame(columns=BACKTEST_STORE_COLUMNS)
+            stored = store.drop_duplicates('fold_key').set_index('fold_key')
+            cached = np.isin(fold_keys, stored.index.to_numpy())
+            pred_ml = np.full(len(test_pos), np.nan)
+            pred_p = np.full(len(test_pos), np.nan)
+            pred_ml[cached] = stored.loc[fold_keys[cached], 'pred_ml'].to_numpy(dtype=np.float64)
+            pred_p[cached] = stored.loc[fold_keys[cached], 'pred_p'].to_numpy(dtype=np.float64)
+            todo = np.ones(len(test_pos), dtype=bool) if warm and not cached.all() else ~cached
+            
+            if todo.any():
+                # Modello potenziato per riflettere le performance reali dell'app - fold in parallelo, cadenza di refit da sidebar
+                pred_ml[todo] = run_backtest_folds(design['X'], design['y'], n_fits[todo], design['X_test'][todo], warm_start=warm)
+                # 3. Prophet - fuori campione: un fit ogni PROPHET_BACKTEST_REFIT_EVERY settimane (o la cadenza RF se più rada)
+                pred_p[todo] = run_prophet_backtest(df_p, regressors, p_fits[todo], test_pos[todo])
+            
+            # Archivio: fold della finestra corrente + altre configurazioni ancora in finestra (via le origini uscite e i fold superati)
+            if persist:
+                origins = pd.Series(d_idx)
+                keep = (pd.to_datetime(store['origin']) >= origins.min()) & (store['config'] != config)
+                current = pd.DataFrame({'fold_key': fold_keys, 'config': config, 'origin': origins, 'pred_ml': pred_ml, 'pred_p': pred_p})
+                store_new = pd.concat([store[keep], current], ignore_index=True) if keep.any() else current
+                if todo.any() or len(store_new) != len(store):
+                    save_backtest_store(store_key, store_new)
+            
+            # 1. Heuristic (Stagionalità Media)
+            pred_h = season_ref[w.astype(np.int64), 0]
+            
+            pred_p = np.where(np.isnan(pred_p), pred_ml, pred_p) # Fallback
+            
+            # 4. Ensemble (Media)
+            pred_ens = (pred_ml + pred_p) / 2
+            
+            # Calcolo Errori per trovare il Vincente (a parità vince il primo, come min su dict)
+            model_names = np.array(['Heuristic', 'Random Forest', 'Prophet', 'Ensemble'])
+            preds = np.column_stack([pred_h, pred_ml, pred_p, pred_ens])
+            errs = np.abs(preds - actual[:, None])
+            
+            # Calcolo Accuratezze Individuali
+            acc = forecast_accuracy(preds, actual[:, None])
+            
+            return pd.DataFrame({
+                'Anno': d_idx.year,
+                'Mese': d_idx.strftime('%b'),
+                'Mese_Num': d_idx.month,
+                'Vincente': model_names[errs.argmin(axis=1)],
+                # Ensemble (Principale)
+                'Accuratezza': acc[:, 3],
+                'Errore_Euro': errs[:, 3],
+                # Heuristic
+                'Acc_Heuristic': acc[:, 0],
+                'Err_Heuristic': errs[:, 0],
+                # ML
+                'Acc_ML': acc[:, 1],
+                'Err_ML': errs[:, 1],
+                # Prophet
+                'Acc_Prophet': acc[:, 2],
+                'Err_Prophet': errs[:, 2]
+            })
 
-        with st.spinner("🧠 Calcolo algoritmi predittivi e analisi in corso..."):
-            df_ml, ml_model, businesses_found = run_ml_forecast(df, mesi_prev, m_google, m_meta, sat_factor, stress_total_mult)
-            df_prophet, p_model, df_prophet_hist = run_prophet_forecast(df, mesi_prev, m_google, m_meta, seasonal, businesses_found, stress_total_mult)
-            df_backtest = run_historical_backtest(df, businesses_found, 'Fatturato_Netto', seasonal, df_prophet_hist)
+        def run_forecast_models():
+            """Modelli ML e Prophet sullo scenario corrente (fit e previsione base in cache): solo nei tab che li usano."""
+            df_ml, ml_model, drivers, rf_ctx = run_ml_forecast(df, mesi_prev, m_google, m_meta, sat_factor, stress_total_mult)
+            df_prophet, p_model, p_ctx = run_prophet_forecast(df, mesi_prev, m_google, m_meta, (proj_google_base, proj_meta_base), drivers, stress_total_mult)
+            return df_ml, ml_model, drivers, rf_ctx, df_prophet, p_model, p_ctx
         
         # --- 6. VISUALIZZAZIONE TABS ---
+        # Tab con stato: ogni rerun esegue solo il tab aperto (meteo, backtest, scoring e grafici degli altri tab restano fermi)
         tabs = st.tabs([
             "🔮 ML Forecasting", "🔵 Analisi Google Ads", 
             "🔵 Analisi Meta Ads", "🧪 Market Elasticity Hub", "📊 Analisi Resi", 
             "🗂️ Dati CSV", "🧠 Insight AI", "🎯 Ottimizzazione", "🏥 Health Check",
             "🌍 Market Intelligence"
-        ])
+        ], key="main_tabs", on_change="rerun")
         
         # COLORI
         DARKEST_BLUE = '#000080'  
@@ -934,1146 +2016,1149 @@ if df is not None:
         
 
         with tabs[0]:
-            st.info("**Cosa fa:** Confronta tre metodologie (Heuristic, Machine Learning, Facebook Prophet) per prevedere il fatturato futuro basato sui piani di budget.  \n**Logica:** Allena gli algoritmi sui dati storici per capire l'impatto della spesa pubblicitaria e della stagionalità.")
-            st.header("🔮 Advanced AI Forecasting: Battle of Models")
-            
-            # --- ALERT STRESS TEST ATTIVO ---
-            if stress_total_mult < 1.0:
-                st.error(f"""
-                ### 🚨 SCENARIO DI CRISI ATTIVO
-                **Stai simulando un mercato ostile:**
-                *   Hai ipotizzato un calo dei ricavi del **{(1-stress_total_mult)*100:.0f}%** dovuto a costi pubblicitari più alti o conversioni più basse.
-                *   I numeri che vedi qui sotto sono **estremamente conservativi** per prepararti al peggiore dei casi.
-                """)
-            
-            # --- NOTA DINAMICA SULL'ACCURATEZZA ---
-            if df_backtest is not None:
-                # Calcoliamo la media dell'accuratezza (escludendo i NaN)
-                avg_accuracy = df_backtest['Accuratezza'].mean()
-                
-                if avg_accuracy >= 0.85:
-                    status_icon, status_label, status_color = "✅", "ALTA", "success"
-                    status_text = "Il modello ha trovato pattern solidi e ricorrenti. Previsioni molto affidabili per decisioni di budget a lungo termine."
-                    st_func = st.success
-                elif avg_accuracy >= 0.70:
-                    status_icon, status_label, status_color = "🟠", "MEDIA", "warning"
-                    status_text = "Il business ha una buona stabilità, ma ci sono rumori statistici o fattori esterni (es. promozioni variabili) che l'IA non può prevedere con certezza totale."
-                    st_func = st.warning
-                else:
-                    status_icon, status_label, status_color = "🚨", "BASSA", "error"
-                    status_text = "Alta volatilità rilevata. Il business potrebbe essere influenzato pesantemente da sconti spot, flash sales o mancare di variabili chiave (es. database email/SMS). Usa i dati con cautela."
-                    st_func = st.error
-
-                st_func(f"**{status_icon} Affidabilità IA: {status_label} ({avg_accuracy:.1%})**  \n{status_text}")
-            else:
-                st.info("📊 **Affidabilità in calcolo:** Carica uno storico più lungo (almeno 6-8 mesi) per generare il bollino di qualità dell'IA.")
-
-            with st.expander("📖 Guida ai Modelli: Cosa sto leggendo?"):
-                st.markdown("""
-                In questa sezione, tre diverse "intelligenze" analizzano i tuoi dati per prevedere il futuro. Ognuna ha un punto di vista differente:
-                
-                1.  **🔸 Heuristic (Stagionalità Media):** 
-                    *   **Cos'è:** Un modello basato sulla media storica. 
-                    *   **Cosa guarda:** Ripete semplicemente l'andamento degli anni passati. 
-                    *   **Limiti:** Non capisce se aumenti il budget o se il mercato è cambiato. È la tua "linea di base".
-                
-                2.  **💜 ML: Random Forest (Budget Focus):** 
-                    *   **Cos'è:** Un algoritmo di Machine Learning puro. 
-                    *   **Cosa guarda:** È molto sensibile alla **spesa pubblicitaria**. Cerca di capire: *"Se spendo 1€ in più su Meta, quanto fatturato extra ottengo?"*.
-                    *   **Punto di forza:** È il migliore per simulare scenari di scalabilità del budget.
-                
-                3.  **🔹 AI: Facebook Prophet (Season Focus):** 
-                    *   **Cos'è:** Un modello avanzato creato da Meta per i dati di business. 
-                    *   **Cosa guarda:** Eccelle nel trovare **pattern ciclici** (es. ogni lunedì vendi di più) e l'effetto delle **festività** (Black Friday, Natale).
-                    *   **Punto di forza:** Include la *"nuvola di incertezza"*, mostrandoti il rischio della previsione.
-                
-                4.  **📉 Media Ensemble:** 
-                    *   **La verità sta nel mezzo:** Spesso la previsione più accurata è la media tra il focus sul budget (ML) e il focus sulla stagionalità (Prophet).
-                """)
-
-            st.caption("Confronto tra Random Forest (più sensibile al budget) e Facebook Prophet (più sensibile a stagionalità e festività).")
-            
-            col_ml1, col_ml2 = st.columns([2, 1])
-            
-            with col_ml1:
-                fig_ml, ax_ml = plt.subplots(figsize=(10, 5))
-                # Storico Reale con markers annuali alla base per "timeline" e linea grigia
-                ax_ml.plot(df['Data_Interna'], df['Fatturato_Netto'], label='Storico Reale', color='gray', alpha=0.4)
-                
-                # Markers e Label Fatturato Annuo alla base per Timeline
-                annual_summary = df.groupby('Year').agg({'Data_Interna': 'min', 'Fatturato_Netto': 'sum'})
-                for yr, row in annual_summary.iterrows():
-                    # Posizione alla base
-                    base_y = df['Fatturato_Netto'].min() * 0.1
-                    ax_ml.scatter(row['Data_Interna'], base_y, s=60, color='gray', alpha=0.4, marker='|')
-                    
-                    # Formattazione K/M compatta
-                    val = row['Fatturato_Netto']
-                    label_val = f"€ {val/1e6:.1f}M" if val >= 1e6 else f"€ {val/1e3:.0f}k"
-                    
-                    # Testo sopra la tacca
-                    ax_ml.text(row['Data_Interna'], base_y * 1.8, label_val, 
-                              color='gray', fontsize=7, ha='center', va='bottom', fontweight='bold', alpha=0.7)
-                
-                # Modello Heuristic
-                ax_ml.plot(df_prev['Data'], df_prev['Fatturato Previsto'], label='Heuristic (Stag. Media)', color=ORANGE_COLOR, linestyle=':')
-                
-                # Modello Random Forest
-                ax_ml.plot(df_ml['Data'], df_ml['Fatturato_ML'], label='ML: Random Forest (Budget Focus)', color='#9b59b6', linewidth=2)
-                
-                # Modello Prophet
-                ax_ml.plot(df_prophet['ds'], df_prophet['yhat'], label='AI: Facebook Prophet (Season Focus)', color='#3498db', linewidth=2)
-                ax_ml.fill_between(df_prophet['ds'], df_prophet['yhat_lower'], df_prophet['yhat_upper'], color='#3498db', alpha=0.15, label='Incertezza Prophet')
-                
-                ax_ml.set_title("Proiezione Multimodale")
-                ax_ml.legend(fontsize=8)
-                st.pyplot(fig_ml)
-            
-            with col_ml2:
-                st.subheader("💡 Analisi Strategica AI")
-                
-                # Calcolo della Previsione Combinata (Ensemble)
-                rf_total = df_ml['Fatturato_ML'].sum()
-                p_total = df_prophet['yhat'].sum()
-                ensemble_total = (rf_total + p_total) / 2
-                
-                st.metric("Fatturato Totale Previsto (Ensemble)", f"€ {ensemble_total:,.0f}", 
-                          help="Questa è la media ponderata tra l'impatto del budget e la stagionalità. È il dato più affidabile per pianificare il cashflow.")
-                
-                diff_pct = abs(rf_total - p_total) / min(rf_total, p_total)
-                optimistic_model = "Machine Learning (Budget Focus)" if rf_total > p_total else "Prophet (Stagionalità)"
-                cautious_model = "Prophet (Stagionalità)" if rf_total > p_total else "Machine Learning (Budget Focus)"
+            if tabs[0].open:
+                with st.spinner("🧠 Calcolo algoritmi predittivi e analisi in corso..."):
+                    df_ml, ml_model, businesses_found, rf_ctx, df_prophet, p_model, p_ctx = run_forecast_models()
+                    df_backtest = run_historical_backtest(df, businesses_found, 'Fatturato_Netto', season_prof, BACKTEST_CADENCES[bt_cadence_label], persist=True)
+                
+                st.info("**Cosa fa:** Confronta tre metodologie (Heuristic, Machine Learning, Facebook Prophet) per prevedere il fatturato futuro basato sui piani di budget.  \n**Logica:** Allena gli algoritmi sui dati storici per capire l'impatto della spesa pubblicitaria e della stagionalità.")
+                st.header("🔮 Advanced AI Forecasting: Battle of Models")
+                
+                # --- ALERT STRESS TEST ATTIVO ---
+                if stress_total_mult < 1.0:
+                    st.error(f"""
+                    ### 🚨 SCENARIO DI CRISI ATTIVO
+                    **Stai simulando un mercato ostile:**
+                    *   Hai ipotizzato un calo dei ricavi del **{(1-stress_total_mult)*100:.0f}%** dovuto a costi pubblicitari più alti o conversioni più basse.
+                    *   I numeri che vedi qui sotto sono **estremamente conservativi** per prepararti al peggiore dei casi.
+                    """)
                 
-                # Integriamo l'accuratezza storica nel verdetto di consenso
-                is_unstable = avg_accuracy < 0.70 if 'avg_accuracy' in locals() else False
-
-                if diff_pct < 0.15:
-                    if not is_unstable:
-                        st.success("🟢 **Consenso Elevato:** I modelli concordano. La previsione è molto solida.")
+                # --- NOTA DINAMICA SULL'ACCURATEZZA ---
+                if df_backtest is not None:
+                    # Calcoliamo la media dell'accuratezza (escludendo i NaN)
+                    avg_accuracy = df_backtest['Accuratezza'].mean()
+                    
+                    if avg_accuracy >= 0.85:
+                        status_icon, status_label, status_color = "✅", "ALTA", "success"
+                        status_text = "Il modello ha trovato pattern solidi e ricorrenti. Previsioni molto affidabili per decisioni di budget a lungo termine."
+                        st_func = st.success
+                    elif avg_accuracy >= 0.70:
+                        status_icon, status_label, status_color = "🟠", "MEDIA", "warning"
+                        status_text = "Il business ha una buona stabilità, ma ci sono rumori statistici o fattori esterni (es. promozioni variabili) che l'IA non può prevedere con certezza totale."
+                        st_func = st.warning
                     else:
-                        st.warning("🟡 **Consenso Fragile:** I modelli concordano sulla cifra, ma l'alta volatilità storica (vedasi a sinistra) suggerisce comunque cautela nell'esecuzione.")
-                elif diff_pct < 0.35:
-                    st.warning(f"🟡 **Divergenza Moderata ({diff_pct:.1%}):** Il modello **{optimistic_model}** è più ottimista rispetto a **{cautious_model}**. Questa è una classica forchetta di mercato.")
+                        status_icon, status_label, status_color = "🚨", "BASSA", "error"
+                        status_text = "Alta volatilità rilevata. Il business potrebbe essere influenzato pesantemente da sconti spot, flash sales o mancare di variabili chiave (es. database email/SMS). Usa i dati con cautela."
+                        st_func = st.error
+
+                    st_func(f"**{status_icon} Affidabilità IA: {status_label} ({avg_accuracy:.1%})**  \n{status_text}")
                 else:
-                    st.error(f"🚨 **Alta Discrepanza ({diff_pct:.1%}):** C'è una forte tensione tra l'andamento recente (Momentum) e lo storico degli anni passati.")
-                
-                st.subheader("Feature Importance (RF)")
-                importances = ml_model.feature_importances_
-                
-                # Creiamo una lista leggibile delle feature presenti
-                base_features = ['Stag. (S)', 'Stag. (C)', 'Budget G.', 'Budget M.', 'Lag 1w', 'Lag 4w']
-                all_feature_names = base_features + [b.replace('Website Purchases ', 'Meta ').replace('Conversion Value', 'Val. Conv.') for b in businesses_found]
-                
-                feat_df = pd.DataFrame({'Feature': all_feature_names, 'Importanza': importances}).sort_values('Importanza', ascending=True)
-                fig_feat, ax_feat = plt.subplots(figsize=(5, 8))
-                ax_feat.barh(feat_df['Feature'], feat_df['Importanza'], color='#9b59b6')
-                ax_feat.set_title("Cosa guida veramente il tuo business?", fontsize=10)
-                ax_feat.tick_params(axis='both', which='major', labelsize=8)
-                st.pyplot(fig_feat)
-
-                with st.expander("📖 Legenda: Cosa significano queste voci?"):
+                    st.info("📊 **Affidabilità in calcolo:** Carica uno storico più lungo (almeno 6-8 mesi) per generare il bollino di qualità dell'IA.")
+
+                with st.expander("📖 Guida ai Modelli: Cosa sto leggendo?"):
                     st.markdown("""
-                    Il grafico mostra quali variabili pesano di più nel calcolo delle previsioni dell'IA:
+                    In questa sezione, tre diverse "intelligenze" analizzano i tuoi dati per prevedere il futuro. Ognuna ha un punto di vista differente:
+                    
+                    1.  **🔸 Heuristic (Stagionalità Media):** 
+                        *   **Cos'è:** Un modello basato sulla media storica. 
+                        *   **Cosa guarda:** Ripete semplicemente l'andamento degli anni passati. 
+                        *   **Limiti:** Non capisce se aumenti il budget o se il mercato è cambiato. È la tua "linea di base".
                     
-                    *   **🌊 Stag. (S) / (C):** Componenti stagionali (Seno/Coseno). Se sono alte, il tuo business è influenzato ciclicamente dal periodo dell'anno.
-                    *   **💰 Budget G. / M.:** Impatto della spesa pubblicitaria su Google e Meta. Indicano quanto il fatturato "risponde" ai tuoi investimenti.
-                    *   **⏳ Lag 1w / 4w:** Inerzia del fatturato (1 sett. e 4 sett. fa). Se sono alte, il tuo business è molto stabile e basato sul brand o sulla retention.
-                    *   **🎯 Val. Conv. / Altro:** Parametri qualitativi (es. valore di conversione storico) rilevati nel tuo CSV.
+                    2.  **💜 ML: Random Forest (Budget Focus):** 
+                        *   **Cos'è:** Un algoritmo di Machine Learning puro. 
+                        *   **Cosa guarda:** È molto sensibile alla **spesa pubblicitaria**. Cerca di capire: *"Se spendo 1€ in più su Meta, quanto fatturato extra ottengo?"*.
+                        *   **Punto di forza:** È il migliore per simulare scenari di scalabilità del budget.
+                    
+                    3.  **🔹 AI: Facebook Prophet (Season Focus):** 
+                        *   **Cos'è:** Un modello avanzato creato da Meta per i dati di business. 
+                        *   **Cosa guarda:** Eccelle nel trovare **pattern ciclici** (es. ogni lunedì vendi di più) e l'effetto delle **festività** (Black Friday, Natale).
+                        *   **Punto di forza:** Include la *"nuvola di incertezza"*, mostrandoti il rischio della previsione.
+                    
+                    4.  **📉 Media Ensemble:** 
+                        *   **La verità sta nel mezzo:** Spesso la previsione più accurata è la media tra il focus sul budget (ML) e il focus sulla stagionalità (Prophet).
                     """)
 
-            st.divider()
-            st.subheader("🛡️ Audit di Affidabilità AI: Backtesting Report")
-            st.caption("Analisi storica delle performance: l'AI ha sfidato i dati reali degli ultimi 12 mesi per misurare la sua precisione.")
-            
-            if df_backtest is not None:
-                # Tab per ogni modello
-                audit_tabs = st.tabs(["🧩 Ensemble (Media)", "💜 Random Forest (ML)", "🔹 Facebook Prophet (AI)", "🔸 Heuristic (Stagionalità)"])
+                st.caption("Confronto tra Random Forest (più sensibile al budget) e Facebook Prophet (più sensibile a stagionalità e festività).")
                 
-                # Setup per il loop dei tab
-                model_configs = [
-                    {"tab": audit_tabs[0], "acc_col": "Accuratezza", "err_col": "Errore_Euro", "name": "Ensemble"},
-                    {"tab": audit_tabs[1], "acc_col": "Acc_ML", "err_col": "Err_ML", "name": "Random Forest"},
-                    {"tab": audit_tabs[2], "acc_col": "Acc_Prophet", "err_col": "Err_Prophet", "name": "Prophet"},
-                    {"tab": audit_tabs[3], "acc_col": "Acc_Heuristic", "err_col": "Err_Heuristic", "name": "Heuristic"}
-                ]
-
-                def style_acc(val):
-                    if pd.isna(val): return ''
-                    color = '#27ae60' if val > 0.9 else '#f39c12' if val > 0.8 else '#e74c3c'
-                    return f'color: {color}; font-weight: bold'
-
-                for config in model_configs:
-                    with config["tab"]:
-                        m_acc = df_backtest[config["acc_col"]].mean()
-                        m_err = df_backtest[config["err_col"]].mean()
-                        
-                        ca, cb = st.columns(2)
-                        ca.metric(f"Accuratezza {config['name']}", f"{m_acc:.1%}")
-                        cb.metric(f"Errore Medio (€)", f"€ {m_err:,.0f}")
+                col_ml1, col_ml2 = st.columns([2, 1])
+                
+                with col_ml1:
+                    fig_ml, ax_ml = plt.subplots(figsize=(10, 5))
+                    # Storico Reale con markers annuali alla base per "timeline" e linea grigia
+                    ax_ml.plot(df['Data_Interna'], df['Fatturato_Netto'], label='Storico Reale', color='gray', alpha=0.4)
+                    
+                    # Markers e Label Fatturato Annuo alla base per Timeline
+                    annual_summary = df.groupby('Year').agg({'Data_Interna': 'min', 'Fatturato_Netto': 'sum'})
+                    for yr, row in annual_summary.iterrows():
+                        # Posizione alla base
+                        base_y = df['Fatturato_Netto'].min() * 0.1
+                        ax_ml.scatter(row['Data_Interna'], base_y, s=60, color='gray', alpha=0.4, marker='|')
                         
-                        # Heatmap Accuratezza
-                        st.markdown(f"**📈 Accuratezza {config['name']} (%)**")
-                        p_acc = df_backtest.groupby(['Mese', 'Anno', 'Mese_Num'])[[config["acc_col"]]].mean().reset_index()
-                        p_acc = p_acc.pivot(index=['Mese_Num', 'Mese'], columns='Anno', values=config["acc_col"]).sort_index()
-                        st.dataframe(p_acc.style.format("{:.1%}") \
-                                   .applymap(style_acc), use_container_width=True)
+                        # Formattazione K/M compatta
+                        val = row['Fatturato_Netto']
+                        label_val = f"€ {val/1e6:.1f}M" if val >= 1e6 else f"€ {val/1e3:.0f}k"
                         
-                        # Tabella Errore
-                        st.markdown(f"**💶 Scostamento {config['name']} (€)**")
-                        p_err = df_backtest.groupby(['Mese', 'Anno', 'Mese_Num'])[[config["err_col"]]].mean().reset_index()
-                        p_err = p_err.pivot(index=['Mese_Num', 'Mese'], columns='Anno', values=config["err_col"]).sort_index()
-                        st.dataframe(p_err.style.format("€ {:,.0f}") \
-                                   .background_gradient(cmap='YlOrRd'), use_container_width=True)
-                
-                # --- SPIEGAZIONE METODOLOGICA (Richiesta Utente) ---
-                with st.expander("🧠 Scienza e Metodologia: Come arriviamo a questo numero?"):
-                    ens_acc = df_backtest['Accuratezza'].mean()
-                    ens_mae = df_backtest['Errore_Euro'].mean()
-                    st.markdown(f"""
-                    L'accuratezza del **{ens_acc:.1%}** non è una stima teorica, ma il risultato di un rigoroso processo di **Backtesting (Walk-forward Validation)**.
+                        # Testo sopra la tacca
+                        ax_ml.text(row['Data_Interna'], base_y * 1.8, label_val, 
+                                  color='gray', fontsize=7, ha='center', va='bottom', fontweight='bold', alpha=0.7)
                     
-                    ### 1. Il Processo di "Esame"
-                    Per ogni settimana dell'ultimo anno, l'IA ha "sfidato" se stessa:
-                    *   **Simulazione del Passato:** Si è posizionata in una data passata (es. Ottobre 2024), facendo finta di non conoscere il futuro.
-                    *   **Training Dinamico:** Si è allenata solo sui dati disponibili *prima* di quella data.
-                    *   **Previsione vs Realtà:** Ha previsto il fatturato usando i budget Ads reali di quel periodo e lo ha confrontato con l'incasso effettivo registrato nel tuo CSV.
+                    # Modello Heuristic
+                    ax_ml.plot(df_prev['Data'], df_prev['Fatturato Previsto'], label='Heuristic (Stag. Media)', color=ORANGE_COLOR, linestyle=':')
                     
-                    ### 2. I Due "Cervelli" (Modelli Ensemble)
-                    Il numero che vedi è la media di due diverse intelligenze che lavorano insieme:
-                    *   **💜 Random Forest (Il Muscolo):** Un algoritmo di Machine Learning avanzato che analizza l'impatto diretto del **Budget**. Capisce quanto ogni Euro investito su Google/Meta muove l'ago della bilancia.
-                    *   **🔹 Facebook Prophet (L'Orologio):** Un'IA statistica di Meta specializzata nella **Stagionalità**. Individua i cicli ricorrenti (giorni festivi, weekend, stagioni) che si ripetono ogni anno nel tuo business.
+                    # Modello Random Forest
+                    ax_ml.plot(df_ml['Data'], df_ml['Fatturato_ML'], label='ML: Random Forest (Budget Focus)', color='#9b59b6', linewidth=2)
                     
-                    ### 3. Cosa significa il Verdetto?
-                    *   **ALTA (>85%):** Business estremamente prevedibile. L'efficienza Ads è costante.
-                    *   **MEDIA (70-85%):** Caso tipico dell'E-commerce. L'IA cattura i trend principali, ma esistono "rumori" esterni (flash sales, promo email, stockout) che creano variazioni non tracciate.
-                    *   **BASSA (<70%):** Alta volatilità. Il business è guidato da fattori che non sono nel CSV.
+                    # Modello Prophet
+                    ax_ml.plot(df_prophet['ds'], df_prophet['yhat'], label='AI: Facebook Prophet (Season Focus)', color='#3498db', linewidth=2)
+                    ax_ml.fill_between(df_prophet['ds'], df_prophet['yhat_lower'], df_prophet['yhat_upper'], color='#3498db', alpha=0.15, label='Incertezza Prophet')
                     
-                    **Conclusione:** Un errore medio di **€ {ens_mae:,.0f}** indica la "forchetta" di rischio da tenere in conto quando pianifichi le tue prossime scalate di budget.
-                    """)
-                
-                # Tabella 3: Modello Vincente
-                st.markdown("#### 🏆 Modello Vincente (Battle of Models)")
-                pivot_win = df_backtest.groupby(['Mese', 'Anno', 'Mese_Num'])['Vincente'].first().reset_index()
-                pivot_win = pivot_win.pivot(index=['Mese_Num', 'Mese'], columns='Anno', values='Vincente').sort_index()
-                
-                def color_winner(val):
-                    if val == 'Ensemble': color = '#2ecc71'
-                    elif val == 'Random Forest': color = '#9b59b6'
-                    elif val == 'Prophet': color = '#3498db'
-                    else: color = '#e67e22' # Heuristic
-                    return f'background-color: {color}; color: white; font-weight: bold'
-
-                st.dataframe(pivot_win.style.applymap(color_winner), use_container_width=True)
+                    ax_ml.set_title("Proiezione Multimodale")
+                    ax_ml.legend(fontsize=8)
+                    st.pyplot(fig_ml)
                 
-                # Summary Vincitori
-                top_winner = df_backtest['Vincente'].mode()[0]
-                st.info(f"🏅 **Analisi Storica:** Il modello più preciso per il tuo business è stato **{top_winner}**. Questo significa che storicamente {'la media dei modelli' if top_winner=='Ensemble' else 'l impatto del budget' if top_winner=='Random Forest' else 'la stagionalità pura'} ha fornito i risultati più vicini alla realtà.")
-            else:
-                st.info("Carica uno storico più lungo (almeno 6 mesi) per generare il report di affidabilità.")
-
-            st.divider()
-            st.subheader("📅 Tabella Comparativa")
-            # Uniamo le previsioni per una tabella chiara
-            df_comp_final = df_ml.copy()
-            df_prophet_clean = df_prophet[['ds', 'yhat']].copy()
-            df_prophet_clean.columns = ['Data', 'Fatturato_Prophet']
-            
-            # NORMALIZZAZIONE DATE PER IL MERGE (Togliamo ore/minuti e allineiamo)
-            df_comp_final['Data'] = pd.to_datetime(df_comp_final['Data']).dt.normalize()
-            df_prophet_clean['Data'] = pd.to_datetime(df_prophet_clean['Data']).dt.normalize()
-            
-            # Usiamo un merge 'outer' o 'left' per sicurezza e debug
-            df_final_tab = pd.merge(df_comp_final, df_prophet_clean, on='Data', how='inner')
-            
-            if df_final_tab.empty:
-                st.warning("⚠️ Nota: I dati di Prophet e ML non sono allineati temporalmente. Prova a ricaricare i dati.")
-            else:
-                df_final_tab['Media_Ensemble'] = (df_final_tab['Fatturato_ML'] + df_final_tab['Fatturato_Prophet']) / 2
-                
-                st.dataframe(df_final_tab.style.format({
-                    'Fatturato_ML': '€ {:,.0f}', 
-                    'Fatturato_Prophet': '€ {:,.0f}', 
-                    'Media_Ensemble': '€ {:,.0f}',
-                    'Spesa_ML': '€ {:,.0f}'
-                }))
+                with col_ml2:
+                    st.subheader("💡 Analisi Strategica AI")
+                    
+                    # Calcolo della Previsione Combinata (Ensemble)
+                    rf_total = df_ml['Fatturato_ML'].sum()
+                    p_total = df_prophet['yhat'].sum()
+                    ensemble_total = (rf_total + p_total) / 2
+                    
+                    st.metric("Fatturato Totale Previsto (Ensemble)", f"€ {ensemble_total:,.0f}", 
+                              help="Questa è la media ponderata tra l'impatto del budget e la stagionalità. È il dato più affidabile per pianificare il cashflow.")
+                    
+                    diff_pct = abs(rf_total - p_total) / min(rf_total, p_total)
+                    optimistic_model = "Machine Learning (Budget Focus)" if rf_total > p_total else "Prophet (Stagionalità)"
+                    cautious_model = "Prophet (Stagionalità)" if rf_total > p_total else "Machine Learning (Budget Focus)"
+                    
+                    # Integriamo l'accuratezza storica nel verdetto di consenso
+                    is_unstable = avg_accuracy < 0.70 if 'avg_accuracy' in locals() else False
+
+                    if diff_pct < 0.15:
+                        if not is_unstable:
+                            st.success("🟢 **Consenso Elevato:** I modelli concordano. La previsione è molto solida.")
+                        else:
+                            st.warning("🟡 **Consenso Fragile:** I modelli concordano sulla cifra, ma l'alta volatilità storica (vedasi a sinistra) suggerisce comunque cautela nell'esecuzione.")
+                    elif diff_pct < 0.35:
+                        st.warning(f"🟡 **Divergenza Moderata ({diff_pct:.1%}):** Il modello **{optimistic_model}** è più ottimista rispetto a **{cautious_model}**. Questa è una classica forchetta di mercato.")
+                    else:
+                        st.error(f"🚨 **Alta Discrepanza ({diff_pct:.1%}):** C'è una forte tensione tra l'andamento recente (Momentum) e lo storico degli anni passati.")
+                    
+                    st.subheader("Feature Importance (RF)")
+                    importances = ml_model.feature_importances_
+                    
+                    # Creiamo una lista leggibile delle feature presenti
+                    base_features = ['Stag. (S)', 'Stag. (C)', 'Budget G.', 'Budget M.', 'Lag 1w', 'Lag 4w']
+                    all_feature_names = base_features + [b.replace('Website Purchases ', 'Meta ').replace('Conversion Value', 'Val. Conv.') for b in businesses_found]
+                    
+                    feat_df = pd.DataFrame({'Feature': all_feature_names, 'Importanza': importances}).sort_values('Importanza', ascending=True)
+                    fig_feat, ax_feat = plt.subplots(figsize=(5, 8))
+                    ax_feat.barh(feat_df['Feature'], feat_df['Importanza'], color='#9b59b6')
+                    ax_feat.set_title("Cosa guida veramente il tuo business?", fontsize=10)
+                    ax_feat.tick_params(axis='both', which='major', labelsize=8)
+                    st.pyplot(fig_feat)
+
+                    with st.expander("📖 Legenda: Cosa significano queste voci?"):
+                        st.markdown("""
+                        Il grafico mostra quali variabili pesano di più nel calcolo delle previsioni dell'IA:
+                        
+                        *   **🌊 Stag. (S) / (C):** Componenti stagionali (Seno/Coseno). Se sono alte, il tuo business è influenzato ciclicamente dal periodo dell'anno.
+                        *   **💰 Budget G. / M.:** Impatto della spesa pubblicitaria su Google e Meta. Indicano quanto il fatturato "risponde" ai tuoi investimenti.
+                        *   **⏳ Lag 1w / 4w:** Inerzia del fatturato (1 sett. e 4 sett. fa). Se sono alte, il tuo business è molto stabile e basato sul brand o sulla retention.
+                        *   **🎯 Val. Conv. / Altro:** Parametri qualitativi (es. valore di conversione storico) rilevati nel tuo CSV.
+                        """)
 
-            st.divider()
-            st.subheader("🧪 Simulatore di Precisione (Actual vs Forecast)")
-            st.write("Scegli una settimana dal tuo storico e confronta quello che è successo realmente con quello che l'AI avrebbe previsto.")
-            
-            # Selettore della settimana
-            date_options = df['Data_Interna'].dt.date.unique()
-            selected_test_date = st.selectbox(
-                "📅 Seleziona la settimana da verificare", 
-                options=date_options,
-                index=len(date_options)-1,
-                help="I dati di spesa e fatturato verranno pre-compilati automaticamente."
-            )
-            
-            # Recupera dati reali per quella data
-            actual_row = df[df['Data_Interna'].dt.date == selected_test_date].iloc[0]
-            
-            with st.container():
-                c_test1, c_test2, c_test3 = st.columns(3)
-                test_g = c_test1.number_input("Spesa Google (€)", value=float(actual_row[col_google]), step=100.0)
-                test_m = c_test2.number_input("Spesa Meta (€)", value=float(actual_row[col_meta]), step=100.0)
-                test_actual = c_test3.number_input("Fatturato Reale (€)", value=float(actual_row['Fatturato_Netto']), step=500.0)
+                st.divider()
+                st.subheader("🛡️ Audit di Affidabilità AI: Backtesting Report")
+                st.caption("Analisi storica delle performance: l'AI ha sfidato i dati reali degli ultimi 12 mesi per misurare la sua precisione.")
                 
-                if st.button("🚀 Avvia Test di Validazione AI"):
-                    # Trova l'indice per calcolare i LAG precedenti a quella data
-                    idx_list = df[df['Data_Interna'].dt.date == selected_test_date].index
-                    if not idx_list.empty:
-                        idx = idx_list[0]
-                        
-                        # 1. Prediction con Random Forest
-                        test_dt = pd.to_datetime(selected_test_date)
-                        curr_w = test_dt.isocalendar().week
-                        w_sin, w_cos = np.sin(2 * np.pi * curr_w / 53), np.cos(2 * np.pi * curr_w / 53)
-                        
-                        # Prendi i Lag basandoti sulla riga selezionata (usiamo dati disponibili PRIMA)
-                        l1 = df['Fatturato_Netto'].iloc[idx-1] if idx > 0 else actual_row['Fatturato_Netto']
-                        l4 = df['Fatturato_Netto'].iloc[idx-4] if idx > 3 else actual_row['Fatturato_Netto']
+                if df_backtest is not None:
+                    # Tab per ogni modello
+                    audit_tabs = st.tabs(["🧩 Ensemble (Media)", "💜 Random Forest (ML)", "🔹 Facebook Prophet (AI)", "🔸 Heuristic (Stagionalità)"])
+                    
+                    # Setup per il loop dei tab
+                    model_configs = [
+                        {"tab": audit_tabs[0], "acc_col": "Accuratezza", "err_col": "Errore_Euro", "name": "Ensemble"},
+                        {"tab": audit_tabs[1], "acc_col": "Acc_ML", "err_col": "Err_ML", "name": "Random Forest"},
+                        {"tab": audit_tabs[2], "acc_col": "Acc_Prophet", "err_col": "Err_Prophet", "name": "Prophet"},
+                        {"tab": audit_tabs[3], "acc_col": "Acc_Heuristic", "err_col": "Err_Heuristic", "name": "Heuristic"}
+                    ]
+
+                    def style_acc(val):
+                        if pd.isna(val): return ''
+                        color = '#27ae60' if val > 0.9 else '#f39c12' if val > 0.8 else '#e74c3c'
+                        return f'color: {color}; font-weight: bold'
+
+                    for config in model_configs:
+                        with config["tab"]:
+                            m_acc = df_backtest[config["acc_col"]].mean()
+                            m_err = df_backtest[config["err_col"]].mean()
+                            
+                            ca, cb = st.columns(2)
+                            ca.metric(f"Accuratezza {config['name']}", f"{m_acc:.1%}")
+                            cb.metric(f"Errore Medio (€)", f"€ {m_err:,.0f}")
+                            
+                            # Heatmap Accuratezza
+                            st.markdown(f"**📈 Accuratezza {config['name']} (%)**")
+                            p_acc = df_backtest.groupby(['Mese', 'Anno', 'Mese_Num'])[[config["acc_col"]]].mean().reset_index()
+                            p_acc = p_acc.pivot(index=['Mese_Num', 'Mese'], columns='Anno', values=config["acc_col"]).sort_index()
+                            st.dataframe(p_acc.style.format("{:.1%}") \
+                                       .applymap(style_acc), use_container_width=True)
+                            
+                            # Tabella Errore
+                            st.markdown(f"**💶 Scostamento {config['name']} (€)**")
+                            p_err = df_backtest.groupby(['Mese', 'Anno', 'Mese_Num'])[[config["err_col"]]].mean().reset_index()
+                            p_err = p_err.pivot(index=['Mese_Num', 'Mese'], columns='Anno', values=config["err_col"]).sort_index()
+                            st.dataframe(p_err.style.format("€ {:,.0f}") \
+                                       .background_gradient(cmap='YlOrRd'), use_container_width=True)
+                    
+                    # --- SPIEGAZIONE METODOLOGICA (Richiesta Utente) ---
+                    with st.expander("🧠 Scienza e Metodologia: Come arriviamo a questo numero?"):
+                        ens_acc = df_backtest['Accuratezza'].mean()
+                        ens_mae = df_backtest['Errore_Euro'].mean()
+                        st.markdown(f"""
+                        L'accuratezza del **{ens_acc:.1%}** non è una stima teorica, ma il risultato di un rigoroso processo di **Backtesting (Walk-forward Validation)**.
                         
-                        row_val = {
-                            'Week_Sin': w_sin, 'Week_Cos': w_cos, 
-                            col_google: test_g, col_meta: test_m, 
-                            'Lag_Sales_1': l1, 'Lag_Sales_4': l4
-                        }
-                        # Aggiungiamo i valori business reali di quella riga per il test
-                        for b in businesses_found:
-                            row_val[b] = actual_row[b]
-
-                        X_val = pd.DataFrame([row_val])
-                        rf_pred = ml_model.predict(X_val)[0]
+                        ### 1. Il Processo di "Esame"
+                        Per ogni settimana dell'ultimo anno, l'IA ha "sfidato" se stessa:
+                        *   **Simulazione del Passato:** Si è posizionata in una data passata (es. Ottobre 2024), facendo finta di non conoscere il futuro.
+                        *   **Training Dinamico:** Si è allenata solo sui dati disponibili *prima* di quella data.
+                        *   **Previsione vs Realtà:** Ha previsto il fatturato usando i budget Ads reali di quel periodo e lo ha confrontato con l'incasso effettivo registrato nel tuo CSV.
                         
-                        # 2. Prediction con Prophet
-                        test_dict_p = {'ds': test_dt, 'google': test_g, 'meta': test_m}
-                        for b in businesses_found:
-                            test_dict_p[b] = actual_row[b]
+                        ### 2. I Due "Cervelli" (Modelli Ensemble)
+                        Il numero che vedi è la media di due diverse intelligenze che lavorano insieme:
+                        *   **💜 Random Forest (Il Muscolo):** Un algoritmo di Machine Learning avanzato che analizza l'impatto diretto del **Budget**. Capisce quanto ogni Euro investito su Google/Meta muove l'ago della bilancia.
+                        *   **🔹 Facebook Prophet (L'Orologio):** Un'IA statistica di Meta specializzata nella **Stagionalità**. Individua i cicli ricorrenti (giorni festivi, weekend, stagioni) che si ripetono ogni anno nel tuo business.
                         
-                        test_df_p = pd.DataFrame([test_dict_p])
-                        p_pred = p_model.predict(test_df_p)['yhat'].values[0]
+                        ### 3. Cosa significa il Verdetto?
+                        *   **ALTA (>85%):** Business estremamente prevedibile. L'efficienza Ads è costante.
+                        *   **MEDIA (70-85%):** Caso tipico dell'E-commerce. L'IA cattura i trend principali, ma esistono "rumori" esterni (flash sales, promo email, stockout) che creano variazioni non tracciate.
+                        *   **BASSA (<70%):** Alta volatilità. Il business è guidato da fattori che non sono nel CSV.
                         
-                        avg_pred = (rf_pred + p_pred) / 2
+                        **Conclusione:** Un errore medio di **€ {ens_mae:,.0f}** indica la "forchetta" di rischio da tenere in conto quando pianifichi le tue prossime scalate di budget.
+                        """)
+                    
+                    # Tabella 3: Modello Vincente
+                    st.markdown("#### 🏆 Modello Vincente (Battle of Models)")
+                    pivot_win = df_backtest.groupby(['Mese', 'Anno', 'Mese_Num'])['Vincente'].first().reset_index()
+                    pivot_win = pivot_win.pivot(index=['Mese_Num', 'Mese'], columns='Anno', values='Vincente').sort_index()
+                    
+                    def color_winner(val):
+                        if val == 'Ensemble': color = '#2ecc71'
+                        elif val == 'Random Forest': color = '#9b59b6'
+                        elif val == 'Prophet': color = '#3498db'
+                        else: color = '#e67e22' # Heuristic
+                        return f'background-color: {color}; color: white; font-weight: bold'
+
+                    st.dataframe(pivot_win.style.applymap(color_winner), use_container_width=True)
+                    
+                    # Summary Vincitori
+                    top_winner = df_backtest['Vincente'].mode()[0]
+                    st.info(f"🏅 **Analisi Storica:** Il modello più preciso per il tuo business è stato **{top_winner}**. Questo significa che storicamente {'la media dei modelli' if top_winner=='Ensemble' else 'l impatto del budget' if top_winner=='Random Forest' else 'la stagionalità pura'} ha fornito i risultati più vicini alla realtà.")
+
+                    with st.expander(f"⏱️ Cadenza di Refit del Backtest (attuale: {bt_cadence_label})"):
+                        st.caption("Confronta l'accuratezza del Random Forest con refit meno frequenti o con una foresta incrementale (warm-start) rispetto al refit completo a ogni settimana, sulle stesse settimane di test. Calcolo su richiesta: esegue il backtest una volta per cadenza.")
+                        if st.button("📊 Confronta Cadenze di Refit", key="bt_cadence_compare"):
+                            design = backtest_design(df, businesses_found)
+                            with st.spinner("Backtest per ogni cadenza in corso..."):
+                                df_cadence = compare_backtest_cadences(design['key'], design['X'], design['y'], design['all_dates'], design['test_pos'], design['X_test'], design['actual'])
+                            st.dataframe(df_cadence.style.format({
+                                'Accuratezza RF': '{:.1%}', 'Errore Medio RF (€)': '€ {:,.0f}', 'Tempo (s)': '{:.1f}', 'Δ Accuratezza vs Completo': '{:+.2%}'
+                            }), use_container_width=True, hide_index=True)
+                else:
+                    st.info("Carica uno storico più lungo (almeno 6 mesi) per generare il report di affidabilità.")
 
-                        st.markdown("---")
-                        res_c1, res_c2, res_c3 = st.columns(3)
-                        res_c1.metric("Previsione RF", f"€ {rf_pred:,.2f}")
-                        res_c2.metric("Previsione Prophet", f"€ {p_pred:,.2f}")
-                        res_c3.metric("Media Ensemble", f"€ {avg_pred:,.2f}", delta="Target AI")
-                        
-                        if test_actual > 0:
-                            error = abs(avg_pred - test_actual) / test_actual
-                            accuracy = (1 - error) * 100
-                            st.subheader(f"🎯 Accuratezza Riscontrata: {accuracy:.1f}%")
+                st.divider()
+                st.subheader("📅 Tabella Comparativa")
+                # Uniamo le previsioni per una tabella chiara
+                df_comp_final = df_ml.copy()
+                df_prophet_clean = df_prophet[['ds', 'yhat']].copy()
+                df_prophet_clean.columns = ['Data', 'Fatturato_Prophet']
+                
+                # NORMALIZZAZIONE DATE PER IL MERGE (Togliamo ore/minuti e allineiamo)
+                df_comp_final['Data'] = pd.to_datetime(df_comp_final['Data']).dt.normalize()
+                df_prophet_clean['Data'] = pd.to_datetime(df_prophet_clean['Data']).dt.normalize()
+                
+                # Usiamo un merge 'outer' o 'left' per sicurezza e debug
+                df_final_tab = pd.merge(df_comp_final, df_prophet_clean, on='Data', how='inner')
+                
+                if df_final_tab.empty:
+                    st.warning("⚠️ Nota: I dati di Prophet e ML non sono allineati temporalmente. Prova a ricaricare i dati.")
+                else:
+                    df_final_tab['Media_Ensemble'] = (df_final_tab['Fatturato_ML'] + df_final_tab['Fatturato_Prophet']) / 2
+                    
+                    st.dataframe(df_final_tab.style.format({
+                        'Fatturato_ML': '€ {:,.0f}', 
+                        'Fatturato_Prophet': '€ {:,.0f}', 
+                        'Media_Ensemble': '€ {:,.0f}',
+                        'Spesa_ML': '€ {:,.0f}'
+                    }))
+
+                st.divider()
+                # Simulatore in un fragment: selezione e test rieseguono solo questo blocco, non modelli e backtest
+                @st.fragment
+                def precision_simulator():
+                    st.subheader("🧪 Simulatore di Precisione (Actual vs Forecast)")
+                    st.write("Scegli una settimana dal tuo storico e confronta quello che è successo realmente con quello che l'AI avrebbe previsto.")
+                
+                    # Selettore della settimana
+                    date_options = df['Data_Interna'].dt.date.unique()
+                    selected_test_date = st.selectbox(
+                        "📅 Seleziona la settimana da verificare", 
+                        options=date_options,
+                        index=len(date_options)-1,
+                        help="I dati di spesa e fatturato verranno pre-compilati automaticamente."
+                    )
+                
+                    # Recupera dati reali per quella data
+                    actual_row = df[df['Data_Interna'].dt.date == selected_test_date].iloc[0]
+                
+                    with st.container():
+                        c_test1, c_test2, c_test3 = st.columns(3)
+                        test_g = c_test1.number_input("Spesa Google (€)", value=float(actual_row[col_google]), step=100.0)
+                        test_m = c_test2.number_input("Spesa Meta (€)", value=float(actual_row[col_meta]), step=100.0)
+                        test_actual = c_test3.number_input("Fatturato Reale (€)", value=float(actual_row['Fatturato_Netto']), step=500.0)
+                    
+                        if st.button("🚀 Avvia Test di Validazione AI"):
+                            # Trova l'indice per calcolare i LAG precedenti a quella data
+                            idx_list = df[df['Data_Interna'].dt.date == selected_test_date].index
+                            if not idx_list.empty:
+                                idx = idx_list[0]
+                            
+                                # 1. Prediction con Random Forest
+                                test_dt = pd.to_datetime(selected_test_date)
+                                curr_w = test_dt.isocalendar().week
+                                w_sin, w_cos = np.sin(2 * np.pi * curr_w / 53), np.cos(2 * np.pi * curr_w / 53)
+                            
+                                # Prendi i Lag basandoti sulla riga selezionata (usiamo dati disponibili PRIMA)
+                                l1 = df['Fatturato_Netto'].iloc[idx-1] if idx > 0 else actual_row['Fatturato_Netto']
+                                l4 = df['Fatturato_Netto'].iloc[idx-4] if idx > 3 else actual_row['Fatturato_Netto']
+                            
+                                row_val = {
+                                    'Week_Sin': w_sin, 'Week_Cos': w_cos, 
+                                    col_google: test_g, col_meta: test_m, 
+                                    'Lag_Sales_1': l1, 'Lag_Sales_4': l4
+                                }
+                                # Aggiungiamo i valori business reali di quella riga per il test
+                                for b in businesses_found:
+                                    row_val[b] = actual_row[b]
+
+                                X_val = pd.DataFrame([row_val]).to_numpy(dtype=np.float64)
+                                rf_pred = ml_model.predict(X_val)[0]
+                            
+                                # 2. Prediction con Prophet
+                                test_dict_p = {'ds': test_dt, 'google': test_g, 'meta': test_m}
+                                for b in businesses_found:
+                                    test_dict_p[b] = actual_row[b]
                             
-                            if accuracy > 92: st.success("🏆 Eccellente! I modelli hanno catturato perfettamente il trend di questa settimana.")
-                            elif accuracy > 85: st.info("📉 Buona precisione. Lo scostamento rientra nei margini statistici.")
-                            else: 
-                                st.warning(f"⚠️ Scostamento del {error*100:.1f}%.")
-                                # Analisi anomalie
-                                st.write("**Possibili cause individuate dall'AI:**")
-                                historical_cpc = df['Avg. CPC'].mean() if 'Avg. CPC' in df.columns else 0
-                                if test_g/test_actual < df[col_google].mean()/df['Fatturato_Netto'].mean() * 0.8:
-                                    st.write("- 🚩 **Efficienza Ads anomala**: Hai speso molto meno del solito per generare questo fatturato. C'era un evento organico?")
-                                if 'Avg. CPC' in actual_row and actual_row['Avg. CPC'] > historical_cpc * 1.3:
-                                    st.write("- 🚩 **CPC Alert**: Il costo per click di questa settimana era il 30% più alto della media, distorcendo la previsione.")
-                                st.write("- 🚩 **Dato mancante**: L'AI non vede sconti o stock-out che potrebbero aver influenzato il risultato.")
+                                test_df_p = pd.DataFrame([test_dict_p])
+                                p_pred = p_model.predict(test_df_p)['yhat'].values[0]
+                            
+                                avg_pred = (rf_pred + p_pred) / 2
+
+                                st.markdown("---")
+                                res_c1, res_c2, res_c3 = st.columns(3)
+                                res_c1.metric("Previsione RF", f"€ {rf_pred:,.2f}")
+                                res_c2.metric("Previsione Prophet", f"€ {p_pred:,.2f}")
+                                res_c3.metric("Media Ensemble", f"€ {avg_pred:,.2f}", delta="Target AI")
+                            
+                                if test_actual > 0:
+                                    error = abs(avg_pred - test_actual) / test_actual
+                                    accuracy = (1 - error) * 100
+                                    st.subheader(f"🎯 Accuratezza Riscontrata: {accuracy:.1f}%")
+                                
+                                    if accuracy > 92: st.success("🏆 Eccellente! I modelli hanno catturato perfettamente il trend di questa settimana.")
+                                    elif accuracy > 85: st.info("📉 Buona precisione. Lo scostamento rientra nei margini statistici.")
+                                    else: 
+                                        st.warning(f"⚠️ Scostamento del {error*100:.1f}%.")
+                                        # Analisi anomalie
+                                        st.write("**Possibili cause individuate dall'AI:**")
+                                        historical_cpc = df['Avg. CPC'].mean() if 'Avg. CPC' in df.columns else 0
+                                        if test_g/test_actual < df[col_google].mean()/df['Fatturato_Netto'].mean() * 0.8:
+                                            st.write("- 🚩 **Efficienza Ads anomala**: Hai speso molto meno del solito per generare questo fatturato. C'era un evento organico?")
+                                        if 'Avg. CPC' in actual_row and actual_row['Avg. CPC'] > historical_cpc * 1.3:
+                                            st.write("- 🚩 **CPC Alert**: Il costo per click di questa settimana era il 30% più alto della media, distorcendo la previsione.")
+                                        st.write("- 🚩 **Dato mancante**: L'AI non vede sconti o stock-out che potrebbero aver influenzato il risultato.")
+
+                    # --- VALIDAZIONE IN BLOCCO ---
+                    st.markdown("---")
+                    if st.toggle("📋 Valida tutte le settimane (audit in blocco)", key="sim_batch", help="Stesso test del simulatore su ogni settimana dello storico, con spesa e driver reali: una sola previsione per modello."):
+                        X_all, p_all, y_all = precision_inputs(df, col_google, col_meta, businesses_found)
+                        df_val = validate_all_weeks(X_all, p_all, y_all, ml_model, p_model)
+                        df_val.insert(1, 'Periodo', df['Periodo'].astype(str).to_numpy())
+                        df_val['Trimestre'] = pd.DatetimeIndex(df_val['Data']).to_period('Q').astype(str)
+                    
+                        c_q, c_n = st.columns([2, 1])
+                        quarters = sorted(df_val['Trimestre'].unique(), reverse=True)
+                        sel_q = c_q.selectbox("🗓️ Periodo di audit", ["Tutto lo storico"] + quarters, key="sim_batch_q")
+                        n_worst = c_n.number_input("Peggiori scostamenti", min_value=min(5, len(df_val)), max_value=len(df_val), value=min(20, len(df_val)), step=5, key="sim_batch_n")
+                        df_audit = df_val if sel_q == "Tutto lo storico" else df_val[df_val['Trimestre'] == sel_q]
+                    
+                        b1, b2, b3 = st.columns(3)
+                        b1.metric("Accuratezza Media Ensemble", f"{df_audit['Accuratezza'].mean():.1%}")
+                        b2.metric("Errore Medio", f"€ {df_audit['Errore Assoluto (€)'].mean():,.0f}")
+                        b3.metric("Settimane sotto l'85%", f"{(df_audit['Accuratezza'] < 0.85).sum()} / {len(df_audit)}")
+                    
+                        st.dataframe(df_audit.nlargest(int(n_worst), 'Errore Assoluto (€)').style.format({
+                            'Data': lambda d: d.strftime('%Y-%m-%d'),
+                            'Fatturato Reale': '€ {:,.0f}', 'Previsione RF': '€ {:,.0f}', 'Previsione Prophet': '€ {:,.0f}',
+                            'Media Ensemble': '€ {:,.0f}', 'Scostamento (€)': '€ {:+,.0f}', 'Errore Assoluto (€)': '€ {:,.0f}',
+                            'Accuratezza': '{:.1%}'
+                        }), use_container_width=True, hide_index=True)
+                        st.caption("Clicca sull'intestazione di una colonna per ordinare la tabella. I modelli sono allenati su tutto lo storico: è un controllo di aderenza, non un backtest fuori campione.")
+
+                precision_simulator()
 
         with tabs[1]:
-            st.info("**Cosa fa:** Analisi verticale delle performance di Google Ads (Spesa vs Valore Conversione).  \n**Logica:** Calcola metriche dinamiche come ROAS e CPC medio degli ultimi 30 giorni per misurare l'efficienza diretta del canale.")
-            st.caption("Focus sulle performance storiche di Google Ads.")
-            st.subheader("🔵 Performance Google Ads")
-            if col_g_val in df.columns:
-                g_metrics = df.tail(4)[[col_google, col_g_val, 'ROAS_Google', col_g_cpc, col_g_imps]].sum()
-                st.columns(5)[0].metric("Spesa (4w)", f"€ {g_metrics[col_google]:,.0f}")
-                
-                fig_g, ax_g1 = plt.subplots(figsize=(12, 5))
-                ax_g1.bar(df['Data_Interna'], df[col_google], color=DARKEST_BLUE, alpha=0.7, label='Spesa Google')
-                ax_g2 = ax_g1.twinx()
-                ax_g2.plot(df['Data_Interna'], df[col_g_val], color=GREEN_COLOR, linewidth=2, label='Valore Conversione')
-                st.pyplot(fig_g)
-                st.dataframe(df[['Periodo', col_google, col_g_val, 'ROAS_Google', col_g_cpc]].iloc[::-1].style.format({col_google: '€ {:,.2f}', col_g_val: '€ {:,.2f}', 'ROAS_Google': '{:.2f}', col_g_cpc: '€ {:,.2f}'}))
+            if tabs[1].open:
+                st.info("**Cosa fa:** Analisi verticale delle performance di Google Ads (Spesa vs Valore Conversione).  \n**Logica:** Calcola metriche dinamiche come ROAS e CPC medio degli ultimi 30 giorni per misurare l'efficienza diretta del canale.")
+                st.caption("Focus sulle performance storiche di Google Ads.")
+                st.subheader("🔵 Performance Google Ads")
+                if col_g_val in df.columns:
+                    g_metrics = df.tail(4)[[col_google, col_g_val, 'ROAS_Google', col_g_cpc, col_g_imps]].sum()
+                    st.columns(5)[0].metric("Spesa (4w)", f"€ {g_metrics[col_google]:,.0f}")
+                    
+                    fig_g, ax_g1 = plt.subplots(figsize=(12, 5))
+                    ax_g1.bar(df['Data_Interna'], df[col_google], color=DARKEST_BLUE, alpha=0.7, label='Spesa Google')
+                    ax_g2 = ax_g1.twinx()
+                    ax_g2.plot(df['Data_Interna'], df[col_g_val], color=GREEN_COLOR, linewidth=2, label='Valore Conversione')
+                    st.pyplot(fig_g)
+                    st.dataframe(df[['Periodo', col_google, col_g_val, 'ROAS_Google', col_g_cpc]].iloc[::-1].style.format({col_google: '€ {:,.2f}', col_g_val: '€ {:,.2f}', 'ROAS_Google': '{:.2f}', col_g_cpc: '€ {:,.2f}'}))
 
         with tabs[2]:
-            st.info("**Cosa fa:** Analisi verticale delle performance di Meta Ads.  \n**Logica:** Monitora ROAS, CPM e frequenza per valutare la salute delle campagne social e l'impatto del pixel di tracciamento.")
-            st.caption("Focus sulle performance storiche di Meta Ads.")
-            st.subheader("🔵 Performance Meta Ads")
-            if col_m_val in df.columns:
-                m_metrics = df.tail(4)[[col_meta, col_m_val, 'ROAS_Meta', col_m_cpc, col_m_cpm, col_m_freq]].sum()
-                st.columns(6)[0].metric("Spesa (4w)", f"€ {m_metrics[col_meta]:,.0f}")
-                
-                fig_m, ax_m1 = plt.subplots(figsize=(12, 5))
-                ax_m1.bar(df['Data_Interna'], df[col_meta], color=DARKEST_BLUE, alpha=0.7, label='Spesa Meta')
-                ax_m2 = ax_m1.twinx()
-                ax_m2.plot(df['Data_Interna'], df[col_m_val], color=GREEN_COLOR, linewidth=2, label='Website Purch. Value')
-                st.pyplot(fig_m)
-                st.dataframe(df[['Periodo', col_meta, col_m_val, 'ROAS_Meta', col_m_cpc, col_m_cpm, col_m_freq]].iloc[::-1].style.format({col_meta: '€ {:,.2f}', col_m_val: '€ {:,.2f}', 'ROAS_Meta': '{:.2f}', col_m_cpc: '€ {:,.2f}', col_m_cpm: '€ {:,.2f}', col_m_freq: '{:.2f}'}))
+            if tabs[2].open:
+                st.info("**Cosa fa:** Analisi verticale delle performance di Meta Ads.  \n**Logica:** Monitora ROAS, CPM e frequenza per valutare la salute delle campagne social e l'impatto del pixel di tracciamento.")
+                st.caption("Focus sulle performance storiche di Meta Ads.")
+                st.subheader("🔵 Performance Meta Ads")
+                if col_m_val in df.columns:
+                    m_metrics = df.tail(4)[[col_meta, col_m_val, 'ROAS_Meta', col_m_cpc, col_m_cpm, col_m_freq]].sum()
+                    st.columns(6)[0].metric("Spesa (4w)", f"€ {m_metrics[col_meta]:,.0f}")
+                    
+                    fig_m, ax_m1 = plt.subplots(figsize=(12, 5))
+                    ax_m1.bar(df['Data_Interna'], df[col_meta], color=DARKEST_BLUE, alpha=0.7, label='Spesa Meta')
+                    ax_m2 = ax_m1.twinx()
+                    ax_m2.plot(df['Data_Interna'], df[col_m_val], color=GREEN_COLOR, linewidth=2, label='Website Purch. Value')
+                    st.pyplot(fig_m)
+                    st.dataframe(df[['Periodo', col_meta, col_m_val, 'ROAS_Meta', col_m_cpc, col_m_cpm, col_m_freq]].iloc[::-1].style.format({col_meta: '€ {:,.2f}', col_m_val: '€ {:,.2f}', 'ROAS_Meta': '{:.2f}', col_m_cpc: '€ {:,.2f}', col_m_cpm: '€ {:,.2f}', col_m_freq: '{:.2f}'}))
 
         with tabs[3]:
-            st.info("**Cosa fa:** Analizza la reattività del tuo business agli aumenti di budget. Misura l'elasticità storica per aiutarti a calibrare correttamente il simulatore.  \n**Logica:** Un coefficiente di 1.0 indica una crescita lineare (spendi 2x, incassi 2x). Valori inferiori indicano che il mercato sta saturando.")
-            st.header("🧪 Market Elasticity Hub")
-            
-            # --- 1. IL VERDETTO DELL'IA ---
-            # --- 1. IL VERDETTO DELL'IA (Logica LFL) ---
-            years_avail = sorted(df['Year'].unique(), reverse=True)
-            annual_rows = []
-            
-            for i in range(len(years_avail) - 1):
-                y_curr, y_prev = years_avail[i], years_avail[i+1]
+            if tabs[3].open:
+                st.info("**Cosa fa:** Analizza la reattività del tuo business agli aumenti di budget. Misura l'elasticità storica per aiutarti a calibrare correttamente il simulatore.  \n**Logica:** Un coefficiente di 1.0 indica una crescita lineare (spendi 2x, incassi 2x). Valori inferiori indicano che il mercato sta saturando.")
+                st.header("🧪 Market Elasticity Hub")
                 
-                # Trova settimane comuni per un confronto LFL reale
-                weeks_curr = set(df[df['Year'] == y_curr]['Week'].unique())
-                weeks_prev = set(df[df['Year'] == y_prev]['Week'].unique())
-                common_w = weeks_curr.intersection(weeks_prev)
+                # --- 1. IL VERDETTO DELL'IA ---
+                # --- 1. IL VERDETTO DELL'IA (Logica LFL) ---
+                years_avail = sorted(df['Year'].unique(), reverse=True)
+                annual_rows = []
                 
-                if common_w:
-                    d_curr = df[(df['Year'] == y_curr) & (df['Week'].isin(common_w))]
-                    d_prev = df[(df['Year'] == y_prev) & (df['Week'].isin(common_w))]
-                    
-                    s_curr, s_prev = d_curr['Spesa_Ads_Totale'].sum(), d_prev['Spesa_Ads_Totale'].sum()
-                    r_curr, r_prev = d_curr['Fatturato_Netto'].sum(), d_prev['Fatturato_Netto'].sum()
-                    
-                    d_spend = ((s_curr - s_prev) / s_prev) if s_prev > 0 else 0
-                    d_rev = ((r_curr - r_prev) / r_prev) if r_prev > 0 else 0
+                for y_curr, y_prev in zip(years_avail[:-1], years_avail[1:]):
+                    # Trova settimane comuni per un confronto LFL reale
+                    common_w = lfl_weeks(lfl_cube, y_curr, y_prev)
+
+                    if common_w.any():
+                        d_curr = cube_totals(lfl_cube, y_curr, common_w)[0]
+                        d_prev = cube_totals(lfl_cube, y_prev, common_w)[0]
+
+                        s_curr, s_prev = d_curr['Spesa_Ads_Totale'], d_prev['Spesa_Ads_Totale']
+                        r_curr, r_prev = d_curr['Fatturato_Netto'], d_prev['Fatturato_Netto']
+                        
+                        d_spend = ((s_curr - s_prev) / s_prev) if s_prev > 0 else 0
+                        d_rev = ((r_curr - r_prev) / r_prev) if r_prev > 0 else 0
+                        
+                        # Elasticità = % Delta Rev / % Delta Spend
+                        elasticity = d_rev / d_spend if abs(d_spend) > 0.01 else 0
+                        
+                        annual_rows.append({
+                            'Confronto': f"{y_curr} vs {y_prev} (LFL)", 
+                            'Delta Spesa %': d_spend * 100, 
+                            'Delta Fatturato %': d_rev * 100, 
+                            'Elasticità': elasticity,
+                            'Settimane': int(common_w.sum())
+                        })
+
+                if annual_rows:
+                    avg_elasticity = np.mean([r['Elasticità'] for r in annual_rows if r['Elasticità'] > 0])
                     
-                    # Elasticità = % Delta Rev / % Delta Spend
-                    elasticity = d_rev / d_spend if abs(d_spend) > 0.01 else 0
+                    col_v1, col_v2 = st.columns([1, 2])
+                    with col_v1:
+                        st.metric("Elasticità Media Storica", f"{avg_elasticity:.2f}")
+                    with col_v2:
+                        if avg_elasticity > 0.95:
+                            status_msg = "🚀 **Business Altamente Scalabile:** Il mercato risponde quasi linearmente. Puoi aumentare il budget con fiducia."
+                        elif avg_elasticity > 0.75:
+                            status_msg = "⚖️ **Efficienza Standard:** Rilevati rendimenti decrescenti fisiologici. Scalare richiede attenzione ai margini."
+                        else:
+                            status_msg = "⚠️ **Segnali di Saturazione:** La crescita del fatturato è molto più lenta della spesa. Focus sull'efficienza prima di scalare."
+                        st.success(status_msg)
                     
-                    annual_rows.append({
-                        'Confronto': f"{y_curr} vs {y_prev} (LFL)", 
-                        'Delta Spesa %': d_spend * 100, 
-                        'Delta Fatturato %': d_rev * 100, 
-                        'Elasticità': elasticity,
-                        'Settimane': len(common_w)
-                    })
+                    st.info(f"👉 **Consiglio Tecnico:** Imposta il 'Coefficiente Saturazione' nel **Simulatore Avanzato** (sidebar) su un valore vicino a **{avg_elasticity:.2f}** per proiezioni massimamente accurate.")
 
-            if annual_rows:
-                avg_elasticity = np.mean([r['Elasticità'] for r in annual_rows if r['Elasticità'] > 0])
-                
-                col_v1, col_v2 = st.columns([1, 2])
-                with col_v1:
-                    st.metric("Elasticità Media Storica", f"{avg_elasticity:.2f}")
-                with col_v2:
-                    if avg_elasticity > 0.95:
-                        status_msg = "🚀 **Business Altamente Scalabile:** Il mercato risponde quasi linearmente. Puoi aumentare il budget con fiducia."
-                    elif avg_elasticity > 0.75:
-                        status_msg = "⚖️ **Efficienza Standard:** Rilevati rendimenti decrescenti fisiologici. Scalare richiede attenzione ai margini."
-                    else:
-                        status_msg = "⚠️ **Segnali di Saturazione:** La crescita del fatturato è molto più lenta della spesa. Focus sull'efficienza prima di scalare."
-                    st.success(status_msg)
+                st.divider()
+                st.subheader("📊 Analisi Comparativa Annuale")
                 
-                st.info(f"👉 **Consiglio Tecnico:** Imposta il 'Coefficiente Saturazione' nel **Simulatore Avanzato** (sidebar) su un valore vicino a **{avg_elasticity:.2f}** per proiezioni massimamente accurate.")
+                if annual_rows:
+                    st.dataframe(pd.DataFrame(annual_rows).style.format({'Delta Spesa %': '{:+.1f}%', 'Delta Fatturato %': '{:+.1f}%', 'Elasticità': '{:.2f}'}) \
+                               .background_gradient(subset=['Elasticità'], cmap='RdYlGn', vmin=0.5, vmax=1.5))
 
-            st.divider()
-            st.subheader("📊 Analisi Comparativa Annuale")
-            
-            if annual_rows:
-                st.dataframe(pd.DataFrame(annual_rows).style.format({'Delta Spesa %': '{:+.1f}%', 'Delta Fatturato %': '{:+.1f}%', 'Elasticità': '{:.2f}'}) \
-                           .background_gradient(subset=['Elasticità'], cmap='RdYlGn', vmin=0.5, vmax=1.5))
-
-            st.divider()
-            st.subheader("2. Dettaglio Settimanale")
-            
-            if not annual_rows:
-                st.warning("Dati insufficienti.")
-            else:
-                comp_options = [row['Confronto'] for row in annual_rows]
-                selected_comp = st.selectbox("Seleziona Anno da Confrontare", comp_options)
-                
-                # Parsing dei nomi degli anni (rimuovendo il suffisso LFL se presente)
-                years_parts = selected_comp.replace(" (LFL)", "").split(" vs ")
-                curr_year_sel = int(years_parts[0])
-                prev_year_sel = int(years_parts[1])
-                
-                all_weeks = pd.DataFrame({'Week': range(1, 54)})
-                df_curr = df[df['Year'] == curr_year_sel][['Week', 'Spesa_Ads_Totale', 'Fatturato_Netto', 'Periodo']]
-                df_hist_prev = df[df['Year'] == prev_year_sel][['Week', 'Spesa_Ads_Totale', 'Fatturato_Netto']]
-                
-                df_comp = pd.merge(all_weeks, df_curr, on='Week', how='left')
-                df_comp = pd.merge(df_comp, df_hist_prev, on='Week', suffixes=('_Curr', '_Prev'), how='left').fillna(0)
-                
-                df_comp['Delta Spesa %'] = np.where(df_comp['Spesa_Ads_Totale_Prev'] > 0, ((df_comp['Spesa_Ads_Totale_Curr'] - df_comp['Spesa_Ads_Totale_Prev']) / df_comp['Spesa_Ads_Totale_Prev']) * 100, 0)
-                df_comp['Delta Ricavi %'] = np.where(df_comp['Fatturato_Netto_Prev'] > 0, ((df_comp['Fatturato_Netto_Curr'] - df_comp['Fatturato_Netto_Prev']) / df_comp['Fatturato_Netto_Prev']) * 100, 0)
-                df_comp['Elasticità'] = np.where(df_comp['Delta Spesa %'] != 0, df_comp['Delta Ricavi %'] / df_comp['Delta Spesa %'], 0)
-                
-                df_view = df_comp[(df_comp['Spesa_Ads_Totale_Curr'] > 0) | (df_comp['Spesa_Ads_Totale_Prev'] > 0)].sort_values('Week', ascending=False)
-                
-                st.dataframe(df_view[['Week', 'Periodo', 'Spesa_Ads_Totale_Curr', 'Spesa_Ads_Totale_Prev', 'Delta Spesa %', 'Delta Ricavi %', 'Elasticità']].style.format({'Spesa_Ads_Totale_Curr': '€ {:,.0f}', 'Spesa_Ads_Totale_Prev': '€ {:,.0f}', 'Delta Spesa %': '{:+.1f}%', 'Delta Ricavi %': '{:+.1f}%', 'Elasticità': '{:.2f}'}).background_gradient(subset=['Elasticità'], cmap='RdYlGn', vmin=0.5, vmax=1.5))
-                
-                fig_sat, ax_sat = plt.subplots(figsize=(10, 5))
-                ax_sat.plot([-100, 500], [-100, 500], ls='--', color='gray', alpha=0.5)
-                scatter = ax_sat.scatter(df_view['Delta Spesa %'], df_view['Delta Ricavi %'], c=df_view['Elasticità'], cmap='RdYlGn', s=80, edgecolor='black', vmin=0.6, vmax=1.4)
-                ax_sat.set_xlabel("Variazione Spesa (%)")
-                ax_sat.set_ylabel("Variazione Fatturato (%)")
-                plt.colorbar(scatter, label='Elasticità')
-                st.pyplot(fig_sat)
+                st.divider()
+                st.subheader("2. Dettaglio Settimanale")
                 
-                with st.expander("📖 Guida alla Lettura: Come interpretare questa Mappa di Scalabilità?"):
-                    st.markdown("""
-                    Questo grafico a dispersione (Scatter Plot) mette in relazione la tua spesa pubblicitaria con la risposta del mercato:
-                    
-                    *   **Asse X (Variazione Spesa %):** Quanto hai aumentato o diminuito il budget rispetto allo scorso anno.
-                    *   **Asse Y (Variazione Fatturato %):** Come sono cambiate le vendite reali in risposta a quel budget.
-                    *   **La Diagonale Tratteggiata:** Rappresenta l'equilibrio (Elasticità 1.0). 
-                        - Se i punti sono **SOPRA** la linea: Sei in zona di **Iper-Efficienza**. Il mercato risponde meglio di quanto investi.
-                        - Se i punti sono **SOTTO** la linea: Sei in zona di **Saturazione**. Stai pagando un "costo marginale" più alto per ogni nuova vendita.
-                    
-                    **Il Significato dei Colori:**
-                    - 🟢 **Verde (Elasticità > 1.2):** Mercato reattivo. Ogni euro speso in più genera una crescita di fatturato più che proporzionale. **ZONA DI SCALA.**
-                    - 🟡 **Giallo/Arancio (0.8 - 1.2):** Rendimenti costanti. La crescita è lineare. **ZONA DI MANTENIMENTO.**
-                    - 🔴 **Rosso (Elasticità < 0.7):** Saturazione rilevata. Hai raggiunto il limite del pubblico attuale o l'offerta ha perso appeal. **ZONA DI OTTIMIZZAZIONE.**
-                    """)
+                if not annual_rows:
+                    st.warning("Dati insufficienti.")
+                else:
+                    comp_options = [row['Confronto'] for row in annual_rows]
+                    selected_comp = st.selectbox("Seleziona Anno da Confrontare", comp_options)
+                    
+                    # Parsing dei nomi degli anni (rimuovendo il suffisso LFL se presente)
+                    years_parts = selected_comp.replace(" (LFL)", "").split(" vs ")
+                    curr_year_sel = int(years_parts[0])
+                    prev_year_sel = int(years_parts[1])
+                    
+                    all_weeks = pd.DataFrame({'Week': range(1, 54)})
+                    df_curr = df[df['Year'] == curr_year_sel][['Week', 'Spesa_Ads_Totale', 'Fatturato_Netto', 'Periodo']].astype({'Periodo': str})
+                    df_hist_prev = df[df['Year'] == prev_year_sel][['Week', 'Spesa_Ads_Totale', 'Fatturato_Netto']]
+                    
+                    df_comp = pd.merge(all_weeks, df_curr, on='Week', how='left')
+                    df_comp = pd.merge(df_comp, df_hist_prev, on='Week', suffixes=('_Curr', '_Prev'), how='left').fillna(0)
+                    
+                    df_comp['Delta Spesa %'] = np.where(df_comp['Spesa_Ads_Totale_Prev'] > 0, ((df_comp['Spesa_Ads_Totale_Curr'] - df_comp['Spesa_Ads_Totale_Prev']) / df_comp['Spesa_Ads_Totale_Prev']) * 100, 0)
+                    df_comp['Delta Ricavi %'] = np.where(df_comp['Fatturato_Netto_Prev'] > 0, ((df_comp['Fatturato_Netto_Curr'] - df_comp['Fatturato_Netto_Prev']) / df_comp['Fatturato_Netto_Prev']) * 100, 0)
+                    df_comp['Elasticità'] = np.where(df_comp['Delta Spesa %'] != 0, df_comp['Delta Ricavi %'] / df_comp['Delta Spesa %'], 0)
+                    
+                    df_view = df_comp[(df_comp['Spesa_Ads_Totale_Curr'] > 0) | (df_comp['Spesa_Ads_Totale_Prev'] > 0)].sort_values('Week', ascending=False)
+                    
+                    st.dataframe(df_view[['Week', 'Periodo', 'Spesa_Ads_Totale_Curr', 'Spesa_Ads_Totale_Prev', 'Delta Spesa %', 'Delta Ricavi %', 'Elasticità']].style.format({'Spesa_Ads_Totale_Curr': '€ {:,.0f}', 'Spesa_Ads_Totale_Prev': '€ {:,.0f}', 'Delta Spesa %': '{:+.1f}%', 'Delta Ricavi %': '{:+.1f}%', 'Elasticità': '{:.2f}'}).background_gradient(subset=['Elasticità'], cmap='RdYlGn', vmin=0.5, vmax=1.5))
+                    
+                    fig_sat, ax_sat = plt.subplots(figsize=(10, 5))
+                    ax_sat.plot([-100, 500], [-100, 500], ls='--', color='gray', alpha=0.5)
+                    scatter = ax_sat.scatter(df_view['Delta Spesa %'], df_view['Delta Ricavi %'], c=df_view['Elasticità'], cmap='RdYlGn', s=80, edgecolor='black', vmin=0.6, vmax=1.4)
+                    ax_sat.set_xlabel("Variazione Spesa (%)")
+                    ax_sat.set_ylabel("Variazione Fatturato (%)")
+                    plt.colorbar(scatter, label='Elasticità')
+                    st.pyplot(fig_sat)
+                    
+                    with st.expander("📖 Guida alla Lettura: Come interpretare questa Mappa di Scalabilità?"):
+                        st.markdown("""
+                        Questo grafico a dispersione (Scatter Plot) mette in relazione la tua spesa pubblicitaria con la risposta del mercato:
+                        
+                        *   **Asse X (Variazione Spesa %):** Quanto hai aumentato o diminuito il budget rispetto allo scorso anno.
+                        *   **Asse Y (Variazione Fatturato %):** Come sono cambiate le vendite reali in risposta a quel budget.
+                        *   **La Diagonale Tratteggiata:** Rappresenta l'equilibrio (Elasticità 1.0). 
+                            - Se i punti sono **SOPRA** la linea: Sei in zona di **Iper-Efficienza**. Il mercato risponde meglio di quanto investi.
+                            - Se i punti sono **SOTTO** la linea: Sei in zona di **Saturazione**. Stai pagando un "costo marginale" più alto per ogni nuova vendita.
+                        
+                        **Il Significato dei Colori:**
+                        - 🟢 **Verde (Elasticità > 1.2):** Mercato reattivo. Ogni euro speso in più genera una crescita di fatturato più che proporzionale. **ZONA DI SCALA.**
+                        - 🟡 **Giallo/Arancio (0.8 - 1.2):** Rendimenti costanti. La crescita è lineare. **ZONA DI MANTENIMENTO.**
+                        - 🔴 **Rosso (Elasticità < 0.7):** Saturazione rilevata. Hai raggiunto il limite del pubblico attuale o l'offerta ha perso appeal. **ZONA DI OTTIMIZZAZIONE.**
+                        """)
 
         with tabs[4]:
-            st.info("**Cosa fa:** Monitora l'incidenza dei resi sul fatturato lordo per valutare la qualità delle vendite.  \n**Logica:** Applica una media mobile a 4 settimane per identificare trend strutturali e impatti sulla marginalità finale.")
-            st.caption("Confronto tra spesa e resi.")
-            st.subheader("🔍 Spesa Ads vs Tasso Resi")
-            fig2, ax1_2 = plt.subplots(figsize=(12, 6))
-            ax1_2.bar(df['Data_Interna'], df['Spesa_Ads_Totale'], color=DARKEST_BLUE, alpha=0.5)
-            ax2_2 = ax1_2.twinx()
-            ax2_2.plot(df['Data_Interna'], df['Tasso_Resi'].rolling(4).mean(), color='#e74c3c', linewidth=2)
-            st.pyplot(fig2)
+            if tabs[4].open:
+                st.info("**Cosa fa:** Monitora l'incidenza dei resi sul fatturato lordo per valutare la qualità delle vendite.  \n**Logica:** Applica una media mobile a 4 settimane per identificare trend strutturali e impatti sulla marginalità finale.")
+                st.caption("Confronto tra spesa e resi.")
+                st.subheader("🔍 Spesa Ads vs Tasso Resi")
+                fig2, ax1_2 = plt.subplots(figsize=(12, 6))
+                ax1_2.bar(df['Data_Interna'], df['Spesa_Ads_Totale'], color=DARKEST_BLUE, alpha=0.5)
+                ax2_2 = ax1_2.twinx()
+                ax2_2.plot(df['Data_Interna'], df['Tasso_Resi'].rolling(4).mean(), color='#e74c3c', linewidth=2)
+                st.pyplot(fig2)
 
         with tabs[5]:
-            st.info("**Cosa fa:** Visualizza il database normalizzato utilizzato per i calcoli.  \n**Logica:** È il risultato del processo di pulizia che trasforma i dati grezzi in numeri pronti per l'analisi statistica e il Machine Learning.")
-            st.caption("Il database grezzo importato.")
-            st.subheader("🗂️ Database Storico")
-            display_cols = [col_date, 'Periodo', 'Total sales', col_google, col_g_val, col_g_cpc, col_g_imps, 
-                            col_meta, col_m_val, col_m_cpc, col_m_cpm, col_m_freq, 'CoS', 'Profitto_Operativo']
-            valid_cols = [c for c in display_cols if c in df.columns]
-            st.dataframe(df[valid_cols].iloc[::-1].style.format({'CoS': '{:.1f}%', 'Profitto_Operativo': '€ {:,.0f}'}, precision=2))
+            if tabs[5].open:
+                st.info("**Cosa fa:** Visualizza il database normalizzato utilizzato per i calcoli.  \n**Logica:** È il risultato del processo di pulizia che trasforma i dati grezzi in numeri pronti per l'analisi statistica e il Machine Learning.")
+                st.caption("Il database grezzo importato.")
+                st.subheader("🗂️ Database Storico")
+                display_cols = [col_date, 'Periodo', 'Total sales', col_google, col_g_val, col_g_cpc, col_g_imps, 
+                                col_meta, col_m_val, col_m_cpc, col_m_cpm, col_m_freq, 'CoS', 'Profitto_Operativo']
+                valid_cols = [c for c in display_cols if c in df.columns]
+                st.dataframe(df[valid_cols].iloc[::-1].style.format({'CoS': '{:.1f}%', 'Profitto_Operativo': '€ {:,.0f}'}, precision=2))
 
         # --- 8. TAB AI AVANZATA ---
         with tabs[6]:
-            st.info("**Cosa fa:** Analisi automatica che assegna un punteggio di salute mensile al business.  \n**Logica:** Incrocia profitto, retention e performance dei canali utilizzando benchmark storici per generare alert e suggerimenti strategici.")
-            st.caption("Analisi automatica che incrocia Profitto, Retention e Performance Canali.")
-            st.header("🧠 Insight AI: Analisi Strategica Completa")
-            
-            df['Month_Date'] = df['Data_Interna'].dt.to_period('M')
-            ai_agg = {
-                'Spesa_Ads_Totale': 'sum', 'Fatturato_Netto': 'sum', 'Orders': 'sum', 
-                col_returns: 'sum', col_discounts: 'sum', col_google: 'sum', col_meta: 'sum', 
-                col_g_val: 'sum', col_m_val: 'sum', 'Gross sales': 'sum', 'Profitto_Operativo': 'sum'
-            }
-            if col_ret_rate in df.columns: ai_agg[col_ret_rate] = 'mean'
-            if col_m_freq in df.columns: ai_agg[col_m_freq] = 'mean'
-            if col_m_cpm in df.columns: ai_agg[col_m_cpm] = 'mean'
-            if col_g_cpc in df.columns: ai_agg[col_g_cpc] = 'mean'
-            if col_m_cpc in df.columns: ai_agg[col_m_cpc] = 'mean'
-
-            ai_df = df.groupby('Month_Date').agg(ai_agg).sort_index(ascending=False)
-            
-            # Calcolo Metriche Avanzate Mensili
-            ai_df['MER'] = ai_df['Fatturato_Netto'] / ai_df['Spesa_Ads_Totale'].replace(0, np.nan)
-            ai_df['AOV'] = ai_df['Fatturato_Netto'] / ai_df['Orders'].replace(0, np.nan)
-            ai_df['CPA'] = ai_df['Spesa_Ads_Totale'] / ai_df['Orders'].replace(0, np.nan)
-            
-            # --- LOGICA LTV INTEGRATA ---
-            ret_col = col_ret_rate if col_ret_rate in ai_df.columns else None
-            if ret_col:
-                ai_df['RET_RATE'] = pd.to_numeric(ai_df[ret_col], errors='coerce').fillna(0) / 100
-                # LTV Proxy = AOV / (1 - Retention) - Cappato al 90% per evitare infiniti
-                ai_df['LTV'] = ai_df['AOV'] / (1 - ai_df['RET_RATE'].clip(upper=0.90))
-                ai_df['LTV_CPA'] = ai_df['LTV'] / ai_df['CPA'].replace(0, np.nan)
-            
-            ai_df['Discount_Rate'] = (ai_df[col_discounts].abs() / ai_df['Gross sales'].replace(0, np.nan)) * 100
-            ai_df['ROAS_Google'] = ai_df[col_g_val] / ai_df[col_google].replace(0, np.nan)
-            ai_df['ROAS_Meta'] = ai_df[col_m_val] / ai_df[col_meta].replace(0, np.nan)
-            
-            avg_sales = ai_df['Fatturato_Netto'].mean()
-            ai_df['Seasonality'] = ai_df['Fatturato_Netto'] / avg_sales
-            
-            # Benchmark storici per lo scoring
-            bench_mer = ai_df['MER'].mean()
-            bench_ltv_cpa = ai_df['LTV_CPA'].mean() if 'LTV_CPA' in ai_df.columns else 0
-            
-            for m in ai_df.index[:12]:
-                row = ai_df.loc[m]
-                m_str = str(m)
-                
-                score = 50
-                tags, alerts = [], []
-                
-                # 1. Salute Finanziaria Immediata (MER)
-                if row['MER'] >= be_roas_val: 
-                    score += 15
-                    tags.append(f"MER Pro: {row['MER']:.2f}")
-                else: 
-                    score -= 15
-                    alerts.append(f"Margine Basso (MER {row['MER']:.2f})")
-                
-                # 2. Salute Strategica a Lungo Termine (LTV)
-                if 'LTV_CPA' in ai_df.columns:
-                    if row['LTV_CPA'] > 3.5: 
-                        score += 20
-                        tags.append(f"High LTV: {row['LTV_CPA']:.1f}x")
-                    elif row['LTV_CPA'] < 2.0:
-                        score -= 10
-                        alerts.append("Bassa Retention/Valore Cliente")
-                
-                # 3. Canale Dominante (Efficienza Diretta)
-                if row['ROAS_Google'] > row['ROAS_Meta']: 
-                    tags.append("Top: Google (Intent)")
-                else: 
-                    tags.append("Top: Meta (Visual)")
-                
-                # 4. Pressione Sconti
-                if row['Discount_Rate'] > 15:
-                    score -= 10
-                    alerts.append(f"Eccesso Sconti ({row['Discount_Rate']:.1f}%)")
-                
-                seas_txt = "Standard"
-                if row['Seasonality'] > 1.2: seas_txt = "Alta Stagionalità 🔥"
-                elif row['Seasonality'] < 0.8: seas_txt = "Bassa Stagionalità ❄️"
-                
-                color_class = "ai-score-high" if score >= 70 else "ai-score-med" if score >= 50 else "ai-score-low"
-                
-                with st.container():
-                    st.markdown(f"""
-                    <div class="ai-box {color_class}">
-                        <div class="ai-title" style="display:flex; justify-content:space-between;">
-                            <span>📅 {m_str} | <b>Health Score: {min(100, score)}/100</b></span>
-                            <span style="font-size:0.8em; color:#666;">{seas_txt}</span>
-                        </div>
-                        <div style="margin:8px 0;">
-                            {' '.join([f'<span class="ai-tag">{t}</span>' for t in tags])}
+            if tabs[6].open:
+                st.info("**Cosa fa:** Analisi automatica che assegna un punteggio di salute mensile al business.  \n**Logica:** Incrocia profitto, retention e performance dei canali utilizzando benchmark storici per generare alert e suggerimenti strategici.")
+                st.caption("Analisi automatica che incrocia Profitto, Retention e Performance Canali.")
+                st.header("🧠 Insight AI: Analisi Strategica Completa")
+                
+                # Scorecard di tutti i mesi, ricalcolata solo al cambio di dataset o economics
+                ai_df = monthly_scorecard(frame_fingerprint(df, ['Data_Interna', *monthly_agg_spec(df.columns)]), df, be_roas_val)
+
+                for m in ai_df.index[:12]:
+                    row = ai_df.loc[m]
+                    m_str = str(m)
+                    tags = row['Tags'].split(' | ') if row['Tags'] else []
+                    alerts = row['Alerts'].split(' | ') if row['Alerts'] else []
+
+                    with st.container():
+                        st.markdown(f"""
+                        <div class="ai-box {row['Score_Class']}">
+                            <div class="ai-title" style="display:flex; justify-content:space-between;">
+                                <span>📅 {m_str} | <b>Health Score: {row['Health_Score']}/100</b></span>
+                                <span style="font-size:0.8em; color:#666;">{row['Stagionalita']}</span>
+                            </div>
+                            <div style="margin:8px 0;">
+                                {' '.join([f'<span class="ai-tag">{t}</span>' for t in tags])}
+                            </div>
+                            <p style="margin:0; font-size:0.95em;">
+                                Fatturato: <b>€ {row['Fatturato_Netto']:,.0f}</b>. 
+                                CPA: <b>€ {row['CPA']:.2f}</b> | 
+                                AOV: <b>€ {row['AOV']:.2f}</b> |
+                                LTV Est.: <b>€ {row['LTV'] if 'LTV' in row else 0:,.0f}</b>
+                            </p>
+                            {''.join([f'<div class="ai-alert">⚠️ {a}</div>' for a in alerts])}
                         </div>
-                        <p style="margin:0; font-size:0.95em;">
-                            Fatturato: <b>€ {row['Fatturato_Netto']:,.0f}</b>. 
-                            CPA: <b>€ {row['CPA']:.2f}</b> | 
-                            AOV: <b>€ {row['AOV']:.2f}</b> |
-                            LTV Est.: <b>€ {row['LTV'] if 'LTV' in row else 0:,.0f}</b>
-                        </p>
-                        {''.join([f'<div class="ai-alert">⚠️ {a}</div>' for a in alerts])}
-                    </div>
-                    """, unsafe_allow_html=True)
+                        """, unsafe_allow_html=True)
+
+                with st.expander(f"📋 Scorecard Completa ({len(ai_df)} mesi)"):
+                    score_cols = ['Health_Score', 'Fatturato_Netto', 'Spesa_Ads_Totale', 'MER', 'CPA', 'AOV', 'LTV', 'LTV_CPA',
+                                  'Discount_Rate', 'Stagionalita', 'Tags', 'Alerts']
+                    scorecard = ai_df[[c for c in score_cols if c in ai_df.columns]].rename_axis('Mese')
+                    scorecard.index = scorecard.index.astype(str)
+                    score_fmt = {'Fatturato_Netto': '€ {:,.0f}', 'Spesa_Ads_Totale': '€ {:,.0f}', 'MER': '{:.2f}', 'CPA': '€ {:.2f}',
+                                 'AOV': '€ {:.2f}', 'LTV': '€ {:,.0f}', 'LTV_CPA': '{:.1f}x', 'Discount_Rate': '{:.1f}%'}
+                    st.dataframe(scorecard.style.format({k: v for k, v in score_fmt.items() if k in scorecard.columns}, na_rep='-')
+                                 .background_gradient(subset=['Health_Score'], cmap='RdYlGn', vmin=20, vmax=100))
+                    st.download_button("⬇️ Esporta Scorecard (CSV)", scorecard.to_csv().encode('utf-8'),
+                                       file_name="scorecard_insight_ai.csv", mime="text/csv", key="ai_scorecard_csv")
 
         with tabs[7]:
-            st.info("**Cosa fa:** Elabora una roadmap di investimento basata sulla tua efficienza reale e sui segnali tecnici dei canali.  \n**Logica:** Analizza il MER, le finestre di attribuzione e le metriche di saturazione (CPM, Frequency, CPC) per definire una scalabilità sostenibile.")
-            st.header("🎯 Analisi Strategica di Scalabilità")
-            
-            # --- LOGICA DI CALCOLO STRATEGICO AVANZATA ---
-            last_4 = df.tail(4)
-            prev_4 = df.iloc[-8:-4] if len(df) >= 8 else last_4
-            
-            g_spend_last = last_4[col_google].sum()
-            m_spend_last = last_4[col_meta].sum()
-            g_roas_last = last_4[col_g_val].sum() / g_spend_last if g_spend_last > 0 else 0
-            m_roas_last = last_4[col_m_val].sum() / m_spend_last if m_spend_last > 0 else 0
-            
-            # Segnali Tecnici (Ultimi 4w vs Precedenti 4w)
-            m_cpm_last = last_4[col_m_cpm].mean()
-            m_cpm_prev = prev_4[col_m_cpm].mean()
-            m_freq_last = last_4[col_m_freq].mean()
-            g_cpc_last = last_4[col_g_cpc].mean()
-            g_cpc_prev = prev_4[col_g_cpc].mean()
-            
-            m_cpm_delta = (m_cpm_last - m_cpm_prev) / m_cpm_prev if m_cpm_prev > 0 else 0
-            g_cpc_delta = (g_cpc_last - g_cpc_prev) / g_cpc_prev if g_cpc_prev > 0 else 0
-            
-            # Determinazione Canale Dominante e Bias di Attribuzione
-            best_channel = "Google Ads" if g_roas_last > m_roas_last else "Meta Ads"
-            performance_gap = abs(g_roas_last - m_roas_last) / max(g_roas_last, m_roas_last, 0.01)
-            
-            # Calcolo Budget Sostenibile basato su Forecasting
-            next_month_sales = df_prev.head(4)['Fatturato Previsto'].sum()
-            max_safe_budget = next_month_sales / be_roas_val
-            
-            # --- RENDERING UI PARTE 1: SEGNALI TECNICI ---
-            st.subheader("📡 Segnali di Mercato & Saturazione")
-            col_sig1, col_sig2, col_sig3 = st.columns(3)
-            
-            with col_sig1:
-                st.metric("CPM Meta", f"€ {m_cpm_last:.2f}", delta=f"{m_cpm_delta:+.1%}", delta_color="inverse")
-                if m_cpm_delta > 0.15: st.warning("⚠️ **Pressione Aste:** I costi pubblicitari su Meta sono in netto aumento.")
-            
-            with col_sig2:
-                st.metric("Frequency Meta (4w)", f"{m_freq_last:.2f}")
-                if m_freq_last > 1.4: st.error("🚨 **Saturazione:** Frequenza alta su Meta. Hai bisogno di nuovi creativi per scalare.")
-                else: st.success("✅ **Audience Fresca:** Hai spazio per aumentare il budget su Meta.")
-                
-            with col_sig3:
-                st.metric("CPC Google Ads", f"€ {g_cpc_last:.2f}", delta=f"{g_cpc_delta:+.1%}", delta_color="inverse")
-
-            # --- PARTE 2: SUGGERIMENTO STRATEGICO ---
-            st.divider()
-            
-            # Logica Proposta Strategica
-            if mer_attuale > be_roas_val * 1.3:
-                strat_title = "🚀 SCALABILITÀ AGGRESSIVA"
-                strat_desc = "Le tue Unit Economics sono eccellenti. L'obiettivo è catturare quota di mercato dominando la scoperta (Meta) e scalando l'intenzione d'acquisto diretta (Google Shopping/PMax)."
-                rec_scale, rec_trend, rec_sat = 1.25, growth_rate + 0.05, 0.92
-            elif mer_attuale >= be_roas_val:
-                strat_title = "⚖️ CRESCITA EQUILIBRATA"
-                strat_desc = "Sei in profitto. Focus sull'ottimizzazione del mix tra canali per massimizzare il profitto netto senza sprecare budget."
-                rec_scale, rec_trend, rec_sat = 1.10, growth_rate, 0.85
-            else:
-                strat_title = "🛡️ DIFESA E OTTIMIZZAZIONE"
-                strat_desc = "Stai operando vicino o sotto il break-even. Priorità al recupero dell'efficienza prima di qualsiasi aumento di spesa."
-                rec_scale, rec_trend, rec_sat = 0.85, growth_rate - 0.05, 0.80
-
-            st.markdown(f"### 🤖 Suggerimento AI: **{strat_title}**")
-            st.write(strat_desc)
-
-            col_rec1, col_rec2 = st.columns([2, 1])
-            with col_rec1:
-                st.info(f"""
-                **Analisi Multimetrica:**
-                * **Attribuzione:** {best_channel} ha un ROAS più alto, ma ricorda che Meta genera la domanda che Google spesso converte in Shopping. Non tagliare Meta se alimenta il volume di traffico "fresco".
-                * **Finestre di conversione:** Google (30gg) intercetta l'intenzione d'acquisto nata spesso da impulsi visivi su Meta (7gg). Valuta il MER complessivo.
-                * **Efficienza:** Il tuo cuscinetto di sicurezza è del **{((mer_attuale/be_roas_val)-1):+.1%}**.
-                """)
-            
-            with col_rec2:
-                st.metric("Target Budget Prossime 4w", f"€ {max_safe_budget * (rec_scale/1.1):,.0f}")
-                st.caption("Budget totale stimato per mantenere il profitto operativo.")
-
-            st.divider()
-
-            col_p1, col_p2 = st.columns(2)
-            
-            # --- LOGICA DI ALLOCAZIONE INTEGRATA (ROAS + ML IMPORTANCE) ---
-            # Estraiamo l'importanza delle feature dal modello Random Forest
-            importances = ml_model.feature_importances_
-            feature_names = ['Week_Sin', 'Week_Cos', col_google, col_meta, 'Lag_Sales_1', 'Lag_Sales_4'] # Da run_ml_forecast
-            for drv in businesses_found: feature_names.append(drv)
-            
-            fi_dict = dict(zip(feature_names, importances))
-            fi_g = fi_dict.get(col_google, 0)
-            fi_m = fi_dict.get(col_meta, 0)
-            
-            # Determinazione del "Vero Motore" del Business (ML vs ROAS)
-            ml_engine = "Google Ads" if fi_g > fi_m else "Meta Ads"
-            roas_efficiency = "Google Ads" if g_roas_last > m_roas_last else "Meta Ads"
-            
-            # Spiegazione approfondita delle tre voci tramite Tabs informative
-            st.divider()
-            opt_tabs = st.tabs(["📍 Setup Simulatore", "📂 Allocazione Consigliata", "⚖️ Nota sull'Attribuzione", "💶 EBITDA & Profitto"])
-
-            with opt_tabs[0]:
-                col_s1, col_s2 = st.columns([1, 2])
-                with col_s1:
-                    st.code(f"""
-Trend Futuro:  {rec_trend:+.1%}
-Budget Scale:  {rec_scale:.2f}x
-Saturazione:   {rec_sat:.2f}
-                    """)
-                    st.caption(f"Basato su MER attuale di **{mer_attuale:.2f}** vs Break-Even di **{be_roas_val:.2f}**.")
-                with col_s2:
-                    st.markdown(f"""
-                    **Logica dei Suggerimenti:**  
-                    Questi valori derivano dal tuo **Cuscinetto di Sicurezza** e non solo dal ROAS:
+            if tabs[7].open:
+                with st.spinner("🧠 Calcolo algoritmi predittivi in corso..."):
+                    df_ml, ml_model, businesses_found, rf_ctx, df_prophet, p_model, p_ctx = run_forecast_models()
+                
+                st.info("**Cosa fa:** Elabora una roadmap di investimento basata sulla tua efficienza reale e sui segnali tecnici dei canali.  \n**Logica:** Analizza il MER, le finestre di attribuzione e le metriche di saturazione (CPM, Frequency, CPC) per definire una scalabilità sostenibile.")
+                st.header("🎯 Analisi Strategica di Scalabilità")
+                
+                # --- LOGICA DI CALCOLO STRATEGICO AVANZATA ---
+                last_4 = df.tail(4)
+                prev_4 = df.iloc[-8:-4] if len(df) >= 8 else last_4
+                
+                g_spend_last = last_4[col_google].sum()
+                m_spend_last = last_4[col_meta].sum()
+                g_roas_last = last_4[col_g_val].sum() / g_spend_last if g_spend_last > 0 else 0
+                m_roas_last = last_4[col_m_val].sum() / m_spend_last if m_spend_last > 0 else 0
+                
+                # Segnali Tecnici (Ultimi 4w vs Precedenti 4w)
+                m_cpm_last = last_4[col_m_cpm].mean()
+                m_cpm_prev = prev_4[col_m_cpm].mean()
+                m_freq_last = last_4[col_m_freq].mean()
+                g_cpc_last = last_4[col_g_cpc].mean()
+                g_cpc_prev = prev_4[col_g_cpc].mean()
+                
+                m_cpm_delta = (m_cpm_last - m_cpm_prev) / m_cpm_prev if m_cpm_prev > 0 else 0
+                g_cpc_delta = (g_cpc_last - g_cpc_prev) / g_cpc_prev if g_cpc_prev > 0 else 0
+                
+                # Determinazione Canale Dominante e Bias di Attribuzione
+                best_channel = "Google Ads" if g_roas_last > m_roas_last else "Meta Ads"
+                performance_gap = abs(g_roas_last - m_roas_last) / max(g_roas_last, m_roas_last, 0.01)
+                
+                # Calcolo Budget Sostenibile basato su Forecasting
+                next_month_sales = df_prev.head(4)['Fatturato Previsto'].sum()
+                max_safe_budget = next_month_sales / be_roas_val
+                
+                # --- RENDERING UI PARTE 1: SEGNALI TECNICI ---
+                st.subheader("📡 Segnali di Mercato & Saturazione")
+                col_sig1, col_sig2, col_sig3 = st.columns(3)
+                
+                with col_sig1:
+                    st.metric("CPM Meta", f"€ {m_cpm_last:.2f}", delta=f"{m_cpm_delta:+.1%}", delta_color="inverse")
+                    if m_cpm_delta > 0.15: st.warning("⚠️ **Pressione Aste:** I costi pubblicitari su Meta sono in netto aumento.")
+                
+                with col_sig2:
+                    st.metric("Frequency Meta (4w)", f"{m_freq_last:.2f}")
+                    if m_freq_last > 1.4: st.error("🚨 **Saturazione:** Frequenza alta su Meta. Hai bisogno di nuovi creativi per scalare.")
+                    else: st.success("✅ **Audience Fresca:** Hai spazio per aumentare il budget su Meta.")
                     
-                    *   **Trend Futuro ({rec_trend:+.1%}):** Unisce la crescita YoY (+{growth_rate:1%}) con la capacità di assorbimento del mercato rilevata dall'IA.
-                    *   **Budget Scale ({rec_scale:.2f}x):** Poiché il tuo MER è {f'superiore del 30% al BE' if mer_attuale > be_roas_val * 1.3 else 'sopra il BE' if mer_attuale >= be_roas_val else 'sotto il BE'}, l'IA consiglia di {f'investire con un +{(rec_scale-1)*100:.0f}%' if rec_scale > 1 else 'ridurre la spesa'}. 
-                    *   **Saturazione ({rec_sat:.2f}):** Indica la reattività delle tue campagne. Più è alto, più l'IA crede che tu possa scalare senza distruggere il ROAS.
-                    """)
+                with col_sig3:
+                    st.metric("CPC Google Ads", f"€ {g_cpc_last:.2f}", delta=f"{g_cpc_delta:+.1%}", delta_color="inverse")
 
-            with opt_tabs[1]:
-                col_a1, col_a2 = st.columns([1, 2])
+                # --- PARTE 2: SUGGERIMENTO STRATEGICO ---
+                st.divider()
                 
-                # Split pesato con Bias Attribuzione: Diamo più peso al canale con più "Importanza" (Machine Learning)
-                # se ROAS e ML concordano, spingiamo ignorando. Se discordano, bilanciamo.
-                if ml_engine == roas_efficiency:
-                    split_best = 0.65 # Convergenza totale
-                    best_channel = roas_efficiency
+                # Logica Proposta Strategica
+                if mer_attuale > be_roas_val * 1.3:
+                    strat_title = "🚀 SCALABILITÀ AGGRESSIVA"
+                    strat_desc = "Le tue Unit Economics sono eccellenti. L'obiettivo è catturare quota di mercato dominando la scoperta (Meta) e scalando l'intenzione d'acquisto diretta (Google Shopping/PMax)."
+                    rec_scale, rec_trend, rec_sat = 1.25, growth_rate + 0.05, 0.92
+                elif mer_attuale >= be_roas_val:
+                    strat_title = "⚖️ CRESCITA EQUILIBRATA"
+                    strat_desc = "Sei in profitto. Focus sull'ottimizzazione del mix tra canali per massimizzare il profitto netto senza sprecare budget."
+                    rec_scale, rec_trend, rec_sat = 1.10, growth_rate, 0.85
                 else:
-                    split_best = 0.55 # Discordano: Prudenza, non togliere ossigeno al motore (ML)
-                    best_channel = ml_engine # Diamo precedenza a chi muove davvero il business secondo l'ML
+                    strat_title = "🛡️ DIFESA E OTTIMIZZAZIONE"
+                    strat_desc = "Stai operando vicino o sotto il break-even. Priorità al recupero dell'efficienza prima di qualsiasi aumento di spesa."
+                    rec_scale, rec_trend, rec_sat = 0.85, growth_rate - 0.05, 0.80
+
+                st.markdown(f"### 🤖 Suggerimento AI: **{strat_title}**")
+                st.write(strat_desc)
+
+                col_rec1, col_rec2 = st.columns([2, 1])
+                with col_rec1:
+                    st.info(f"""
+                    **Analisi Multimetrica:**
+                    * **Attribuzione:** {best_channel} ha un ROAS più alto, ma ricorda che Meta genera la domanda che Google spesso converte in Shopping. Non tagliare Meta se alimenta il volume di traffico "fresco".
+                    * **Finestre di conversione:** Google (30gg) intercetta l'intenzione d'acquisto nata spesso da impulsi visivi su Meta (7gg). Valuta il MER complessivo.
+                    * **Efficienza:** Il tuo cuscinetto di sicurezza è del **{((mer_attuale/be_roas_val)-1):+.1%}**.
+                    """)
                 
-                val_best = max_safe_budget * rec_scale * split_best
-                val_other = (max_safe_budget * rec_scale) - val_best
+                with col_rec2:
+                    st.metric("Target Budget Prossime 4w", f"€ {max_safe_budget * (rec_scale/1.1):,.0f}")
+                    st.caption("Budget totale stimato per mantenere il profitto operativo.")
+
+                st.divider()
+
+                col_p1, col_p2 = st.columns(2)
                 
-                with col_a1:
-                    st.success(f"**{best_channel}:**  \n€ {val_best:,.0f}")
-                    st.info(f"**Altro Canale:**  \n€ {val_other:,.0f}")
+                # --- LOGICA DI ALLOCAZIONE INTEGRATA (ROAS + ML IMPORTANCE) ---
+                # Estraiamo l'importanza delle feature dal modello Random Forest
+                importances = ml_model.feature_importances_
+                feature_names = ['Week_Sin', 'Week_Cos', col_google, col_meta, 'Lag_Sales_1', 'Lag_Sales_4'] # Da run_ml_forecast
+                for drv in businesses_found: feature_names.append(drv)
                 
-                with col_a2:
-                    st.markdown(f"""
-                    **Perché questa divisione?**  
-                    Abbiamo incrociato l'Efficienza (ROAS) con l'Impatto (Machine Learning):
-                    *   L'IA ha rilevato che **{ml_engine}** è il canale che **"muove maggiormente il fatturato"** (Feature Importance).
-                    *   Sebbene l'altro canale possa sembrare più efficiente a parità di spesa, togliere budget a {ml_engine} potrebbe causare un crollo delle vendite organiche o di ricerca.
-                    *   Consigliamo di mantenere il **{split_best*100:.0f}%** del budget su **{best_channel}** per stabilità.
-                    """)
-
-            with opt_tabs[2]:
-                st.markdown(f"""
-                ### ⚠️ Il Bias delle Finestre di Conversione
-                È fondamentale distinguere tra la **Funzione** dei canali:
+                fi_dict = dict(zip(feature_names, importances))
+                fi_g = fi_dict.get(col_google, 0)
+                fi_m = fi_dict.get(col_meta, 0)
                 
-                1.  **Meta Ads (Market Generation):** Intercetta la domanda latente. È il tuo **Motore di Scoperta**. Senza Meta, il volume di ricerche specifiche per i tuoi prodotti su Google potrebbe calare nel lungo termine.
-                2.  **Google Ads (Direct Intent):** Grazie a Shopping e PMax, cattura l'utente nel momento esatto del bisogno. È il tuo **Motore di Conversione**.
+                # Determinazione del "Vero Motore" del Business (ML vs ROAS)
+                ml_engine = "Google Ads" if fi_g > fi_m else "Meta Ads"
+                roas_efficiency = "Google Ads" if g_roas_last > m_roas_last else "Meta Ads"
                 
-                **Analisi AntiGravity:**  
-                Dall'analisi del Random Forest, risulta che la variabile **{col_google if fi_g > fi_m else col_meta}** correla meglio con le vendite finali. Anche se il ROAS sembra inferiore, non ridurlo: è il canale che garantisce la massa critica di ordini.
-                """)
+                # Spiegazione approfondita delle tre voci tramite Tabs informative
+                st.divider()
+                # Chiave del piano base: heuristic + input RF + previsione base Prophet (cambiano con dati, trend e orizzonte)
+                plan_arrays = heur_base + (rf_ctx[1], p_ctx[0]['yhat'].to_numpy(), np.array(rf_ctx[4:], dtype=np.float64))
+                plan_key = hashlib.sha1(b''.join(np.ascontiguousarray(a, dtype=np.float64).tobytes() for a in plan_arrays)).hexdigest()
+
+                def score_plan_ensemble(g_plan, m_plan):
+                    """Fatturato settimanale Ensemble (RF + Prophet) di un piano di spesa, con lo Stress Test corrente."""
+                    rf_model, exog_row, lag_idx, (i_g, i_m), lag1, lag4 = rf_ctx
+                    exog = exog_row.copy()[None]
+                    exog[0, :, i_g], exog[0, :, i_m] = g_plan, m_plan
+                    rf_sales = recursive_rf_forecast(rf_model, exog, lag_idx, lag1, lag4, stress_total_mult)[0]
+                    p_sales = prophet_plan_sales(p_ctx, g_plan, m_plan, stress_total_mult)
+                    return (rf_sales + p_sales) / 2
+
+                opt_tabs = st.tabs(["📍 Setup Simulatore", "📂 Allocazione Consigliata", "⚖️ Nota sull'Attribuzione", "💶 EBITDA & Profitto", "🗺️ Superficie Budget"])
+
+                with opt_tabs[0]:
+                    col_s1, col_s2 = st.columns([1, 2])
+                    with col_s1:
+                        st.code(f"""
+    Trend Futuro:  {rec_trend:+.1%}
+    Budget Scale:  {rec_scale:.2f}x
+    Saturazione:   {rec_sat:.2f}
+                        """)
+                        st.caption(f"Basato su MER attuale di **{mer_attuale:.2f}** vs Break-Even di **{be_roas_val:.2f}**.")
+                    with col_s2:
+                        st.markdown(f"""
+                        **Logica dei Suggerimenti:**  
+                        Questi valori derivano dal tuo **Cuscinetto di Sicurezza** e non solo dal ROAS:
+                        
+                        *   **Trend Futuro ({rec_trend:+.1%}):** Unisce la crescita YoY (+{growth_rate:1%}) con la capacità di assorbimento del mercato rilevata dall'IA.
+                        *   **Budget Scale ({rec_scale:.2f}x):** Poiché il tuo MER è {f'superiore del 30% al BE' if mer_attuale > be_roas_val * 1.3 else 'sopra il BE' if mer_attuale >= be_roas_val else 'sotto il BE'}, l'IA consiglia di {f'investire con un +{(rec_scale-1)*100:.0f}%' if rec_scale > 1 else 'ridurre la spesa'}. 
+                        *   **Saturazione ({rec_sat:.2f}):** Indica la reattività delle tue campagne. Più è alto, più l'IA crede che tu possa scalare senza distruggere il ROAS.
+                        """)
 
-            with opt_tabs[3]:
-                ebitda_val = (next_month_sales * rec_scale) - (max_safe_budget * rec_scale)
-                col_e1, col_e2 = st.columns([1, 2])
-                with col_e1:
-                    st.metric("EBITDA Stimato", f"€ {ebitda_val:,.0f}")
-                with col_e2:
+                with opt_tabs[1]:
+                    col_a1, col_a2 = st.columns([1, 2])
+                    
+                    # Split pesato con Bias Attribuzione: Diamo più peso al canale con più "Importanza" (Machine Learning)
+                    # se ROAS e ML concordano, spingiamo ignorando. Se discordano, bilanciamo.
+                    if ml_engine == roas_efficiency:
+                        split_best = 0.65 # Convergenza totale
+                        best_channel = roas_efficiency
+                    else:
+                        split_best = 0.55 # Discordano: Prudenza, non togliere ossigeno al motore (ML)
+                        best_channel = ml_engine # Diamo precedenza a chi muove davvero il business secondo l'ML
+                    
+                    val_best = max_safe_budget * rec_scale * split_best
+                    val_other = (max_safe_budget * rec_scale) - val_best
+                    
+                    with col_a1:
+                        st.success(f"**{best_channel}:**  \n€ {val_best:,.0f}")
+                        st.info(f"**Altro Canale:**  \n€ {val_other:,.0f}")
+                    
+                    with col_a2:
+                        st.markdown(f"""
+                        **Perché questa divisione?**  
+                        Abbiamo incrociato l'Efficienza (ROAS) con l'Impatto (Machine Learning):
+                        *   L'IA ha rilevato che **{ml_engine}** è il canale che **"muove maggiormente il fatturato"** (Feature Importance).
+                        *   Sebbene l'altro canale possa sembrare più efficiente a parità di spesa, togliere budget a {ml_engine} potrebbe causare un crollo delle vendite organiche o di ricerca.
+                        *   Consigliamo di mantenere il **{split_best*100:.0f}%** del budget su **{best_channel}** per stabilità.
+                        """)
+
+                    st.divider()
+                    st.markdown("#### 🧮 Ottimizzatore Numerico (Profitto Operativo)")
+                    st.caption("Cerca la spesa settimanale Google/Meta che massimizza il Profitto Operativo sull'orizzonte di previsione, con il budget totale e la variazione massima tra settimane come vincoli. Il piano ottenuto viene poi verificato con l'Ensemble (Random Forest + Prophet).")
+                    
+                    plan_g, plan_m = df_prev['Google Previsto'].to_numpy(), df_prev['Meta Previsto'].to_numpy()
+                    col_o1, col_o2, col_o3 = st.columns(3)
+                    opt_budget = col_o1.number_input("Budget Totale Orizzonte (€)", value=float(round(plan_g.sum() + plan_m.sum(), -2)), step=1000.0, min_value=0.0, key="opt_budget")
+                    opt_change = col_o2.slider("Variazione Max Settimanale (%)", 5, 100, 20, key="opt_change", help="Variazione massima della spesa tra due settimane consecutive, in % della spesa media settimanale del canale.") / 100
+                    opt_be = col_o3.checkbox("Vincolo MER ≥ Break-Even", value=True, key="opt_be")
+                    
+                    opt = optimize_budget_plan(plan_key, opt_budget, opt_change, be_aov, profit_order, be_roas_val if opt_be else None,
+                                               sat_factor, stress_total_mult, heur_base, p_ctx)
+                    if not opt['success']:
+                        st.warning(f"⚠️ Ottimizzatore non convergente ({opt['message']}): il piano mostrato è l'ultima iterazione, verifica budget e vincoli.")
+                    
+                    opt_sales = score_plan_ensemble(opt['google'], opt['meta'])
+                    cur_sales = score_plan_ensemble(plan_g, plan_m)
+                    opt_spend, cur_spend = opt['google'].sum() + opt['meta'].sum(), plan_g.sum() + plan_m.sum()
+                    opt_profit = opt_sales.sum() / be_aov * profit_order - opt_spend
+                    cur_profit = cur_sales.sum() / be_aov * profit_order - cur_spend
+                    
+                    col_r1, col_r2, col_r3, col_r4 = st.columns(4)
+                    col_r1.metric("Profitto Piano Ottimizzato", f"€ {opt_profit:,.0f}", delta=f"€ {opt_profit - cur_profit:+,.0f} vs piano attuale", help="Valutato con l'Ensemble (RF + Prophet).")
+                    col_r2.metric("Spesa Ads Ottimizzata", f"€ {opt_spend:,.0f}", delta=f"{(opt_spend - cur_spend) / cur_spend:+.1%}" if cur_spend > 0 else None, delta_color="off")
+                    col_r3.metric("Split Google / Meta", f"{opt['google'].sum() / opt_spend:.0%} / {opt['meta'].sum() / opt_spend:.0%}" if opt_spend > 0 else "-")
+                    col_r4.metric("MER Piano", f"{opt_sales.sum() / opt_spend:.2f}" if opt_spend > 0 else "-", delta=f"{opt_sales.sum() / opt_spend - be_roas_val:+.2f} vs BE" if opt_spend > 0 else None)
+                    
+                    fig_opt, ax_opt = plt.subplots(figsize=(10, 3.5))
+                    ax_opt.plot(df_prev['Data'], opt['google'], color=DARKEST_BLUE, linewidth=2, label='Google (Ottimizzato)')
+                    ax_opt.plot(df_prev['Data'], opt['meta'], color=META_COLOR, linewidth=2, label='Meta (Ottimizzato)')
+                    ax_opt.plot(df_prev['Data'], plan_g, color=DARKEST_BLUE, linestyle=':', alpha=0.6, label='Google (Piano Attuale)')
+                    ax_opt.plot(df_prev['Data'], plan_m, color=META_COLOR, linestyle=':', alpha=0.6, label='Meta (Piano Attuale)')
+                    ax_opt.set_title("Spesa Settimanale: Piano Ottimizzato vs Attuale", fontsize=10)
+                    ax_opt.legend(fontsize=8)
+                    st.pyplot(fig_opt)
+                    
+                    with st.expander("📋 Piano settimanale ottimizzato"):
+                        df_opt_plan = pd.DataFrame({
+                            'Periodo': df_prev['Periodo'], 'Google (€)': opt['google'], 'Meta (€)': opt['meta'],
+                            'Fatturato Ensemble (€)': opt_sales
+                        })
+                        st.dataframe(df_opt_plan.style.format({c: "€ {:,.0f}" for c in df_opt_plan.columns if c != 'Periodo'}), use_container_width=True, hide_index=True)
+
+                with opt_tabs[2]:
                     st.markdown(f"""
-                    **Il tuo guadagno reale (stimato)**  
-                    L'EBITDA (Earnings Before Interest, Taxes, Depreciation, and Amortization) qui rappresenta il tuo **Margine Operativo Lordo** previsto per il prossimo mese.
+                    ### ⚠️ Il Bias delle Finestre di Conversione
+                    È fondamentale distinguere tra la **Funzione** dei canali:
                     
-                    **Formula:** `Fatturato Previsto - Spesa Ads Prevista`
+                    1.  **Meta Ads (Market Generation):** Intercetta la domanda latente. È il tuo **Motore di Scoperta**. Senza Meta, il volume di ricerche specifiche per i tuoi prodotti su Google potrebbe calare nel lungo termine.
+                    2.  **Google Ads (Direct Intent):** Grazie a Shopping e PMax, cattura l'utente nel momento esatto del bisogno. È il tuo **Motore di Conversione**.
                     
-                    *Nota: Questo valore non tiene conto di costi fissi, tasse o costi di prodotto (COGS) non inseriti nella sidebar.*
+                    **Analisi AntiGravity:**  
+                    Dall'analisi del Random Forest, risulta che la variabile **{col_google if fi_g > fi_m else col_meta}** correla meglio con le vendite finali. Anche se il ROAS sembra inferiore, non ridurlo: è il canale che garantisce la massa critica di ordini.
                     """)
+
+                with opt_tabs[3]:
+                    ebitda_val = (next_month_sales * rec_scale) - (max_safe_budget * rec_scale)
+                    col_e1, col_e2 = st.columns([1, 2])
+                    with col_e1:
+                        st.metric("EBITDA Stimato", f"€ {ebitda_val:,.0f}")
+                    with col_e2:
+                        st.markdown(f"""
+                        **Il tuo guadagno reale (stimato)**  
+                        L'EBITDA (Earnings Before Interest, Taxes, Depreciation, and Amortization) qui rappresenta il tuo **Margine Operativo Lordo** previsto per il prossimo mese.
+                        
+                        **Formula:** `Fatturato Previsto - Spesa Ads Prevista`
+                        
+                        *Nota: Questo valore non tiene conto di costi fissi, tasse o costi di prodotto (COGS) non inseriti nella sidebar.*
+                        """)
+
+                with opt_tabs[4]:
+                    st.caption(f"Tutte le combinazioni di scala Google × Meta ({SURFACE_SCALES[0]:.1f}x–{SURFACE_SCALES[-1]:.1f}x) sull'orizzonte di {mesi_prev} mesi, con Saturazione e Stress Test correnti. La linea tratteggiata è il Break-Even ROAS ({be_roas_val:.2f}).")
+                    
+                    surface = response_surface(plan_key, SURFACE_SCALES, SURFACE_SCALES, sat_factor, stress_total_mult, heur_base, rf_ctx, p_ctx)
+                    
+                    col_sf1, col_sf2 = st.columns([1, 3])
+                    with col_sf1:
+                        surf_model = st.radio("Modello", [k for k in surface if k != 'Spesa'], index=len(surface) - 2, key="surface_model")
+                        surf_metric = st.radio("Metrica", ["Profitto Operativo", "Fatturato"], key="surface_metric")
+                    
+                    surf_sales = surface[surf_model]
+                    surf_spend = surface['Spesa']
+                    # Profitto Operativo = (Ordini Previsti * Profitto per Ordine) - Spesa Ads
+                    surf_profit = surf_sales / be_aov * profit_order - surf_spend
+                    surf_mer = np.divide(surf_sales, surf_spend, out=np.zeros_like(surf_sales), where=surf_spend > 0)
+                    surf_z = surf_profit if surf_metric == "Profitto Operativo" else surf_sales
+                    
+                    i_best, j_best = np.unravel_index(np.argmax(surf_profit), surf_profit.shape)
+                    i_cur, j_cur = np.abs(SURFACE_SCALES - m_google).argmin(), np.abs(SURFACE_SCALES - m_meta).argmin()
+                    
+                    with col_sf1:
+                        st.metric("Scala Ottimale (Profitto)", f"G {SURFACE_SCALES[i_best]:.1f}x · M {SURFACE_SCALES[j_best]:.1f}x")
+                        st.metric("Profitto Ottimale", f"€ {surf_profit[i_best, j_best]:,.0f}",
+                                  delta=f"€ {surf_profit[i_best, j_best] - surf_profit[i_cur, j_cur]:+,.0f} vs scenario attuale")
+                        st.metric("MER all'Ottimo", f"{surf_mer[i_best, j_best]:.2f}")
+                    
+                    with col_sf2:
+                        fig_sf, ax_sf = plt.subplots(figsize=(8, 6))
+                        cf = ax_sf.contourf(SURFACE_SCALES, SURFACE_SCALES, surf_z, levels=20, cmap='RdYlGn' if surf_metric == "Profitto Operativo" else 'Blues')
+                        fig_sf.colorbar(cf, ax=ax_sf, label=f"{surf_metric} (€)")
+                        if surf_mer.min() < be_roas_val < surf_mer.max():
+                            ax_sf.contour(SURFACE_SCALES, SURFACE_SCALES, surf_mer, levels=[be_roas_val], colors='black', linestyles='--', linewidths=1.5)
+                        ax_sf.scatter(SURFACE_SCALES[j_cur], SURFACE_SCALES[i_cur], marker='o', s=80, color='white', edgecolors='black', label='Scenario attuale', zorder=3)
+                        ax_sf.scatter(SURFACE_SCALES[j_best], SURFACE_SCALES[i_best], marker='*', s=200, color='gold', edgecolors='black', label='Massimo profitto', zorder=3)
+                        ax_sf.set_xlabel("Meta Ads Budget Scale")
+                        ax_sf.set_ylabel("Google Ads Budget Scale")
+                        ax_sf.set_title(f"{surf_metric} - {surf_model}", fontsize=10)
+                        ax_sf.legend(fontsize=8, loc='upper right')
+                        st.pyplot(fig_sf)
       
      
         with tabs[8]:
-            st.info("**Cosa fa:** Confronto Anno su Anno (YoY) per valutare la crescita strutturale del progetto.  \n**Logica:** Analizza metriche chiave come CPA, AOV e Retention Rate comparando periodi omogenei tra anni diversi.")
-            st.header("🏥 Stato di Salute del Progetto (YoY)")
-            
-            years_avail = sorted(df['Year'].unique(), reverse=True)
-            if len(years_avail) < 2:
-                st.warning("Dati insufficienti per un confronto YoY.")
-            else:
-                with st.expander("⚙️ Opzioni di Confronto", expanded=False):
-                    col_f1, col_f2 = st.columns(2)
-                    year_target = col_f1.selectbox("Anno", years_avail, index=0, key="year_t_9")
-                    year_comp = col_f2.selectbox("Confronta con", years_avail, index=min(1, len(years_avail)-1), key="year_c_9")
-
-                # --- LOGICA DI ALLINEAMENTO SETTIMANALE (INTERSEZIONE) ---
-                weeks_target = set(df[df['Year'] == year_target]['Week'].unique())
-                weeks_comp = set(df[df['Year'] == year_comp]['Week'].unique())
-                
-                # Intersezione: prendiamo solo le settimane presenti in ENTRAMBI gli anni
-                common_weeks = sorted(list(weeks_target.intersection(weeks_comp)))
+            if tabs[8].open:
+                st.info("**Cosa fa:** Confronto Anno su Anno (YoY) per valutare la crescita strutturale del progetto.  \n**Logica:** Analizza metriche chiave come CPA, AOV e Retention Rate comparando periodi omogenei tra anni diversi.")
+                st.header("🏥 Stato di Salute del Progetto (YoY)")
                 
-                def get_y_metrics(year, week_filter=None):
-                    d = df[df['Year'] == year].copy()
-                    if week_filter:
-                        d = d[d['Week'].isin(week_filter)]
+                years_avail = sorted(df['Year'].unique(), reverse=True)
+                if len(years_avail) < 2:
+                    st.warning("Dati insufficienti per un confronto YoY.")
+                else:
+                    with st.expander("⚙️ Opzioni di Confronto", expanded=False):
+                        col_f1, col_f2 = st.columns(2)
+                        year_target = col_f1.selectbox("Anno", years_avail, index=0, key="year_t_9")
+                        year_comp = col_f2.selectbox("Confronta con", years_avail, index=min(1, len(years_avail)-1), key="year_c_9")
+
+                    # --- LOGICA DI ALLINEAMENTO SETTIMANALE (INTERSEZIONE) ---
+                    # Intersezione: prendiamo solo le settimane presenti in ENTRAMBI gli anni
+                    common_mask = lfl_weeks(lfl_cube, year_target, year_comp)
+                    common_weeks = np.flatnonzero(common_mask).tolist()
+
+                    # Le statistiche di tutti gli anni e finestre LFL sono precalcolate: i selettori indicizzano soltanto
+                    health = health_metrics_table(lfl_key, lfl_cube, be_aov)
+                    mt = health.loc[(year_target, year_comp)]
+                    mc = health.loc[(year_comp, year_target)]
+
+                    st.subheader(f"🏥 Statistiche Vitali: {year_target} vs {year_comp}")
+                    
+                    # Notifica di Allineamento Tecnico
+                    with st.expander("🔬 Nota Tecnica: Metodologia di Confronto"):
+                        st.markdown(fr"""
+                        **Allineamento Temporale:**
+                        *   Il sistema ha individuato le settimane presenti in **entrambi** gli anni ({len(common_weeks)} settimane totali).
+                        *   Settimane incluse: `{common_weeks}`.
                         
-                    sales = d['Fatturato_Netto'].sum()
-                    spend = d['Spesa_Ads_Totale'].sum()
-                    orders = d['Orders'].sum() if 'Orders' in d.columns else (sales / be_aov)
-                    
-                    # Pulizia Returning Customer Rate
-                    if 'Returning customer rate' in d.columns:
-                        ret_values = d['Returning customer rate'].astype(str).str.replace('%', '').str.strip()
-                        ret_mean = pd.to_numeric(ret_values, errors='coerce').mean()
-                    else:
-                        ret_mean = 0
-
-                    aov = sales / orders if orders > 0 else 0
-                    cpa = spend / orders if orders > 0 else 0
-                    ret_rate = ret_mean / 100
-                    # Formula LTV Proxy: AOV / (1 - Retention Rate)
-                    ltv = aov / (1 - ret_rate) if ret_rate < 0.99 else aov
-                    ltv_cpa_ratio = ltv / cpa if cpa > 0 else 0
-
-                    return {
-                        'sales': sales,
-                        'mer': sales / spend if spend > 0 else 0,
-                        'cpa': cpa,
-                        'cpc_g': d[col_g_cpc].mean() if col_g_cpc in d.columns else 0,
-                        'cpc_m': d[col_m_cpc].mean() if col_m_cpc in d.columns else 0,
-                        'cpm_m': d[col_m_cpm].mean() if col_m_cpm in d.columns else 0,
-                        'freq_m': d[col_m_freq].mean() if col_m_freq in d.columns else 0,
-                        'imps_g': d[col_g_imps].sum() if col_g_imps in d.columns else 0,
-                        'aov': aov,
-                        'returns': (d['Returns'].abs().sum() / sales * 100) if sales > 0 else 0,
-                        'ret': ret_mean,
-                        'ltv': ltv,
-                        'ltv_cpa': ltv_cpa_ratio,
-                        'weeks_count': d['Week'].nunique(),
-                        'week_list': sorted(d['Week'].unique().tolist())
-                    }
-
-                # Applichiamo l'intersezione per un confronto 1:1 perfetto
-                mt = get_y_metrics(year_target, week_filter=common_weeks)
-                mc = get_y_metrics(year_comp, week_filter=common_weeks)
-
-                st.subheader(f"🏥 Statistiche Vitali: {year_target} vs {year_comp}")
-                
-                # Notifica di Allineamento Tecnico
-                with st.expander("🔬 Nota Tecnica: Metodologia di Confronto"):
-                    st.markdown(fr"""
-                    **Allineamento Temporale:**
-                    *   Il sistema ha individuato le settimane presenti in **entrambi** gli anni ({len(common_weeks)} settimane totali).
-                    *   Settimane incluse: `{common_weeks}`.
-                    
-                    **Calcolo Lifetime Value (LTV):**
-                    *   Utilizziamo la formula predittiva: $LTV = \frac{{AOV}}{{1 - Retention Rate}}$
-                    *   Questo valore indica quanto fatturato genera mediamente un cliente nel tempo, considerando la sua propensione al riacquisto attuale.
+                        **Calcolo Lifetime Value (LTV):**
+                        *   Utilizziamo la formula predittiva: $LTV = \frac{{AOV}}{{1 - Retention Rate}}$
+                        *   Questo valore indica quanto fatturato genera mediamente un cliente nel tempo, considerando la sua propensione al riacquisto attuale.
+                        """)
+
+                    # Caption sui periodi
+                    col_cap1, col_cap2 = st.columns(2)
+                    with col_cap1:
+                        st.caption(f"📅 **{year_target}**: {mt['weeks_count']:.0f} settimane selezionate")
+                    with col_cap2:
+                        st.caption(f"📅 **{year_comp}**: {mc['weeks_count']:.0f} settimane selezionate")
+                    
+                    st.info(f"💡 **Confronto 1:1 Attivo:** Analisi basata sulle {len(common_weeks)} settimane comuni rilevate.")
+                    st.divider()
+
+                    # --- RIGA 1: FINANCIALS ---
+                    st.subheader("💰 Performance Finanziaria (PTD)")
+                    c1, c2, c3, c4 = st.columns(4)
+                    with c1:
+                        delta_sales = ((mt['sales'] - mc['sales']) / mc['sales'] * 100) if mc['sales'] > 0 else 0
+                        st.metric("Fatturato", f"€ {mt['sales']:,.0f}", f"{delta_sales:+.1f}%", help="Somma totale del Fatturato Netto nel periodo selezionato. Rappresenta il volume d'affari lordo al netto di IVA.")
+                    with c2:
+                        st.metric("ROAS (MER)", f"{mt['mer']:.2f}", f"{(mt['mer'] - mc['mer']):+.2f}", help="Marketing Efficiency Ratio. Calcolato come Fatturato Totale / Spesa Ads Totale. Indica l'efficienza globale di ogni euro investito in pubblicità.")
+                    with c3:
+                        delta_cpa = ((mt['cpa'] - mc['cpa']) / mc['cpa'] * 100) if mc['cpa'] > 0 else 0
+                        st.metric("CPA Medio", f"€ {mt['cpa']:.2f}", f"{delta_cpa:+.1f}%", delta_color="inverse", help="Costo Per Acquisizione. Calcolato come Spesa Ads Totale / Numero Ordini. Indica quanto paghi in media per ottenere una vendita.")
+                    with c4:
+                        delta_aov = ((mt['aov'] - mc['aov']) / mc['aov'] * 100) if mc['aov'] > 0 else 0
+                        st.metric("Carrello Medio (AOV)", f"€ {mt['aov']:.2f}", f"{delta_aov:+.1f}%", help="Average Order Value. Fatturato Totale / Numero Ordini. Indica la spesa media di un cliente per singolo acquisto.")
+
+                    st.divider()
+
+                    # --- RIGA 2: TECHNICAL HEALTH ---
+                    st.subheader("📡 Analisi Tecnica Canali (Deep Dive)")
+                    ct1, ct2, ct3, ct4 = st.columns(4)
+                    with ct1:
+                        delta_cpm = ((mt['cpm_m'] - mc['cpm_m']) / mc['cpm_m'] * 100) if mc['cpm_m'] > 0 else 0
+                        st.metric("CPM Meta", f"€ {mt['cpm_m']:.2f}", f"{delta_cpm:+.1f}%", delta_color="inverse", help="Cost Per Mille. Costo medio pagato su Meta per 1.000 visualizzazioni dell'annuncio.")
+                    with ct2:
+                        delta_freq = mt['freq_m'] - mc['freq_m']
+                        st.metric("Frequency Meta", f"{mt['freq_m']:.2f}", f"{delta_freq:+.2f}", help="Frequenza media. Indica quante volte mediamente una persona ha visto i tuoi annunci su Meta. Un valore troppo alto (sopra 3-4) può indicare saturazione del pubblico.")
+                    with ct3:
+                        delta_cpc_g = ((mt['cpc_g'] - mc['cpc_g']) / mc['cpc_g'] * 100) if mc['cpc_g'] > 0 else 0
+                        st.metric("CPC Google", f"€ {mt['cpc_g']:.2f}", f"{delta_cpc_g:+.1f}%", delta_color="inverse", help="Cost Per Click. Costo medio pagato per ogni click sui tuoi annunci Google.")
+                    with ct4:
+                        delta_imps = ((mt['imps_g'] - mc['imps_g']) / mc['imps_g'] * 100) if mc['imps_g'] > 0 else 0
+                        st.metric("Impression Google", f"{mt['imps_g']:,.0f}", f"{delta_imps:+.1f}%", help="Somma totale delle visualizzazioni ottenute sui posizionamenti Google Ads.")
+
+                    st.info(f"""
+                    **Diagnostica Rapida:**
+                    * {'🔴 **Meta Saturazione:** La frequenza è aumentata!' if mt['freq_m'] > mc['freq_m'] else '🟢 **Meta Audience:** La frequenza è stabile o in calo.'}
+                    * {'🔴 **Costi in ascesa:** Il CPM di Meta è aumentato del ' + f"{delta_cpm:.1f}%" if delta_cpm > 5 else '🟢 **Efficienza Costi:** I costi delle aste sono sotto controllo.'}
+                    * {'🔵 **Visibilità Google:** Hai ottenuto il ' + f"{delta_imps:+.1f}%" + ' di impression rispetto al passato.'}
+                    """)
+                    
+                    st.divider()
+
+                    # --- RIGA 3: BRAND SOLIDITY & LTV ---
+                    st.subheader("🛠️ Solidità del Brand & Lifetime Value")
+                    st.write("Formula: $LTV = AOV / (1 - Retention Rate)$")
+                    c_op1, c_op2, c_op3, c_op4 = st.columns(4)
+                    with c_op1:
+                        delta_ret = mt['ret'] - mc['ret']
+                        st.metric("Retention Rate", f"{mt['ret']:.2f}%", f"{delta_ret:+.2f}% (pt)", help="Percentuale di clienti che tornano ad acquistare. Estratto direttamente dalla colonna 'Returning customer rate' del tuo report Shopify.")
+                    with c_op2:
+                        delta_res = mt['returns'] - mc['returns']
+                        st.metric("Incidenza Resi", f"{mt['returns']:.1f}%", f"{delta_res:+.1f}% (pt)", delta_color="inverse", help="Rapporto tra il valore dei resi/rimborsi e il fatturato lordo. Indica la qualità della vendita e della logistica.")
+                    with c_op3:
+                        delta_ltv = ((mt['ltv'] - mc['ltv']) / mc['ltv'] * 100) if mc['ltv'] > 0 else 0
+                        st.metric("LTV Stimato (12m)", f"€ {mt['ltv']:,.2f}", f"{delta_ltv:+.1f}%", help="Lifetime Value Stimato. Calcolato matematicamente come AOV / (1 - Retention Rate). Indica quanto vale mediamente un cliente in un anno.")
+                    with c_op4:
+                        delta_ratio = mt['ltv_cpa'] - mc['ltv_cpa']
+                        st.metric("LTV / CPA Ratio", f"{mt['ltv_cpa']:.2f}", f"{delta_ratio:+.2f}", help="Indice di sostenibilità. Rapporto tra quanto il cliente vale nel tempo (LTV) e quanto costa acquisirlo (CPA). Un valore sopra 3.0 indica eccellente scalabilità.")
+
+                    st.info(f"""
+                    **Analisi Qualitativa & Valore Cliente:**
+                    * {'🟢 **LTV in crescita:** Ogni nuovo cliente acquisito oggi vale più che in passato.' if mt['ltv'] > mc['ltv'] else '🟡 **LTV Statico:** Il valore nel tempo del cliente non sta crescendo. Lavora su bundle e cross-selling.'}
+                    * {'  **Efficienza Scalabilità:**' if mt['ltv_cpa'] > 3 else '⚖️ **Efficienza Moderata:**'} Il tuo rapporto LTV/CPA è di **{mt['ltv_cpa']:.2f}**. {'Puoi permetterti di alzare il CAC per dominare il mercato.' if mt['ltv_cpa'] > 3 else 'Monitora attentamente i costi di acquisizione.'}
                     """)
-
-                # Caption sui periodi
-                col_cap1, col_cap2 = st.columns(2)
-                with col_cap1:
-                    st.caption(f"📅 **{year_target}**: {mt['weeks_count']} settimane selezionate")
-                with col_cap2:
-                    st.caption(f"📅 **{year_comp}**: {mc['weeks_count']} settimane selezionate")
-                
-                st.info(f"💡 **Confronto 1:1 Attivo:** Analisi basata sulle {len(common_weeks)} settimane comuni rilevate.")
-                st.divider()
-
-                # --- RIGA 1: FINANCIALS ---
-                st.subheader("💰 Performance Finanziaria (PTD)")
-                c1, c2, c3, c4 = st.columns(4)
-                with c1:
-                    delta_sales = ((mt['sales'] - mc['sales']) / mc['sales'] * 100) if mc['sales'] > 0 else 0
-                    st.metric("Fatturato", f"€ {mt['sales']:,.0f}", f"{delta_sales:+.1f}%", help="Somma totale del Fatturato Netto nel periodo selezionato. Rappresenta il volume d'affari lordo al netto di IVA.")
-                with c2:
-                    st.metric("ROAS (MER)", f"{mt['mer']:.2f}", f"{(mt['mer'] - mc['mer']):+.2f}", help="Marketing Efficiency Ratio. Calcolato come Fatturato Totale / Spesa Ads Totale. Indica l'efficienza globale di ogni euro investito in pubblicità.")
-                with c3:
-                    delta_cpa = ((mt['cpa'] - mc['cpa']) / mc['cpa'] * 100) if mc['cpa'] > 0 else 0
-                    st.metric("CPA Medio", f"€ {mt['cpa']:.2f}", f"{delta_cpa:+.1f}%", delta_color="inverse", help="Costo Per Acquisizione. Calcolato come Spesa Ads Totale / Numero Ordini. Indica quanto paghi in media per ottenere una vendita.")
-                with c4:
-                    delta_aov = ((mt['aov'] - mc['aov']) / mc['aov'] * 100) if mc['aov'] > 0 else 0
-                    st.metric("Carrello Medio (AOV)", f"€ {mt['aov']:.2f}", f"{delta_aov:+.1f}%", help="Average Order Value. Fatturato Totale / Numero Ordini. Indica la spesa media di un cliente per singolo acquisto.")
-
-                st.divider()
-
-                # --- RIGA 2: TECHNICAL HEALTH ---
-                st.subheader("📡 Analisi Tecnica Canali (Deep Dive)")
-                ct1, ct2, ct3, ct4 = st.columns(4)
-                with ct1:
-                    delta_cpm = ((mt['cpm_m'] - mc['cpm_m']) / mc['cpm_m'] * 100) if mc['cpm_m'] > 0 else 0
-                    st.metric("CPM Meta", f"€ {mt['cpm_m']:.2f}", f"{delta_cpm:+.1f}%", delta_color="inverse", help="Cost Per Mille. Costo medio pagato su Meta per 1.000 visualizzazioni dell'annuncio.")
-                with ct2:
-                    delta_freq = mt['freq_m'] - mc['freq_m']
-                    st.metric("Frequency Meta", f"{mt['freq_m']:.2f}", f"{delta_freq:+.2f}", help="Frequenza media. Indica quante volte mediamente una persona ha visto i tuoi annunci su Meta. Un valore troppo alto (sopra 3-4) può indicare saturazione del pubblico.")
-                with ct3:
-                    delta_cpc_g = ((mt['cpc_g'] - mc['cpc_g']) / mc['cpc_g'] * 100) if mc['cpc_g'] > 0 else 0
-                    st.metric("CPC Google", f"€ {mt['cpc_g']:.2f}", f"{delta_cpc_g:+.1f}%", delta_color="inverse", help="Cost Per Click. Costo medio pagato per ogni click sui tuoi annunci Google.")
-                with ct4:
-                    delta_imps = ((mt['imps_g'] - mc['imps_g']) / mc['imps_g'] * 100) if mc['imps_g'] > 0 else 0
-                    st.metric("Impression Google", f"{mt['imps_g']:,.0f}", f"{delta_imps:+.1f}%", help="Somma totale delle visualizzazioni ottenute sui posizionamenti Google Ads.")
-
-                st.info(f"""
-                **Diagnostica Rapida:**
-                * {'🔴 **Meta Saturazione:** La frequenza è aumentata!' if mt['freq_m'] > mc['freq_m'] else '🟢 **Meta Audience:** La frequenza è stabile o in calo.'}
-                * {'🔴 **Costi in ascesa:** Il CPM di Meta è aumentato del ' + f"{delta_cpm:.1f}%" if delta_cpm > 5 else '🟢 **Efficienza Costi:** I costi delle aste sono sotto controllo.'}
-                * {'🔵 **Visibilità Google:** Hai ottenuto il ' + f"{delta_imps:+.1f}%" + ' di impression rispetto al passato.'}
-                """)
-                
-                st.divider()
-
-                # --- RIGA 3: BRAND SOLIDITY & LTV ---
-                st.subheader("🛠️ Solidità del Brand & Lifetime Value")
-                st.write("Formula: $LTV = AOV / (1 - Retention Rate)$")
-                c_op1, c_op2, c_op3, c_op4 = st.columns(4)
-                with c_op1:
-                    delta_ret = mt['ret'] - mc['ret']
-                    st.metric("Retention Rate", f"{mt['ret']:.2f}%", f"{delta_ret:+.2f}% (pt)", help="Percentuale di clienti che tornano ad acquistare. Estratto direttamente dalla colonna 'Returning customer rate' del tuo report Shopify.")
-                with c_op2:
-                    delta_res = mt['returns'] - mc['returns']
-                    st.metric("Incidenza Resi", f"{mt['returns']:.1f}%", f"{delta_res:+.1f}% (pt)", delta_color="inverse", help="Rapporto tra il valore dei resi/rimborsi e il fatturato lordo. Indica la qualità della vendita e della logistica.")
-                with c_op3:
-                    delta_ltv = ((mt['ltv'] - mc['ltv']) / mc['ltv'] * 100) if mc['ltv'] > 0 else 0
-                    st.metric("LTV Stimato (12m)", f"€ {mt['ltv']:,.2f}", f"{delta_ltv:+.1f}%", help="Lifetime Value Stimato. Calcolato matematicamente come AOV / (1 - Retention Rate). Indica quanto vale mediamente un cliente in un anno.")
-                with c_op4:
-                    delta_ratio = mt['ltv_cpa'] - mc['ltv_cpa']
-                    st.metric("LTV / CPA Ratio", f"{mt['ltv_cpa']:.2f}", f"{delta_ratio:+.2f}", help="Indice di sostenibilità. Rapporto tra quanto il cliente vale nel tempo (LTV) e quanto costa acquisirlo (CPA). Un valore sopra 3.0 indica eccellente scalabilità.")
-
-                st.info(f"""
-                **Analisi Qualitativa & Valore Cliente:**
-                * {'🟢 **LTV in crescita:** Ogni nuovo cliente acquisito oggi vale più che in passato.' if mt['ltv'] > mc['ltv'] else '🟡 **LTV Statico:** Il valore nel tempo del cliente non sta crescendo. Lavora su bundle e cross-selling.'}
-                * {'  **Efficienza Scalabilità:**' if mt['ltv_cpa'] > 3 else '⚖️ **Efficienza Moderata:**'} Il tuo rapporto LTV/CPA è di **{mt['ltv_cpa']:.2f}**. {'Puoi permetterti di alzare il CAC per dominare il mercato.' if mt['ltv_cpa'] > 3 else 'Monitora attentamente i costi di acquisizione.'}
-                """)
 
         with tabs[9]:
-            st.header("🌍 Market Intelligence: Weather Timeline")
-            st.info("""
-            **Sincronizzazione Eventi:** Questa sezione analizza come i fattori climatici hanno influenzato le tue vendite giorno per giorno. 
-            Sposta lo slider per vedere l'evoluzione del meteo sull'Italia in tempo reale.
-            """)
-
-            # 1. Recupero date totali dal CSV
-            full_start = df['Data_Interna'].min()
-            full_end = df['Data_Interna'].max()
-
-            # 2. Logica Weather Time-Series (Open-Meteo)
-            @st.cache_data(ttl=86400) # Cache 24h visto che sono dati storici fissi
-            def fetch_weather_timeseries(start_date, end_date):
-                cities = {
-                    'Milano': (45.46, 9.19), 'Torino': (45.07, 7.68), 'Venezia': (45.44, 12.31),
-                    'Bologna': (44.49, 11.34), 'Genova': (44.40, 8.94), 'Firenze': (43.76, 11.25),
-                    'Ancona': (43.61, 13.51), 'Perugia': (43.11, 12.38), 'Roma': (41.90, 12.49),
-                    'Pescara': (42.46, 14.21), 'Napoli': (40.85, 14.26), 'Bari': (41.11, 16.87),
-                    'Potenza': (40.64, 15.80), 'Catanzaro': (38.90, 16.58), 'Palermo': (38.11, 13.36),
-                    'Catania': (37.50, 15.08), 'Cagliari': (39.22, 9.12), 'Sassari': (40.72, 8.56),
-                    'Trento': (46.06, 11.12), 'Trieste': (45.64, 13.77)
-                }
-                
-                lats = ",".join([str(c[0]) for c in cities.values()])
-                lons = ",".join([str(c[1]) for c in cities.values()])
-                s_str = start_date.strftime('%Y-%m-%d')
-                e_str = end_date.strftime('%Y-%m-%d')
-                
-                # Limitiamo il range per non sovraccaricare l'API (max 6 mesi per test)
-                is_recent = (datetime.now() - end_date).days < 5
-                base_url = "https://api.open-meteo.com/v1/forecast" if is_recent else "https://archive-api.open-meteo.com/v1/archive"
-                url = f"{base_url}?latitude={lats}&longitude={lons}&start_date={s_str}&end_date={e_str}&daily=temperature_2m_max,precipitation_sum&timezone=Europe%2FBerlin"
-                
-                all_days_data = []
-                try:
-                    resp = requests.get(url, timeout=15).json()
-                    if not isinstance(resp, list): resp = [resp]
-                    
-                    for i, (city, coords) in enumerate(cities.items()):
-                        data = resp[i]
-                        if 'daily' in data:
-                            for day_idx in range(len(data['daily']['time'])):
-                                t = data['daily']['temperature_2m_max'][day_idx]
-                                r = data['daily']['precipitation_sum'][day_idx]
-                                d = data['daily']['time'][day_idx]
-                                
-                                # Heatmap color
-                                if t < 5: c = '#0000FF'
-                                elif t < 12: c = '#3498db'
-                                elif t < 20: c = '#f1c40f'
-                                elif t < 28: c = '#e67e22'
-                                else: c = '#e74c3c'
-                                
-                                all_days_data.append({
-                                    'Date': d, 'City': city, 'lat': coords[0], 'lon': coords[1],
-                                    'temp': t, 'rain': r, 'color': c, 'size': 6000 + (r * 400)
-                                })
-                except Exception as ex:
-                    st.error(f"Errore API: {ex}")
-                return pd.DataFrame(all_days_data)
-
-            # --- ESECUZIONE PLAYER ---
-            st.write("---")
-            weather_full_df = fetch_weather_timeseries(full_start, full_end)
+            if tabs[9].open:
+                st.header("🌍 Market Intelligence: Weather Timeline")
+                st.info("""
+                **Sincronizzazione Eventi:** Questa sezione analizza come i fattori climatici hanno influenzato le tue vendite giorno per giorno. 
+                Sposta lo slider per vedere l'evoluzione del meteo sull'Italia in tempo reale.
+                """)
 
-            if not weather_full_df.empty:
-                # Slider Temporale
-                unique_days = sorted(weather_full_df['Date'].unique())
-                sel_date_str = st.select_slider("📅 Seleziona il giorno da analizzare", options=unique_days, value=unique_days[-1])
-                
-                # Filtraggio dati per il giorno scelto
-                day_weather = weather_full_df[weather_full_df['Date'] == sel_date_str]
-                
-                # Visualizzazione Mappa Dinamica
-                st.subheader(f"🌦️ Stato Meteo Italia: {datetime.strptime(sel_date_str, '%Y-%m-%d').strftime('%d %B %Y')}")
-                st.map(day_weather, color='color', size='size')
-                
-                col_w1, col_w2, col_w3 = st.columns(3)
-                col_w1.metric("Temperatura Media", f"{day_weather['temp'].mean():.1f}°C")
-                col_w2.metric("Precipitazioni Max", f"{day_weather['rain'].max():.1f} mm")
-                col_w3.metric("Città più Calda", day_weather.loc[day_weather['temp'].idxmax()]['City'])
-
-                # Correlazione con i dati del business
-                target_dt = pd.to_datetime(sel_date_str)
-                biz_day = df[df['Data_Interna'].dt.date == target_dt.date()]
-                
-                if not biz_day.empty:
-                    st.write("---")
-                    st.subheader("📊 Performance Business del Giorno")
-                    cb1, cb2 = st.columns(2)
-                    day_sales = biz_day['Fatturato_Netto'].values[0]
-                    day_mer = biz_day['Fatturato_Netto'].values[0] / biz_day['Spesa_Ads_Totale'].values[0] if biz_day['Spesa_Ads_Totale'].values[0] > 0 else 0
+                # 1. Recupero date totali dal CSV
+                full_start = df['Data_Interna'].min()
+                full_end = df['Data_Interna'].max()
+
+                # 2. Meteo dall'archivio locale: dal provider (Open-Meteo o file locale) solo le date mancanti
+                # --- ESECUZIONE PLAYER ---
+                st.write("---")
+                weather_error = sync_weather_store(full_start, full_end, WEATHER_PROVIDER)
+                if weather_error is not None: st.error(f"Errore API: {weather_error}")
+                weather_version = weather_store_version()
+                weather_full_df = load_weather_timeseries(full_start, full_end, weather_version)
+
+                if not weather_full_df.empty:
+                    # Slider Temporale
+                    unique_days = sorted(weather_full_df['Date'].unique())
+                    sel_date_str = st.select_slider("📅 Seleziona il giorno da analizzare", options=unique_days, value=unique_days[-1])
                     
-                    cb1.metric("Fatturato Giorno", f"€ {day_sales:,.0f}")
-                    cb2.metric("MER Reale Giorno", f"{day_mer:.2f}")
+                    # Filtraggio dati per il giorno scelto
+                    day_weather = weather_full_df[weather_full_df['Date'] == sel_date_str]
                     
-                    st.info(f"💡 **Insight AI:** In questa giornata di {day_weather.loc[day_weather['temp'].idxmin()]['status'] if 'status' in day_weather else 'clima variabile'}, il business ha generato un'efficienza di {day_mer:.2f}. {'Ottima correlazione con il maltempo!' if day_weather['rain'].sum() > 30 else 'Performance guidata da fattori interni (Ads/Promo).'}")
-            else:
-                st.warning("Caricamento dati meteo in corso o fallito. Verifica la connessione.")
+                    # Visualizzazione Mappa Dinamica
+                    st.subheader(f"🌦️ Stato Meteo Italia: {datetime.strptime(sel_date_str, '%Y-%m-%d').strftime('%d %B %Y')}")
+                    st.map(day_weather, color='color', size='size')
+                    
+                    col_w1, col_w2, col_w3 = st.columns(3)
+                    col_w1.metric("Temperatura Media", f"{day_weather['temp'].mean():.1f}°C")
+                    col_w2.metric("Precipitazioni Max", f"{day_weather['rain'].max():.1f} mm")
+                    col_w3.metric("Città più Calda", day_weather.loc[day_weather['temp'].idxmax()]['City'])
+
+                    # Correlazione con i dati del business
+                    target_dt = pd.to_datetime(sel_date_str)
+                    biz_day = df[df['Data_Interna'].dt.date == target_dt.date()]
+                    
+                    if not biz_day.empty:
+                        st.write("---")
+                        st.subheader("📊 Performance Business del Giorno")
+                        cb1, cb2 = st.columns(2)
+                        day_sales = biz_day['Fatturato_Netto'].values[0]
+                        day_mer = biz_day['Fatturato_Netto'].values[0] / biz_day['Spesa_Ads_Totale'].values[0] if biz_day['Spesa_Ads_Totale'].values[0] > 0 else 0
+                        
+                        cb1.metric("Fatturato Giorno", f"€ {day_sales:,.0f}")
+                        cb2.metric("MER Reale Giorno", f"{day_mer:.2f}")
+                        
+                        st.info(f"💡 **Insight AI:** In questa giornata di {day_weather.loc[day_weather['temp'].idxmin()]['status'] if 'status' in day_weather else 'clima variabile'}, il business ha generato un'efficienza di {day_mer:.2f}. {'Ottima correlazione con il maltempo!' if day_weather['rain'].sum() > 30 else 'Performance guidata da fattori interni (Ads/Promo).'}")
+                else:
+                    st.warning("Caricamento dati meteo in corso o fallito. Verifica la connessione.")
 
-            st.divider()
-            
-            # --- SEZIONE 3: STRATEGIC CORRELATION LEDGER ---
-            st.subheader("📊 Strategic Correlation Ledger (LFL Monthly)")
-            st.info("Questa tabella incrocia i tuoi KPI con i 'fatti del mondo' per identificare le cause esterne di successo o fallimento.")
-            
-            # Prepariamo i dati mensili degli ultimi 12 mesi
-            df_last_12 = df[df['Data_Interna'] > (full_end - timedelta(days=365))].copy()
-            df_last_12['Month_Year'] = df_last_12['Data_Interna'].dt.strftime('%Y-%m')
-            
-            monthly_biz = df_last_12.groupby('Month_Year').agg({
-                'Fatturato_Netto': 'sum',
-                'Spesa_Ads_Totale': 'sum',
-                'Data_Interna': 'min'
-            }).reset_index()
-            
-            monthly_biz['MER'] = monthly_biz['Fatturato_Netto'] / monthly_biz['Spesa_Ads_Totale']
-            
-            # Database Eventi Sincronizzato (Espanso)
-            events_template = [
-                {"month": 1, "day_start": 3, "day_end": 31, "title": "🛍️ Saldi Invernali", "type": "Commercial", "desc": "Sconti stagionali massicci."},
-                {"month": 2, "day_start": 5, "day_end": 12, "title": "🎶 Festival di Sanremo", "type": "Cultural", "desc": "Picco di attenzione media su TV/Social."},
-                {"month": 2, "day_start": 10, "day_end": 14, "title": "❤️ San Valentino", "type": "Commercial", "desc": "Focus su gifting."},
-                {"month": 4, "day_start": 1, "day_end": 15, "title": "🐣 Pasqua", "type": "Cultural", "desc": "Festività nazionali."},
-                {"month": 5, "day_start": 1, "day_end": 12, "title": "💐 Festa della Mamma", "type": "Commercial", "desc": "Lifestyle gifting."},
-                {"month": 7, "day_start": 1, "day_end": 31, "title": "☀️ Saldi Estivi", "type": "Commercial", "desc": "Svuotamento inventory."},
-                {"month": 11, "day_start": 20, "day_end": 30, "title": "🖤 Black Friday", "type": "Commercial", "desc": "Picco annuale Ads."},
-                {"month": 12, "day_start": 1, "day_end": 24, "title": "🎄 Natale", "type": "Commercial", "desc": "Massimo volume ordini."},
-            ]
+                st.divider()
+                
+                # --- SEZIONE 3: STRATEGIC CORRELATION LEDGER ---
+                st.subheader("📊 Strategic Correlation Ledger (LFL Monthly)")
+                st.info("Questa tabella incrocia i tuoi KPI con i 'fatti del mondo' per identificare le cause esterne di successo o fallimento.")
+                
+                # Prepariamo i dati mensili della finestra scelta (default: ultimi 12 mesi)
+                ledger_window = st.selectbox("🗓️ Finestra del Ledger", ["Ultimi 12 mesi", "Ultimi 24 mesi", "Ultimi 36 mesi", "Tutto lo storico"], key="ledger_window")
+                ledger_days = {"Ultimi 12 mesi": 365, "Ultimi 24 mesi": 730, "Ultimi 36 mesi": 1095}.get(ledger_window)
+                df_last_12 = df[df['Data_Interna'] > (full_end - timedelta(days=ledger_days))].copy() if ledger_days else df.copy()
+                df_last_12['Month_Year'] = df_last_12['Data_Interna'].dt.strftime('%Y-%m')
+                
+                monthly_biz = df_last_12.groupby('Month_Year').agg({
+                    'Fatturato_Netto': 'sum',
+                    'Spesa_Ads_Totale': 'sum',
+                    'Data_Interna': 'min'
+                }).reset_index()
+                
+                monthly_biz['MER'] = monthly_biz['Fatturato_Netto'] / monthly_biz['Spesa_Ads_Totale']
+                
+                # Database Eventi Sincronizzato (Espanso)
+                events_template = [
+                    {"month": 1, "day_start": 3, "day_end": 31, "title": "🛍️ Saldi Invernali", "type": "Commercial", "desc": "Sconti stagionali massicci."},
+                    {"month": 2, "day_start": 5, "day_end": 12, "title": "🎶 Festival di Sanremo", "type": "Cultural", "desc": "Picco di attenzione media su TV/Social."},
+                    {"month": 2, "day_start": 10, "day_end": 14, "title": "❤️ San Valentino", "type": "Commercial", "desc": "Focus su gifting."},
+                    {"month": 4, "day_start": 1, "day_end": 15, "title": "🐣 Pasqua", "type": "Cultural", "desc": "Festività nazionali."},
+                    {"month": 5, "day_start": 1, "day_end": 12, "title": "💐 Festa della Mamma", "type": "Commercial", "desc": "Lifestyle gifting."},
+                    {"month": 7, "day_start": 1, "day_end": 31, "title": "☀️ Saldi Estivi", "type": "Commercial", "desc": "Svuotamento inventory."},
+                    {"month": 11, "day_start": 20, "day_end": 30, "title": "🖤 Black Friday", "type": "Commercial", "desc": "Picco annuale Ads."},
+                    {"month": 12, "day_start": 1, "day_end": 24, "title": "🎄 Natale", "type": "Commercial", "desc": "Massimo volume ordini."},
+                ]
 
-            correlation_rows = []
-            for idx, row in monthly_biz.iterrows():
-                m_start = row['Data_Interna'].replace(day=1)
-                m_end = (m_start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+                # Meteo ed eventi agganciati per mese con dei join: il meteo è aggregato una volta sola (in cache per versione dell'archivio)
+                # Per il dato nazionale usiamo la media di tutte le città (temperatura e pioggia medie)
+                weather_city_m, weather_nat_m = weather_monthly(full_start, full_end, weather_version, weather_full_df)
+                ledger_m = monthly_biz.merge(weather_nat_m, left_on='Month_Year', right_index=True, how='left')
+                m_start = ledger_m['Data_Interna'].dt.to_period('M').dt.start_time
                 
                 # Cerchiamo eventi nel mese
-                m_events = [ev['title'] for ev in events_template if ev['month'] == m_start.month]
-                event_str = ", ".join(m_events) if m_events else "Nessun evento"
+                events_by_month = pd.DataFrame(events_template).groupby('month')['title'].agg(", ".join)
+                event_str = m_start.dt.month.map(events_by_month).fillna("Nessun evento")
                 
                 # Macro/Inflazione Proxy (Logica ISTAT 2024-25)
                 # Simulo un sentiment basato sul periodo storico
-                inflazione = "1.2%" # Baseline Italia
-                if m_start.year == 2024 and m_start.month > 9: inflazione = "0.7% (Deflazione)"
-                elif m_start.year == 2025: inflazione = "1.0% (Stabile)"
-                
-                # Dati Meteo Sintetizzati (da cache o chiamata ridotta)
-                # Per velocità usiamo dati aggregati da Milano/Roma come proxy nazionale
-                city_w = weather_full_df[pd.to_datetime(weather_full_df['Date']).dt.to_period('M') == m_start.strftime('%Y-%m')]
-                if not city_w.empty:
-                    avg_t = city_w['temp'].mean()
-                    sum_r = city_w['rain'].mean() # Media delle città per avere un'idea nazionale
-                else:
-                    avg_t, sum_r = 15.0, 40.0 # Fallback
-                
-                correlation_rows.append({
-                    'Mese': row['Month_Year'],
-                    'Fatturato': row['Fatturato_Netto'],
-                    'Spesa Ads': row['Spesa_Ads_Totale'],
-                    'MER': row['MER'],
-                    'Temp Media': f"{avg_t:.1f}°C",
-                    'Pioggia': f"{sum_r:.0f} mm",
-                    'Contesto Esterno': f"{event_str} | Infl. {inflazione}"
+                inflazione = np.select(
+                    [(m_start.dt.year == 2024) & (m_start.dt.month > 9), m_start.dt.year == 2025],
+                    ["0.7% (Deflazione)", "1.0% (Stabile)"], default="1.2%" # Baseline Italia
+                )
+                
+                ledger_df = pd.DataFrame({
+                    'Mese': ledger_m['Month_Year'],
+                    'Fatturato': ledger_m['Fatturato_Netto'],
+                    'Spesa Ads': ledger_m['Spesa_Ads_Totale'],
+                    'MER': ledger_m['MER'],
+                    'Temp Media': ledger_m['temp'].fillna(15.0).map("{:.1f}°C".format), # Fallback senza meteo
+                    'Pioggia': ledger_m['rain'].fillna(40.0).map("{:.0f} mm".format),
+                    'Contesto Esterno': event_str + " | Infl. " + inflazione
                 })
-            
-            ledger_df = pd.DataFrame(correlation_rows)
-            
-            # Styling della tabella
-            st.dataframe(ledger_df.style.format({
-                'Fatturato': '€ {:,.0f}',
-                'Spesa Ads': '€ {:,.0f}',
-                'MER': '{:.2f}'
-            }).background_gradient(subset=['MER'], cmap='RdYlGn', vmin=monthly_biz['MER'].min(), vmax=monthly_biz['MER'].max()), use_container_width=True)
-            
-            # --- CONCLUSIONI AUTOMATICHE ---
-            st.subheader("💡 Verdetto di Correlazione")
-            best_month = monthly_biz.loc[monthly_biz['MER'].idxmax()]
-            worst_month = monthly_biz.loc[monthly_biz['MER'].idxmin()]
-            
-            col_res1, col_res2 = st.columns(2)
-            with col_res1:
-                st.success(f"**Mese Top: {best_month['Month_Year']}**")
-                # Cerchiamo se c'era pioggia o eventi
-                best_info = ledger_df[ledger_df['Mese'] == best_month['Month_Year']].iloc[0]
-                st.write(f"In questo periodo l'efficienza è stata massima ({best_month['MER']:.2f}).")
-                st.caption(f"Fattori Esterni: {best_info['Contesto Esterno']} | Meteo: {best_info['Temp Media']}")
-            
-            with col_res2:
-                st.error(f"**Mese Critico: {worst_month['Month_Year']}**")
-                worst_info = ledger_df[ledger_df['Mese'] == worst_month['Month_Year']].iloc[0]
-                st.write(f"Calo di efficienza rilevato ({worst_month['MER']:.2f}).")
-                st.caption(f"Fattori Esterni: {worst_info['Contesto Esterno']} | Meteo: {worst_info['Temp Media']}")
-            
-            st.warning("⚠️ **Conclusione Strategica:** Se vedi un MER alto in mesi con 'Saldi' o 'Pioggia > 60mm', la tua crescita è drogata da fattori esterni. Non scalare il budget nel mese successivo se le condizioni meteo/commerciali cambiano.")
+                
+                # Styling della tabella
+                st.dataframe(ledger_df.style.format({
+                    'Fatturato': '€ {:,.0f}',
+                    'Spesa Ads': '€ {:,.0f}',
+                    'MER': '{:.2f}'
+                }).background_gradient(subset=['MER'], cmap='RdYlGn', vmin=monthly_biz['MER'].min(), vmax=monthly_biz['MER'].max()), use_container_width=True)
+                
+                with st.expander("🌦️ Meteo Mensile per Città"):
+                    w_metric = st.radio("Metrica", ["Temperatura Media (°C)", "Pioggia Media (mm)"], horizontal=True, key="ledger_city_metric")
+                    city_view = weather_city_m[weather_city_m.index.isin(monthly_biz['Month_Year'])]
+                    city_view = city_view['temp'] if w_metric.startswith("Temperatura") else city_view['rain']
+                    st.dataframe(city_view.style.format(precision=1).background_gradient(cmap='coolwarm' if w_metric.startswith("Temperatura") else 'Blues', axis=None), use_container_width=True)
+                
+                # --- CONCLUSIONI AUTOMATICHE ---
+                st.subheader("💡 Verdetto di Correlazione")
+                best_month = monthly_biz.loc[monthly_biz['MER'].idxmax()]
+                worst_month = monthly_biz.loc[monthly_biz['MER'].idxmin()]
+                
+                col_res1, col_res2 = st.columns(2)
+                with col_res1:
+                    st.success(f"**Mese Top: {best_month['Month_Year']}**")
+                    # Cerchiamo se c'era pioggia o eventi
+                    best_info = ledger_df[ledger_df['Mese'] == best_month['Month_Year']].iloc[0]
+                    st.write(f"In questo periodo l'efficienza è stata massima ({best_month['MER']:.2f}).")
+                    st.caption(f"Fattori Esterni: {best_info['Contesto Esterno']} | Meteo: {best_info['Temp Media']}")
+                
+                with col_res2:
+                    st.error(f"**Mese Critico: {worst_month['Month_Year']}**")
+                    worst_info = ledger_df[ledger_df['Mese'] == worst_month['Month_Year']].iloc[0]
+                    st.write(f"Calo di efficienza rilevato ({worst_month['MER']:.2f}).")
+                    st.caption(f"Fattori Esterni: {worst_info['Contesto Esterno']} | Meteo: {worst_info['Temp Media']}")
+                
+                st.warning("⚠️ **Conclusione Strategica:** Se vedi un MER alto in mesi con 'Saldi' o 'Pioggia > 60mm', la tua crescita è drogata da fattori esterni. Non scalare il budget nel mese successivo se le condizioni meteo/commerciali cambiano.")
 
     except Exception as e:
         st.error(f"⚠️ Errore: {e}")
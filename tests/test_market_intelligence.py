@@ -0,0 +1,34 @@
+"""Smoke test del tab Market Intelligence senza dati meteo (offline / file mancante)."""
+from pathlib import Path
+
+import warnings
+
+import pytest
+from streamlit.testing.v1 import AppTest
+
+APP = str(Path(__file__).resolve().parents[1] / "app_forecast_demo.py")
+
+
+@pytest.fixture
+def no_weather(tmp_path, monkeypatch):
+    monkeypatch.setenv("FORECAST_STORE_DIR", str(tmp_path / "store"))
+    monkeypatch.setenv("FORECAST_WEATHER_PROVIDER", "file")
+    monkeypatch.setenv("FORECAST_WEATHER_FILE", str(tmp_path / "weather_local.csv"))
+
+
+def test_ledger_falls_back_without_weather(no_weather):
+    at = AppTest.from_file(APP, default_timeout=300)
+    at.run()
+    # Tab aperto prima di caricare la demo: gli altri tab (modelli, backtest) non vengono eseguiti
+    at.session_state["main_tabs"] = "🌍 Market Intelligence"
+    with warnings.catch_warnings():
+        # Il fallback del ledger non deve passare per downcast deprecati (colonne meteo object)
+        warnings.simplefilter("error", FutureWarning)
+        at.toggle[0].set_value(True).run()
+
+    assert not at.exception
+    assert not [e.value for e in at.error if e.value.startswith("Errore:")]
+    assert "💡 Verdetto di Correlazione" in [h.value for h in at.subheader]
+    ledger = next(d.value for d in at.dataframe if "Temp Media" in d.value.columns)
+    assert (ledger["Temp Media"] == "15.0°C").all()
+    assert (ledger["Pioggia"] == "40 mm").all()
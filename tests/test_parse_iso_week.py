@@ -0,0 +1,57 @@
+"""parse_iso_week vettoriale contro il parser riga per riga originale (fromisocalendar)."""
+import ast
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+APP = Path(__file__).resolve().parents[1] / "app_forecast_demo.py"
+
+
+def load_app_function(name):
+    """Compila una sola funzione top-level dello script, senza eseguire l'app Streamlit."""
+    tree = ast.parse(APP.read_text(encoding="utf-8"))
+    node = next(n for n in tree.body if isinstance(n, ast.FunctionDef) and n.name == name)
+    ns = {"np": np, "pd": pd}
+    exec(compile(ast.Module(body=[node], type_ignores=[]), str(APP), "exec"), ns)
+    return ns[name]
+
+
+def legacy_parse_iso_week(week_str):
+    try:
+        week_str = str(week_str).strip()
+        if len(week_str) < 6: return pd.NaT
+        year = int(week_str[:4])
+        week = int(week_str[4:])
+        return datetime.fromisocalendar(year, week, 1)
+    except Exception:
+        return pd.NaT
+
+
+EDGE_INPUTS = [
+    "20231", "20239", "2023 01", "202353", "2023001", 202301, None, "abc",
+    "202001", "202053", "2020053", " 202410 ", "202400", "2024054", "", np.nan,
+]
+
+
+@pytest.mark.parametrize("value", EDGE_INPUTS)
+def test_matches_legacy_parser(value):
+    parse_iso_week = load_app_function("parse_iso_week")
+    got = parse_iso_week([value]).iloc[0]
+    expected = legacy_parse_iso_week(value)
+    if pd.isna(expected):
+        assert pd.isna(got)
+    else:
+        assert got == pd.Timestamp(expected)
+
+
+def test_repeated_values_keep_order_and_index():
+    parse_iso_week = load_app_function("parse_iso_week")
+    values = pd.Series(["202301", "abc", "202301", "202452"], index=[10, 11, 12, 13])
+    got = parse_iso_week(values)
+    assert list(got.index) == [10, 11, 12, 13]
+    assert got.iloc[0] == got.iloc[2] == pd.Timestamp("2023-01-02")
+    assert pd.isna(got.iloc[1])
+    assert got.iloc[3] == pd.Timestamp("2024-12-23")